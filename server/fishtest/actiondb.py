@@ -3,11 +3,12 @@ from datetime import UTC, datetime
 from bson.objectid import ObjectId
 from pymongo import DESCENDING
 from pymongo.errors import OperationFailure
-from vtjson import ValidationError, validate
+from vtjson import ValidationError
 
 from fishtest.lru_cache import lru_cache
-from fishtest.schemas import ACTION_MESSAGE_SIZE, action_schema
+from fishtest.schemas import ACTION_MESSAGE_SIZE
 from fishtest.util import hex_print, worker_name
+from fishtest.validators import validate_action
 
 
 def run_name(run):
@@ -21,7 +22,7 @@ class ActionDb:
         self.db = db
         self.actions = self.db["actions"]
 
-    @lru_cache(maxsize=1, expiration=30, refresh=False)
+    @lru_cache(maxsize=1, expiration=30, refresh=False, stale_while_revalidate=60)
     def get_action_usernames(self):
         return sorted(self.actions.distinct("username"), key=str.lower)
 
@@ -306,7 +307,7 @@ class ActionDb:
         action["time"] = datetime.now(UTC).timestamp()
         action["_id"] = ObjectId()
         try:
-            validate(action_schema, action, "action")
+            validate_action(action)
         except ValidationError as e:
             message = (
                 f"Internal Error. Request {str(action)} does not validate: {str(e)}"
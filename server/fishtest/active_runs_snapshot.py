@@ -0,0 +1,148 @@
+import copy
+import hashlib
+import json
+import threading
+import zlib
+from datetime import UTC, datetime
+
+import bson
+from bson.codec_options import CodecOptions
+
+_CODEC_OPTIONS = CodecOptions(tz_aware=True, tzinfo=UTC)
+
+
+def lightweight_run(run):
+    """Copy of the run without the tasks, the bad tasks and the spsa
+    parameter history (the projection used for the unfinished runs)."""
+    lightweight = {}
+    for key, value in run.items():
+        if key in ("tasks", "bad_tasks"):
+            continue
+        if key == "args" and "spsa" in value:
+            value = value | {
+                "spsa": {k: v for k, v in value["spsa"].items() if k != "param_history"}
+            }
+        lightweight[key] = copy.deepcopy(value)
+    return lightweight
+
+
+class Snapshot:
+    """Immutable view of the unfinished runs.
+
+    It contains the lightweight runs (sorted by _id) and the serialized
+    response of /api/active_runs together with its ETag. The runs are
+    shared by all readers so they must not be modified.
+    """
+
+    __slots__ = ("runs", "time", "body", "etag", "__aggregates")
+
+    def __init__(self, runs, time=None):
+        self.runs = runs
+        self.time = time if time is not None else datetime.now(UTC)
+        active = {}
+        for run in runs:
+            run = copy.copy(run)
+            # some string conversions
+            for key in ("_id", "start_time", "last_updated"):
+                run[key] = str(run[key])
+            active[run["_id"]] = run
+        self.body = json.dumps(
+            active,
+            ensure_ascii=False,
+            allow_nan=False,
+            separators=(",", ":"),
+            default=str,
+        ).encode()
+        self.etag = f'"{hashlib.blake2b(self.body, digest_size=16).hexdigest()}"'
+        self.__aggregates = {}
+
+    def aggregate(self, username, compute):
+        """Memoize compute(runs) for the runs of username (all runs if
+        username is empty)."""
+        if username not in self.__aggregates:
+            runs = self.runs
+            if username:
+                runs = [run for run in runs if run["args"]["username"] == username]
+            # A race only leads to a duplicate computation.
+            self.__aggregates[username] = compute(runs)
+        return self.__aggregates[username]
+
+
+class ActiveRunsSnapshot:
+    """Holder of the current Snapshot.
+
+    On the primary instance the snapshot is built from the run cache by
+    build(), which is called periodically and after invalidate() (i.e.
+    after a state change of a run) when the snapshot is requested. The
+    snapshot is then published in the kvstore, from where the secondary
+    instances load it with load(), instead of scanning the runs
+    collection. The runs are published as zlib compressed bson: the
+    parameters of a large SPSA tune would otherwise make the document
+    several MB large, or even exceed the 16 MB limit of MongoDB.
+    """
+
+    KVSTORE_KEY = "active_runs_snapshot"
+
+    def __init__(self, kvstore, build):
+        self.kvstore = kvstore
+        self.lock = threading.Lock()
+        self.__build = build
+        self.__snapshot = None
+        self.__dirty = True
+
+    def invalidate(self):
+        self.__dirty = True
+
+    def __rebuild(self):
+        # Helper method. The caller should hold the lock.
+        # Clear the flag first, so that a concurrent invalidation
+        # triggers a new rebuild.
+        self.__dirty = False
+        self.__snapshot = Snapshot(self.__build())
+
+    def get(self):
+        """Primary instance: the current snapshot, rebuilt if needed."""
+        snapshot = self.__snapshot
+        if snapshot is None or self.__dirty:
+            with self.lock:
+                if self.__snapshot is None or self.__dirty:
+                    self.__rebuild()
+                snapshot = self.__snapshot
+        return snapshot
+
+    def publish(self):
+        """Primary instance: rebuild the snapshot and store it in the kvstore."""
+        with self.lock:
+            self.__rebuild()
+            snapshot = self.__snapshot
+        runs_zlib = zlib.compress(bson.encode({"runs": snapshot.runs}))
+        try:
+            self.kvstore[self.KVSTORE_KEY] = {
+                "time": snapshot.time,
+                "runs_zlib": runs_zlib,
+            }
+        except Exception as e:
+            # The secondary instances will consider the last published
+            # snapshot as too old and fall back to the runs collection.
+            print(
+                f"Unable to publish the active runs snapshot "
+                f"({len(runs_zlib)} bytes): {str(e)}",
+                flush=True,
+            )
+
+    def load(self, max_age):
+        """Secondary instance: the snapshot published by the primary instance,
+        or None if it is absent or older than max_age (in seconds)."""
+        value = self.kvstore.get(self.KVSTORE_KEY)
+        if value is None or "runs_zlib" not in value:
+            return None
+        if (datetime.now(UTC) - value["time"]).total_seconds() > max_age:
+            return None
+        with self.lock:
+            snapshot = self.__snapshot
+            if snapshot is None or snapshot.time != value["time"]:
+                runs = bson.decode(
+                    zlib.decompress(value["runs_zlib"]), codec_options=_CODEC_OPTIONS
+                )["runs"]
+                snapshot = self.__snapshot = Snapshot(runs, value["time"])
+            return snapshot
@@ -0,0 +1,93 @@
+import threading
+
+from fishtest.util import estimate_game_duration
+
+
+class ActiveTasks:
+    """Index of the active tasks of the unfinished runs.
+
+    Long runs have tens of thousands of tasks of which only a few
+    hundred are active at any time. For every run we keep the ids of the
+    active tasks together with their contribution to the nps and the
+    games per minute of the run, and the running sums of those, so that
+    the periodic jobs and the machines page do not have to scan all the
+    tasks.
+
+    The index is updated by the callers when a task is created, updated
+    or becomes inactive, and is rebuilt on startup.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # run_id -> {"tasks": {task_id: (nps, games_per_minute)},
+        #            "nps": float, "games_per_minute": float}
+        self.__runs = {}
+
+    @staticmethod
+    def contribution(run, task):
+        worker_info = task["worker_info"]
+        concurrency = worker_info["concurrency"]
+        nps = concurrency * float(worker_info["nps"])
+        games_per_minute = 0.0
+        if worker_info["nps"] != 0:
+            games_per_minute = (
+                (worker_info["nps"] / 628000)
+                * (60.0 / estimate_game_duration(run["args"]["tc"]))
+                * (int(concurrency) // run["args"].get("threads", 1))
+            )
+        return nps, games_per_minute
+
+    def __discard(self, run_id, task_id):
+        # Helper method. Not synchronized!
+        entry = self.__runs.get(run_id)
+        if entry is None or task_id not in entry["tasks"]:
+            return
+        nps, games_per_minute = entry["tasks"].pop(task_id)
+        if entry["tasks"]:
+            entry["nps"] -= nps
+            entry["games_per_minute"] -= games_per_minute
+        else:
+            # No rounding errors may survive.
+            del self.__runs[run_id]
+
+    def update(self, run, task_id):
+        """Add, refresh or remove the task, depending on its current state."""
+        run_id = str(run["_id"])
+        task = run["tasks"][task_id]
+        with self.lock:
+            self.__discard(run_id, task_id)
+            if not task["active"]:
+                return
+            nps, games_per_minute = self.contribution(run, task)
+            entry = self.__runs.setdefault(
+                run_id, {"tasks": {}, "nps": 0.0, "games_per_minute": 0.0}
+            )
+            entry["tasks"][task_id] = nps, games_per_minute
+            entry["nps"] += nps
+            entry["games_per_minute"] += games_per_minute
+
+    def remove(self, run_id, task_id):
+        with self.lock:
+            self.__discard(str(run_id), task_id)
+
+    def remove_run(self, run_id):
+        with self.lock:
+            self.__runs.pop(str(run_id), None)
+
+    def clear(self):
+        with self.lock:
+            self.__runs.clear()
+
+    def task_ids(self, run_id):
+        """Return the sorted list of the ids of the active tasks of the run."""
+        with self.lock:
+            entry = self.__runs.get(str(run_id))
+            return sorted(entry["tasks"]) if entry is not None else []
+
+    def totals(self, run_id):
+        """Return (nps, games_per_minute) summed over the active tasks."""
+        with self.lock:
+            entry = self.__runs.get(str(run_id))
+            if entry is None:
+                return 0.0, 0.0
+            return entry["nps"], entry["games_per_minute"]
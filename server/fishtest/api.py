@@ -1,24 +1,42 @@
 import base64
 import copy
-import io
+import json
 import os
 import re
+from collections.abc import AsyncIterator
 from datetime import UTC, datetime
 from urllib.parse import urlparse
 
 from fastapi import APIRouter, HTTPException
-from starlette.concurrency import iterate_in_threadpool, run_in_threadpool
+from starlette.concurrency import iterate_in_threadpool
 from starlette.requests import Request
-from starlette.responses import JSONResponse, RedirectResponse, StreamingResponse
-from vtjson import ValidationError, validate
+from starlette.responses import (
+    JSONResponse,
+    RedirectResponse,
+    Response,
+    StreamingResponse,
+)
+from vtjson import ValidationError
 
 import fishtest.github_api as gh
 from fishtest.http.boundary import ApiRequestShim, get_request_shim
-from fishtest.schemas import api_access_schema, api_schema, gzip_data
-from fishtest.stats.stat_util import SPRT_elo, get_elo
-from fishtest.util import strip_run, worker_name
-
-WORKER_VERSION = 325
+from fishtest.http.metrics import run_in_threadpool
+from fishtest.http.settings import (
+    ELO_BATCH_MAX_RUNS,
+    PGN_UPLOAD_MAX_SIZE_BYTES,
+    PGN_UPLOAD_REQUEST_MAX_SIZE_BYTES,
+)
+from fishtest.stats.stat_util import SPRT_elo, SPRT_elo_batch, get_elo
+from fishtest.util import iter_chunks, strip_run, worker_name
+from fishtest.validators import (
+    validate_api_access,
+    validate_api_beat,
+    validate_api_request,
+    validate_api_update_task,
+    validate_gzip_data,
+)
+
+WORKER_VERSION = 331
 
 WORKER_API_PATHS = {
     "/api/request_version",
@@ -29,29 +47,20 @@ WORKER_API_PATHS = {
     "/api/failed_task",
     "/api/stop_run",
     "/api/upload_pgn",
+    "/api/upload_pgn_stream",
     "/api/worker_log",
 }
 
-# Primary-only worker endpoints exclude upload_pgn, which is routed to a
+# Primary-only worker endpoints exclude the pgn uploads, which are routed to a
 # non-primary backend for single-instance handling.
-PRIMARY_ONLY_WORKER_API_PATHS = WORKER_API_PATHS - {"/api/upload_pgn"}
+PRIMARY_ONLY_WORKER_API_PATHS = WORKER_API_PATHS - {
+    "/api/upload_pgn",
+    "/api/upload_pgn_stream",
+}
 
 router = APIRouter(tags=["api"])
 
 
-def _iter_filelike(fileobj, chunk_size=1024 * 1024):
-    try:
-        while True:
-            chunk = fileobj.read(chunk_size)
-            if not chunk:
-                break
-            yield chunk
-    finally:
-        close = getattr(fileobj, "close", None)
-        if callable(close):
-            close()
-
-
 class GenericApi:
     def __init__(self, request):
         self.request = request
@@ -89,7 +98,7 @@ class WorkerApi(GenericApi):
     def validate_username_password(self):
         # Is the request syntactically correct?
         try:
-            validate(api_access_schema, self.request_body, "request")
+            validate_api_access(self.request_body)
         except ValidationError as e:
             self.handle_error(str(e))
 
@@ -101,12 +110,13 @@ class WorkerApi(GenericApi):
         if "error" in token:
             self.handle_error(token["error"], status_code=401)
 
-    def validate_request(self):
+    def validate_request(self, validator=validate_api_request):
         """This function will load the run from the cache or the db,
         depending on the type of instance it runs on (primary or
         secondary). If the request refers to a particular
         task then one needs to make sure that it has been saved
         to disk when invoking this function on a secondary instance.
+        The endpoints called at a high rate pass a narrower validator.
         """
         self.__run = None
         self.__task = None
@@ -116,7 +126,7 @@ class WorkerApi(GenericApi):
 
         # Is the request syntactically correct?
         try:
-            validate(api_schema, self.request_body, "request")
+            validator(self.request_body)
         except ValidationError as e:
             self.handle_error(str(e))
 
@@ -237,7 +247,7 @@ class WorkerApi(GenericApi):
         return self.add_time(result)
 
     def update_task(self):
-        self.validate_request()
+        self.validate_request(validate_api_update_task)
         result = self.request.rundb.update_task(
             worker_info=self.worker_info(),
             run_id=self.run_id(),
@@ -275,7 +285,19 @@ class WorkerApi(GenericApi):
         self.validate_request()
         try:
             pgn_zip = base64.b64decode(self.pgn())
-            validate(gzip_data, pgn_zip, "pgn")
+            validate_gzip_data(pgn_zip)
+        except Exception as e:
+            self.handle_error(str(e))
+        result = self.request.rundb.upload_pgn(
+            run_id=f"{self.run_id()}-{self.task_id()}",
+            pgn_zip=pgn_zip,
+        )
+        return self.add_time(result)
+
+    def upload_pgn_stream(self, pgn_zip):
+        # The request has already been validated before the body was read.
+        try:
+            validate_gzip_data(pgn_zip)
         except Exception as e:
             self.handle_error(str(e))
         result = self.request.rundb.upload_pgn(
@@ -319,13 +341,18 @@ class WorkerApi(GenericApi):
         return self.add_time({"version": WORKER_VERSION})
 
     def beat(self):
-        self.validate_request()
+        self.validate_request(validate_api_beat)
         run = self.run()
         task = self.task()
         with self.request.rundb.active_run_lock(self.run_id()):
             if task["active"]:
                 task["last_updated"] = datetime.now(UTC)
-                self.request.rundb.buffer(run)
+                self.request.rundb.task_deadlines.touch(
+                    self.run_id(), self.task_id(), task["last_updated"]
+                )
+                self.request.rundb.buffer(
+                    run, paths=(f"tasks.{self.task_id()}.last_updated",)
+                )
             return self.add_time({"task_alive": task["active"]})
 
     def request_spsa(self):
@@ -342,17 +369,7 @@ class UserApi(GenericApi):
         return gh.rate_limit()
 
     def active_runs(self):
-        runs = self.request.rundb.runs.find(
-            {"finished": False},
-            {"tasks": 0, "bad_tasks": 0, "args.spsa.param_history": 0},
-        )
-        active = {}
-        for run in runs:
-            # some string conversions
-            for key in ("_id", "start_time", "last_updated"):
-                run[key] = str(run[key])
-            active[str(run["_id"])] = run
-        return active
+        return self.request.rundb.get_active_runs_snapshot()
 
     def finished_runs(self):
         username = self.request.params.get("username", "")
@@ -482,6 +499,45 @@ class UserApi(GenericApi):
         run["elo"] = a
         return run
 
+    def get_elo_batch(self):
+        run_ids = [
+            run_id for run_id in self.request.params.get("ids", "").split(",") if run_id
+        ]
+        if not run_ids:
+            self.handle_error("Please provide a comma separated list of run ids.")
+        if len(run_ids) > ELO_BATCH_MAX_RUNS:
+            self.handle_error(f"At most {ELO_BATCH_MAX_RUNS} run ids are allowed.")
+        runs = self.request.rundb.get_runs_results(run_ids)
+        # Unknown runs are reported as null and non SPRT runs as {}
+        # (like /api/get_elo).
+        ret = {run_id: None for run_id in run_ids}
+        sprt_runs = []
+        tests = []
+        for run_id, run in runs.items():
+            ret[run_id] = {}
+            sprt = run["args"].get("sprt")
+            if sprt is None:
+                continue
+            sprt_runs.append(run_id)
+            tests.append(
+                {
+                    "results": copy.deepcopy(run["results"]),
+                    "alpha": sprt["alpha"],
+                    "beta": sprt["beta"],
+                    "elo0": sprt["elo0"],
+                    "elo1": sprt["elo1"],
+                    "elo_model": sprt.get("elo_model", "BayesElo"),
+                    "state": sprt.get("state", ""),
+                    "llr": sprt.get("llr", 0.0),
+                }
+            )
+        for run_id, test, a in zip(sprt_runs, tests, SPRT_elo_batch(tests)):
+            results = test.pop("results")
+            ret[run_id] = {"sprt": test, "results": results, "elo": a}
+        self.request.response.headers["access-control-allow-origin"] = "*"
+        self.request.response.headers["access-control-allow-headers"] = "content-type"
+        return ret
+
     def calc_elo(self):
         W = self.request.params.get("W")
         D = self.request.params.get("D")
@@ -598,27 +654,39 @@ class UserApi(GenericApi):
             "Content-Length": str(size),
         }
         return StreamingResponse(
-            iterate_in_threadpool(_iter_filelike(io.BytesIO(pgn_zip))),
+            iterate_in_threadpool(iter_chunks([pgn_zip])),
             media_type="application/gzip",
             headers=headers,
         )
 
     def download_run_pgns(self):
         pgns_name = self.request.matchdict["id"]
-        match = re.match(r"^([a-zA-Z0-9]+)\.pgn\.gz$", pgns_name)
+        match = re.match(r"^([a-zA-Z0-9]+)(\.pgn\.gz|\.tar)$", pgns_name)
         if not match:
             self.handle_error(f"Invalid filename format for {pgns_name}")
         run_id = match.group(1)
-        pgns_reader, total_size = self.request.rundb.get_run_pgns(run_id)
-        if pgns_reader is None:
+        # The tar archive contains the pgns of the tasks as separate
+        # members, together with an index (see PgnTar).
+        archive_format = self.request.params.get(
+            "format", "tar" if match.group(2) == ".tar" else "gz"
+        )
+        if archive_format == "gz":
+            pgns, total_size = self.request.rundb.get_run_pgns(run_id)
+            filename, media_type = f"{run_id}.pgn.gz", "application/gzip"
+        elif archive_format == "tar":
+            pgns, total_size = self.request.rundb.get_run_pgns_tar(run_id)
+            filename, media_type = f"{run_id}.tar", "application/x-tar"
+        else:
+            self.handle_error(f"Invalid format {archive_format}")
+        if pgns is None:
             self.handle_error(f"No data found for {pgns_name}", status_code=404)
         headers = {
-            "Content-Disposition": f'attachment; filename="{pgns_name}"',
+            "Content-Disposition": f'attachment; filename="{filename}"',
             "Content-Length": str(total_size),
         }
         return StreamingResponse(
-            iterate_in_threadpool(_iter_filelike(pgns_reader)),
-            media_type="application/gzip",
+            iterate_in_threadpool(iter_chunks(pgns)),
+            media_type=media_type,
             headers=headers,
         )
 
@@ -690,16 +758,81 @@ async def api_upload_pgn(request: Request):
     return await run_in_threadpool(api.upload_pgn)
 
 
+async def _read_stream_request(
+    request: Request, stream: AsyncIterator[bytes]
+) -> tuple[ApiRequestShim, bytes]:
+    # The body of /api/upload_pgn_stream starts with the json request,
+    # terminated by a newline (json.dumps() escapes the newlines in
+    # strings), so that the credentials are not sent in a header.
+    # Returns the request shim and the data read past the newline.
+    head = bytearray()
+    async for chunk in stream:
+        head += chunk
+        if b"\n" in chunk or len(head) > PGN_UPLOAD_REQUEST_MAX_SIZE_BYTES:
+            break
+    line, newline, rest = bytes(head).partition(b"\n")
+    if not newline or len(line) > PGN_UPLOAD_REQUEST_MAX_SIZE_BYTES:
+        return ApiRequestShim(request, json_error=True), b""
+    try:
+        json_body = json.loads(line)
+    except ValueError:
+        return ApiRequestShim(request, json_error=True), b""
+    return ApiRequestShim(request, json_body=json_body), rest
+
+
+async def _read_body(
+    stream: AsyncIterator[bytes], max_size: int, head: bytes = b""
+) -> bytes | None:
+    # Returns None if the body is too large. Only the chunks received
+    # so far are kept in memory.
+    chunks = [head]
+    size = len(head)
+    if size > max_size:
+        return None
+    async for chunk in stream:
+        size += len(chunk)
+        if size > max_size:
+            return None
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+
+@router.post("/api/upload_pgn_stream")
+async def api_upload_pgn_stream(request: Request):
+    stream = request.stream()
+    shim, head = await _read_stream_request(request, stream)
+    api = WorkerApi(shim)
+    # Reject unauthenticated uploads before reading the pgn.
+    await run_in_threadpool(api.validate_request)
+    pgn_zip = await _read_body(stream, PGN_UPLOAD_MAX_SIZE_BYTES, head)
+    if pgn_zip is None:
+        api.handle_error(
+            f"pgn larger than {PGN_UPLOAD_MAX_SIZE_BYTES} bytes", status_code=413
+        )
+    return await run_in_threadpool(api.upload_pgn_stream, pgn_zip)
+
+
 @router.get("/api/rate_limit")
 async def api_rate_limit(request: Request):
     api = UserApi(ApiRequestShim(request))
     return await run_in_threadpool(api.rate_limit)
 
 
+def _etag_matches(if_none_match, etag):
+    if if_none_match is None:
+        return False
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags
+
+
 @router.get("/api/active_runs")
 async def api_active_runs(request: Request):
     api = UserApi(ApiRequestShim(request))
-    return await run_in_threadpool(api.active_runs)
+    snapshot = await run_in_threadpool(api.active_runs)
+    headers = {"ETag": snapshot.etag}
+    if _etag_matches(request.headers.get("if-none-match"), snapshot.etag):
+        return Response(status_code=304, headers=headers)
+    return Response(snapshot.body, media_type="application/json", headers=headers)
 
 
 @router.get("/api/finished_runs")
@@ -734,6 +867,13 @@ async def api_get_elo(id, request: Request):
     return await run_in_threadpool(api.get_elo)
 
 
+@router.get("/api/get_elo_batch")
+async def api_get_elo_batch(request: Request):
+    api = UserApi(ApiRequestShim(request))
+    result = await run_in_threadpool(api.get_elo_batch)
+    return JSONResponse(result, headers=api.request.response.headers)
+
+
 @router.get("/api/calc_elo")
 async def api_calc_elo(request: Request):
     api = UserApi(ApiRequestShim(request))
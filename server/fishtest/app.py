@@ -35,9 +35,11 @@ from fishtest.http.cookie_session import (
     session_secret_key,
 )
 from fishtest.http.errors import install_error_handlers
+from fishtest.http.metrics import router as metrics_router
 from fishtest.http.middleware import (
     AttachRequestStateMiddleware,
     HeadMethodMiddleware,
+    MetricsMiddleware,
     RedirectBlockedUiUsersMiddleware,
     RejectNonPrimaryWorkerApiMiddleware,
     ShutdownGuardMiddleware,
@@ -192,6 +194,7 @@ def create_app() -> FastAPI:
     app.add_middleware(cast("MiddlewareFactory", HeadMethodMiddleware))
     app.add_middleware(cast("MiddlewareFactory", ShutdownGuardMiddleware))
     app.add_middleware(cast("MiddlewareFactory", AttachRequestStateMiddleware))
+    app.add_middleware(cast("MiddlewareFactory", MetricsMiddleware))
     app.add_middleware(
         cast("MiddlewareFactory", RejectNonPrimaryWorkerApiMiddleware),
     )
@@ -215,6 +218,7 @@ def create_app() -> FastAPI:
 
     app.include_router(views_router)
     app.include_router(api_router)
+    app.include_router(metrics_router)
 
     return app
 
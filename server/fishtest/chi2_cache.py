@@ -0,0 +1,123 @@
+import copy
+import threading
+from collections import OrderedDict
+
+from fishtest.util import get_chi2_from_worker_stats, worker_wld
+
+
+class Chi2Cache:
+    """Per run aggregate of the task stats by worker, for get_chi2().
+
+    get_chi2() aggregates all the tasks of a run by worker before doing
+    the actual chi^2 computation, which is expensive for big runs. Here
+    we keep the aggregate, together with the contribution of every task,
+    so that an update of a task only requires subtracting its old
+    contribution and adding the new one. The chi^2 result itself is
+    memoized until the next update of the run.
+
+    The aggregate of a run is built on first use. At most maxsize runs
+    are kept (least recently used first out).
+    """
+
+    def __init__(self, maxsize=200):
+        self.lock = threading.Lock()
+        self.maxsize = maxsize
+        # run_id -> {
+        #   "has_pentanomial": bool or None,
+        #   "first_task": task_id which determined has_pentanomial,
+        #   "users": {unique_key: [wins, losses, draws]},
+        #   "tasks": {task_id: (unique_key, [wins, losses, draws])},
+        #   "version": int,
+        #   "chi2": memoized result or None,
+        # }
+        self.__runs = OrderedDict()
+
+    def __add_task(self, entry, task_id, task):
+        # Helper method. Not synchronized!
+        if "bad" in task or "worker_info" not in task:
+            return
+        stats = task.get("stats", {})
+        if entry["has_pentanomial"] is None:
+            entry["has_pentanomial"] = "pentanomial" in stats
+            entry["first_task"] = task_id
+        key = task["worker_info"]["unique_key"]
+        wld = worker_wld(stats, entry["has_pentanomial"])
+        user = entry["users"].setdefault(key, [0.0] * len(wld))
+        for i, value in enumerate(wld):
+            user[i] += value
+        entry["tasks"][task_id] = key, wld
+
+    def __build(self, run):
+        # Helper method. Not synchronized!
+        entry = {
+            "has_pentanomial": None,
+            "first_task": None,
+            "users": {},
+            "tasks": {},
+            "version": 0,
+            "chi2": None,
+        }
+        for task_id, task in enumerate(copy.copy(run["tasks"])):
+            self.__add_task(entry, task_id, task)
+        return entry
+
+    def __get_entry(self, run):
+        # Helper method. Not synchronized!
+        run_id = str(run["_id"])
+        entry = self.__runs.get(run_id)
+        if entry is None:
+            entry = self.__build(run)
+            self.__runs[run_id] = entry
+            while len(self.__runs) > self.maxsize:
+                self.__runs.popitem(last=False)
+        else:
+            self.__runs.move_to_end(run_id)
+        return entry
+
+    def update_task(self, run, task_id):
+        """Take into account the current stats (and badness) of the task."""
+        run_id = str(run["_id"])
+        task = run["tasks"][task_id]
+        with self.lock:
+            entry = self.__runs.get(run_id)
+            if entry is None:
+                return
+            if "bad" in task and entry["first_task"] == task_id:
+                # The choice between trinomial and pentanomial stats depends
+                # on the first good task. Start over.
+                del self.__runs[run_id]
+                return
+            old = entry["tasks"].pop(task_id, None)
+            if old is not None:
+                key, wld = old
+                user = entry["users"][key]
+                for i, value in enumerate(wld):
+                    user[i] -= value
+            self.__add_task(entry, task_id, task)
+            entry["version"] += 1
+            entry["chi2"] = None
+
+    def remove(self, run_id):
+        with self.lock:
+            self.__runs.pop(str(run_id), None)
+
+    def worker_stats(self, run):
+        """Return a copy of the stats of the run aggregated by worker."""
+        with self.lock:
+            entry = self.__get_entry(run)
+            return {key: list(wld) for key, wld in entry["users"].items()}
+
+    def get_chi2(self, run):
+        """Return the (memoized) result of get_chi2(run["tasks"])."""
+        with self.lock:
+            entry = self.__get_entry(run)
+            if entry["chi2"] is not None:
+                return entry["chi2"]
+            version = entry["version"]
+            users = {key: list(wld) for key, wld in entry["users"].items()}
+        # The computation is done outside the lock.
+        chi2 = get_chi2_from_worker_stats(users)
+        with self.lock:
+            if entry["version"] == version:
+                entry["chi2"] = chi2
+        return chi2
@@ -6,6 +6,8 @@ wiring for the UI and API layers.
 
 from __future__ import annotations
 
+import json
+import zlib
 from dataclasses import dataclass
 from json import JSONDecodeError
 from types import SimpleNamespace
@@ -29,7 +31,10 @@ from fishtest.http.dependencies import (
 )
 from fishtest.http.jinja import static_url
 from fishtest.http.open_graph import default_open_graph
-from fishtest.http.settings import SESSION_REMEMBER_ME_MAX_AGE_SECONDS
+from fishtest.http.settings import (
+    API_GZIP_BODY_MAX_SIZE_BYTES,
+    SESSION_REMEMBER_ME_MAX_AGE_SECONDS,
+)
 
 if TYPE_CHECKING:
     from collections.abc import Mapping
@@ -116,11 +121,27 @@ class JsonBodyResult:
     error: bool
 
 
+def gunzip_body(data: bytes, max_size: int = API_GZIP_BODY_MAX_SIZE_BYTES) -> bytes:
+    """Decompress a gzip request body of at most max_size bytes."""
+    decompressor = zlib.decompressobj(wbits=16 + zlib.MAX_WBITS)
+    body = decompressor.decompress(data, max_size)
+    if decompressor.unconsumed_tail or not decompressor.eof:
+        message = "invalid or too large gzip body"
+        raise ValueError(message)
+    return body
+
+
 async def get_json_body(request: Request) -> JsonBodyResult:
-    """Parse JSON body, preserving legacy error behavior."""
+    """Parse JSON body, preserving legacy error behavior.
+
+    Workers may send the body gzip compressed (Content-Encoding: gzip).
+    """
     try:
-        body = await request.json()
-    except JSONDecodeError, TypeError, ValueError:
+        if request.headers.get("content-encoding", "").lower() == "gzip":
+            body = json.loads(gunzip_body(await request.body()))
+        else:
+            body = await request.json()
+    except JSONDecodeError, TypeError, ValueError, zlib.error:
         return JsonBodyResult(body=None, error=True)
     return JsonBodyResult(body=body, error=False)
 
@@ -0,0 +1,122 @@
+"""Expose the server metrics on /metrics.
+
+Define the HTTP metrics recorded by the middleware, a run_in_threadpool that
+records how long the blocking work waited for a thread, and the /metrics
+endpoint in the Prometheus text exposition format.
+"""
+
+from __future__ import annotations
+
+import ipaddress
+import time
+from typing import TYPE_CHECKING, Any
+
+from anyio.to_thread import current_default_thread_limiter
+from fastapi import APIRouter
+from starlette.concurrency import run_in_threadpool as _run_in_threadpool
+from starlette.requests import Request
+from starlette.responses import PlainTextResponse, Response
+
+from fishtest.metrics import Counter, Gauge, Histogram, render
+
+if TYPE_CHECKING:
+    from collections.abc import Callable
+
+HTTP_REQUEST_DURATION = Histogram(
+    "fishtest_http_request_duration_seconds",
+    "Time from the start of a request to the end of the response.",
+    labels=("method", "route"),
+)
+
+HTTP_REQUESTS = Counter(
+    "fishtest_http_requests_total",
+    "Number of handled requests.",
+    labels=("method", "route", "status"),
+)
+
+THREADPOOL_QUEUE_WAIT = Histogram(
+    "fishtest_threadpool_queue_wait_seconds",
+    "Time blocking work waited for a thread of the threadpool.",
+    labels=("function",),
+)
+
+router = APIRouter(tags=["metrics"])
+
+
+async def run_in_threadpool[T](func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    """Run func in the threadpool like starlette's run_in_threadpool, and
+    record the time until a thread picked it up."""
+    queued_at = time.monotonic()
+    function = getattr(func, "__name__", "other")
+
+    def timed() -> T:
+        THREADPOOL_QUEUE_WAIT.observe(time.monotonic() - queued_at, function)
+        return func(*args, **kwargs)
+
+    return await _run_in_threadpool(timed)
+
+
+def _is_local_request(request: Request) -> bool:
+    # Requests forwarded by nginx come from the loopback interface too,
+    # but carry the address of the actual client in X-Forwarded-For.
+    if "x-forwarded-for" in request.headers or request.client is None:
+        return False
+    try:
+        return ipaddress.ip_address(request.client.host).is_loopback
+    except ValueError:
+        return False
+
+
+def _scrape_time_metrics(rundb: Any) -> list[Gauge | Counter]:
+    limiter = current_default_thread_limiter()
+    threads_busy = Gauge(
+        "fishtest_threadpool_busy_threads",
+        "Threads of the threadpool running blocking work.",
+        register=False,
+    )
+    threads_busy.set(limiter.borrowed_tokens)
+    threads_total = Gauge(
+        "fishtest_threadpool_threads",
+        "Size of the threadpool.",
+        register=False,
+    )
+    threads_total.set(limiter.total_tokens)
+    metrics: list[Gauge | Counter] = [threads_busy, threads_total]
+    if rundb is None:
+        return metrics
+
+    stats = rundb.run_cache.flush_stats()
+    for key, help in (
+        ("queue_depth", "Dirty runs left after the last flush."),
+        ("max_queue_depth", "Largest number of dirty runs seen by a flush."),
+        ("oldest_dirty_age", "Age in seconds of the oldest dirty run."),
+        ("last_flush_latency", "Duration in seconds of the last bulk write."),
+        ("max_flush_latency", "Longest bulk write in seconds."),
+    ):
+        gauge = Gauge(f"fishtest_run_cache_{key}", help, register=False)
+        gauge.set(stats[key])
+        metrics.append(gauge)
+    for key, name, help in (
+        ("flushes", "flushes_total", "Bulk writes of dirty runs."),
+        ("runs_flushed", "runs_flushed_total", "Dirty runs written."),
+        (
+            "total_flush_latency",
+            "flush_latency_seconds_total",
+            "Total duration of the bulk writes.",
+        ),
+    ):
+        counter = Counter(f"fishtest_run_cache_{name}", help, register=False)
+        counter.inc(amount=stats[key])
+        metrics.append(counter)
+    return metrics
+
+
+@router.get("/metrics", include_in_schema=False)
+async def metrics(request: Request) -> Response:
+    """Serve the metrics of this instance to local scrapers only."""
+    if not _is_local_request(request):
+        return PlainTextResponse("Not Found", status_code=404)
+    rundb = getattr(request.app.state, "rundb", None)
+    extra = _scrape_time_metrics(rundb)
+    body = await _run_in_threadpool(render, extra)
+    return PlainTextResponse(body, media_type="text/plain; version=0.0.4")
@@ -7,11 +7,8 @@ testable.
 from __future__ import annotations
 
 import time
-from dataclasses import dataclass, field
-from threading import Lock
 from typing import TYPE_CHECKING, Protocol
 
-from starlette.concurrency import run_in_threadpool
 from starlette.requests import Request
 from starlette.responses import JSONResponse, PlainTextResponse, RedirectResponse
 
@@ -19,6 +16,12 @@ from fishtest.api import PRIMARY_ONLY_WORKER_API_PATHS
 from fishtest.http.cookie_session import (
     authenticated_user_from_data,
 )
+from fishtest.http.metrics import (
+    HTTP_REQUEST_DURATION,
+    HTTP_REQUESTS,
+    run_in_threadpool,
+)
+from fishtest.lru_cache import lru_cache
 
 if TYPE_CHECKING:
     from starlette.types import ASGIApp, Message, Receive, Scope, Send
@@ -32,40 +35,16 @@ class _BlockedUserDb(Protocol):
         """Return blocked users from the data store."""
 
 
-@dataclass
-class _BlockedCache:
-    timestamp: float | None = None
-    value: list[dict[str, object]] | None = None
-    lock: Lock = field(default_factory=Lock)
-
-
-_blocked_cache = _BlockedCache()
-
-
+# Single flight: when the value expires, one request reloads it and the
+# others wait for its result.
+@lru_cache(
+    maxsize=1,
+    expiration=_BLOCKED_CACHE_TTL_SECONDS,
+    refresh=False,
+    single_flight=True,
+)
 def _get_blocked_cached(userdb: _BlockedUserDb) -> list[dict[str, object]]:
-    now = time.monotonic()
-    with _blocked_cache.lock:
-        if (
-            _blocked_cache.timestamp is not None
-            and _blocked_cache.value is not None
-            and now - _blocked_cache.timestamp < _BLOCKED_CACHE_TTL_SECONDS
-        ):
-            return _blocked_cache.value
-
-    # Fetch outside the lock to keep lock hold time short.
-    blocked = list(userdb.get_blocked())
-
-    with _blocked_cache.lock:
-        if (
-            _blocked_cache.timestamp is not None
-            and _blocked_cache.value is not None
-            and now - _blocked_cache.timestamp < _BLOCKED_CACHE_TTL_SECONDS
-        ):
-            return _blocked_cache.value
-
-        _blocked_cache.value = blocked
-        _blocked_cache.timestamp = now
-        return _blocked_cache.value
+    return list(userdb.get_blocked())
 
 
 async def _get_blocked_cached_async(userdb: _BlockedUserDb) -> list[dict[str, object]]:
@@ -116,7 +95,11 @@ class HeadMethodMiddleware:
                 return
             await send(message)
 
-        await self.app({**scope, "method": "GET"}, receive, send_no_body)
+        get_scope = {**scope, "method": "GET"}
+        await self.app(get_scope, receive, send_no_body)
+        # Let MetricsMiddleware see the route matched for the GET request.
+        if "route" in get_scope:
+            scope["route"] = get_scope["route"]
 
 
 class ShutdownGuardMiddleware:
@@ -224,6 +207,49 @@ class AttachRequestStateMiddleware:
         await self.app(scope, receive, send)
 
 
+def _route_label(scope: Scope) -> str:
+    route = scope.get("route")
+    if route is not None:
+        return getattr(route, "path", "unmatched")
+    # Mounts (/static) do not set the route, only the endpoint and root_path.
+    if scope.get("endpoint") is not None and scope.get("root_path"):
+        return scope["root_path"]
+    # Keep the number of label values bounded: the path of an unmatched
+    # request is chosen by the client.
+    return "unmatched"
+
+
+class MetricsMiddleware:
+    """Record the latency and the status of the requests per route."""
+
+    def __init__(self, app: ASGIApp) -> None:
+        """Store the downstream ASGI app."""
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        """Time the downstream app until the response is complete."""
+        if scope.get("type") != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started_at = time.monotonic()
+        status = 500
+
+        async def send_with_status(message: Message) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            method = scope["method"]
+            route = _route_label(scope)
+            HTTP_REQUEST_DURATION.observe(time.monotonic() - started_at, method, route)
+            HTTP_REQUESTS.inc(method, route, str(status))
+
+
 class RedirectBlockedUiUsersMiddleware:
     """If an authenticated UI user becomes blocked, invalidate and redirect."""
 
@@ -20,6 +20,47 @@ from pathlib import Path
 THREADPOOL_TOKENS: int = 200
 TASK_SEMAPHORE_SIZE: int = 5
 
+# Run cache write-behind constants.
+#
+# RUN_CACHE_FLUSH_BATCH_SIZE: Max dirty runs written per (1 s) flush tick.
+# RUN_CACHE_MAX_STALENESS_S: Max time a Prio.NORMAL run stays dirty; higher
+# priorities get max_staleness / (1 + priority). Overdue runs are always
+# written, even beyond the batch size.
+
+RUN_CACHE_FLUSH_BATCH_SIZE: int = 20
+RUN_CACHE_MAX_STALENESS_S: float = 60.0
+
+# Stats journal (capped collection, see stats_journal.py).
+#
+# It must still hold the last record of every task whose stats are not yet
+# flushed, i.e. records up to RUN_CACHE_MAX_STALENESS_S old, with a margin
+# for a slow or stalled flush: STATS_JOURNAL_WINDOW_S.
+# STATS_JOURNAL_PEAK_UPDATE_RATE: update_task calls per second. A worker
+# sends one per batch (about 4 games per core, so every 20-40 s at STC);
+# 10,000 workers give about 500/s.
+# STATS_JOURNAL_RECORD_SIZE_BYTES: upper bound of the BSON size of a record.
+# Resizing needs MongoDB >= 6.0 for an existing journal.
+
+STATS_JOURNAL_WINDOW_S: float = 10 * RUN_CACHE_MAX_STALENESS_S
+STATS_JOURNAL_PEAK_UPDATE_RATE: int = 1000
+STATS_JOURNAL_RECORD_SIZE_BYTES: int = 256
+STATS_JOURNAL_SIZE_BYTES: int = int(
+    STATS_JOURNAL_WINDOW_S
+    * STATS_JOURNAL_PEAK_UPDATE_RATE
+    * STATS_JOURNAL_RECORD_SIZE_BYTES
+)
+
+# Snapshot of the unfinished runs (/api/active_runs and the homepage).
+#
+# ACTIVE_RUNS_SNAPSHOT_PERIOD_S: Interval at which the primary instance
+# rebuilds the snapshot and publishes it in the kvstore. State changes of a
+# run rebuild it earlier on the primary instance.
+# ACTIVE_RUNS_SNAPSHOT_MAX_AGE_S: Older published snapshots are ignored by
+# the secondary instances, which then fall back to querying the runs.
+
+ACTIVE_RUNS_SNAPSHOT_PERIOD_S: float = 5.0
+ACTIVE_RUNS_SNAPSHOT_MAX_AGE_S: float = 60.0
+
 # htmx polling intervals (seconds), used via Jinja2 global `poll`.
 POLL_MACHINES_HOMEPAGE_S: int = 60
 POLL_TESTS_RUN_TABLES_S: int = 20
@@ -64,6 +105,27 @@ UI_FORM_MAX_FILES: int = 2
 UI_FORM_MAX_FIELDS: int = 200
 UI_FORM_MAX_PART_SIZE_BYTES: int = 200 * 1024 * 1024
 
+# Streaming PGN uploads (/api/upload_pgn_stream). The compressed PGN is
+# stored in a single MongoDB document, which is limited to 16 MB.
+PGN_UPLOAD_MAX_SIZE_BYTES: int = 15 * 1024 * 1024
+# The json request which precedes the PGN in the body of the upload.
+PGN_UPLOAD_REQUEST_MAX_SIZE_BYTES: int = 64 * 1024
+
+# Maximal decompressed size of a gzip compressed (Content-Encoding: gzip)
+# json request body of the worker api.
+API_GZIP_BODY_MAX_SIZE_BYTES: int = 4 * 1024 * 1024
+
+# Number of pgns fetched per cursor batch by /api/run_pgns. Together with
+# the chunking of the response this bounds the memory used by a download.
+RUN_PGNS_CURSOR_BATCH_SIZE: int = 16
+
+# Maximal number of run ids in a single /api/get_elo_batch request.
+ELO_BATCH_MAX_RUNS: int = 500
+
+# Number of SPSA tunes whose params are kept as numpy arrays by the
+# SPSA handler (the least recently used ones are rebuilt on demand).
+SPSA_STATE_CACHE_SIZE: int = 64
+
 
 def env_int(name: str, *, default: int) -> int:
     """Parse an environment variable as an integer, with a fallback default."""
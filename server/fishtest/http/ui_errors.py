@@ -8,14 +8,13 @@ from __future__ import annotations
 
 from typing import TYPE_CHECKING
 
-from starlette.concurrency import run_in_threadpool
-
 from fishtest.http.boundary import (
     SessionCommitFlags,
     build_template_context,
     commit_session_flags,
 )
 from fishtest.http.cookie_session import load_session
+from fishtest.http.metrics import run_in_threadpool
 from fishtest.http.template_renderer import render_template_to_response
 
 if TYPE_CHECKING:
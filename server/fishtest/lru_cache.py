@@ -1,27 +1,56 @@
 import functools
+import math
 import threading
 import time
-from collections import OrderedDict
+from collections import OrderedDict, namedtuple
 from collections.abc import MutableMapping
 
 
 class LRUCache(MutableMapping):
+    """A thread safe LRU cache whose entries may expire.
+
+    An entry expires when it has not been refreshed (written or, if refresh
+    is True, read) for more than its time to live: the ttl given to set(),
+    which must be one of the ttls given to the constructor, or else the
+    expiration of the cache.
+
+    The entries with the same ttl expire in the order in which they were
+    last refreshed, so they are kept in an ordered dict in that order (a
+    bucket) and only the heads of the buckets can be expired. Moreover the
+    earliest time at which an entry may expire is cached, so that purging
+    the cache is O(1) unless some entries have actually expired. Each entry
+    is removed at most once, so the cost of purging is amortized O(1) per
+    operation. Purging scans one bucket per ttl, which is why the ttls
+    are fixed when the cache is created.
+    """
+
     __slots__ = (
         "__size",
         "__expiration",
         "__refresh",
         "__data",
+        "__ttls",
+        "__buckets",
+        "__next_expiry",
         "__lock",
         "__lock_depth",
     )
 
-    def __init__(self, maxsize=None, expiration=None, refresh=True):
+    def __init__(self, maxsize=None, expiration=None, refresh=True, ttls=()):
         if maxsize is not None and maxsize < 0:
             raise ValueError("maxsize must be >= 0 or None (default)")
         self.__size = maxsize
         self.__expiration = expiration
         self.__refresh = refresh
+        # key -> [value, atime, ttl], in LRU order.
         self.__data = OrderedDict()
+        # The ttls accepted by set(), besides None.
+        self.__ttls = frozenset(ttls)
+        # ttl -> ordered dict of the keys with that ttl, in atime order.
+        # The ttl None stands for the expiration of the cache.
+        self.__buckets = self.__new_buckets()
+        # No entry expires before this time.
+        self.__next_expiry = math.inf
 
         # The internal state of the object is protected by this lock.
         # The lock can be acquired externally by using self (or equivalently
@@ -63,45 +92,57 @@ class LRUCache(MutableMapping):
 
     def __getitem__(self, key):
         with self.__lock:
-            current_time = time.monotonic()
-            v, atime = self.__data[key]
-            if self.__expiration is not None and self.__lock_depth == 0:
-                if atime < current_time - self.__expiration:
-                    del self.__data[key]
-                    raise KeyError(key)
-            if self.__refresh:
-                self.__data.move_to_end(key)
-                self.__data[key] = (v, current_time)
-            return v
+            return self.__get(key, self.__refresh)
 
     def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def set(self, key, value, ttl=None):
+        """Store value under key. The entry expires ttl seconds after its
+        last refresh, instead of after the expiration of the cache."""
+        if ttl is not None and ttl not in self.__ttls:
+            raise ValueError(f"ttl must be None or one of {sorted(self.__ttls)}")
         with self.__lock:
-            self.__data[key] = (value, time.monotonic())
-            self.__data.move_to_end(key)
+            current_time = time.monotonic()
+            entry = self.__data.get(key)
+            if entry is not None and entry[2] != ttl:
+                self.__unlink(key, entry)
+                entry = None
+            if entry is None:
+                self.__data[key] = [value, current_time, ttl]
+                self.__buckets[ttl][key] = None
+            else:
+                entry[0] = value
+                entry[1] = current_time
+                self.__data.move_to_end(key)
+                self.__buckets[ttl].move_to_end(key)
+            ttl = self.__ttl(ttl)
+            if ttl is not None:
+                self.__next_expiry = min(self.__next_expiry, current_time + ttl)
             self.__purge()
 
     def __delitem__(self, key):
         with self.__lock:
-            del self.__data[key]
+            self.__unlink(key, self.__data[key])
 
     def __len__(self):
         with self.__lock:
             self.__purge()
             return len(self.__data)
 
-    def get(self, *args, refresh=True, **kw):
+    def get(self, key, default=None, *, refresh=True):
         with self.__lock:
-            saved_refresh = self.__refresh
-            self.__refresh = refresh
             try:
-                return super().get(*args, **kw)
-            finally:
-                self.__refresh = saved_refresh
+                return self.__get(key, refresh)
+            except KeyError:
+                return default
 
     # the default implementation is very inefficient
     def clear(self):
         with self.__lock:
             self.__data.clear()
+            self.__buckets = self.__new_buckets()
+            self.__next_expiry = math.inf
 
     # the default implementation of __contains__ calls
     # self.__getitem__ and hence it modifies the access time,
@@ -109,14 +150,12 @@ class LRUCache(MutableMapping):
     # check
     def __contains__(self, key):
         with self.__lock:
-            if key not in self.__data:
+            entry = self.__data.get(key)
+            if entry is None:
+                return False
+            if self.__expired(entry, time.monotonic()):
+                self.__unlink(key, entry)
                 return False
-            if self.__expiration is not None and self.__lock_depth == 0:
-                current_time = time.monotonic()
-                v, atime = self.__data[key]
-                if atime < current_time - self.__expiration:
-                    del self.__data[key]
-                    return False
             return True
 
     def __iter__(self):
@@ -142,22 +181,70 @@ class LRUCache(MutableMapping):
         with self.__lock:
             self.__purge()
 
+    def __get(self, key, refresh):
+        # Helper method. Not synchronized!
+        entry = self.__data[key]
+        current_time = time.monotonic()
+        if self.__expired(entry, current_time):
+            self.__unlink(key, entry)
+            raise KeyError(key)
+        if refresh:
+            entry[1] = current_time
+            self.__data.move_to_end(key)
+            self.__buckets[entry[2]].move_to_end(key)
+        return entry[0]
+
+    def __ttl(self, ttl):
+        # Helper method. Not synchronized!
+        return self.__expiration if ttl is None else ttl
+
+    def __expired(self, entry, current_time):
+        # Helper method. Not synchronized!
+        if self.__lock_depth != 0:
+            return False
+        ttl = self.__ttl(entry[2])
+        return ttl is not None and entry[1] < current_time - ttl
+
+    def __unlink(self, key, entry):
+        # Helper method. Not synchronized!
+        del self.__data[key]
+        del self.__buckets[entry[2]][key]
+
     def __purge(self):
         # Helper method. Not synchronized!
-        if self.__lock_depth == 0:
-            if self.__size is not None:
-                while len(self.__data) > self.__size:
-                    self.__data.popitem(last=False)
-            if self.__expiration is not None:
-                expired = []
-                cutoff_time = time.monotonic() - self.__expiration
-                for k, v in self.__data.items():
-                    atime = v[1]
-                    if atime >= cutoff_time:
-                        break
-                    expired.append(k)
-                for k in expired:
-                    del self.__data[k]
+        if self.__lock_depth != 0:
+            return
+        if self.__size is not None:
+            while len(self.__data) > self.__size:
+                key = next(iter(self.__data))
+                self.__unlink(key, self.__data[key])
+        current_time = time.monotonic()
+        if current_time <= self.__next_expiry:
+            return
+        next_expiry = math.inf
+        for ttl, bucket in self.__buckets.items():
+            ttl = self.__ttl(ttl)
+            if ttl is None:
+                continue
+            cutoff_time = current_time - ttl
+            while bucket:
+                key = next(iter(bucket))
+                atime = self.__data[key][1]
+                if atime >= cutoff_time:
+                    next_expiry = min(next_expiry, atime + ttl)
+                    break
+                self.__unlink(key, self.__data[key])
+        self.__next_expiry = next_expiry
+
+    def __new_buckets(self):
+        # Helper method. Not synchronized!
+        return {ttl: OrderedDict() for ttl in (None, *self.__ttls)}
+
+    def __reset_expiry(self):
+        # Helper method. Not synchronized!
+        # Called when the expiration changes.
+        self.__next_expiry = -math.inf
+        self.__purge()
 
     @property
     def maxsize(self):
@@ -181,7 +268,7 @@ class LRUCache(MutableMapping):
     def expiration(self, val):
         with self.__lock:
             self.__expiration = val
-            self.__purge()
+            self.__reset_expiry()
 
     @property
     def refresh(self):
@@ -208,12 +295,39 @@ class LRUCache(MutableMapping):
         return self
 
 
+CacheInfo = namedtuple(
+    "CacheInfo", ["hits", "misses", "waits", "stale", "maxsize", "currsize"]
+)
+
+
+class _Flight:
+    # A computation in progress in single flight mode.
+    __slots__ = ("owner", "done", "value", "error")
+
+    def __init__(self):
+        self.owner = threading.get_ident()
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
 # This mimics to some extent the decorator "functools.lru_cache". It has however
 # the extra options "expiration" and "refresh". Furthermore it is possible
 # to use a previously defined LRUCache object as cache. The "key" parameter
 # allows customizing how cache keys are constructed from (f, args, kw), and the
 # "filter" parameter controls, based on (f, args, kw, val), whether a computed
 # result should be stored in the cache.
+#
+# With "single_flight=True" concurrent calls which miss the cache for the same
+# key do not all call f: the first one computes the value and the others wait
+# for its result (or its exception). With "stale_while_revalidate=s" (which
+# implies single_flight) a value which has been expired for less than s seconds
+# is still returned to the other callers while a single caller recomputes it.
+# The expiration is then counted from the time the value was computed, so
+# refresh must be False, and the cache stores (value, computation time) pairs.
+#
+# The hits, misses, waits (callers which waited for another computation) and
+# stale values served are counted, see wrapper.cache_info().
 class lru_cache:
     def __init__(
         self,
@@ -223,7 +337,17 @@ class lru_cache:
         cache=None,
         key=lambda f, args, kw: (f, frozenset(kw.items())) + args,
         filter=lambda f, args, kw, val: True,
+        single_flight=False,
+        stale_while_revalidate=None,
     ):
+        if stale_while_revalidate is not None:
+            if cache is not None or expiration is None or refresh:
+                raise ValueError(
+                    "stale_while_revalidate requires an expiration, "
+                    "refresh=False and no pre-constructed LRUCache object",
+                )
+            if stale_while_revalidate < 0:
+                raise ValueError("stale_while_revalidate must be >= 0")
         if cache is not None:
             if any((x is not None for x in (maxsize, expiration, refresh))):
                 raise ValueError(
@@ -231,38 +355,132 @@ class lru_cache:
                     "refresh for a pre-constructed LRUCache object",
                 )
             self.__cache = cache
+        elif stale_while_revalidate is not None:
+            # Expired values are kept for stale_while_revalidate seconds
+            # more. Whether they are fresh is decided by the wrapper.
+            self.__cache = LRUCache(
+                maxsize=maxsize,
+                expiration=expiration + stale_while_revalidate,
+                refresh=False,
+            )
         else:
             if refresh is None:
                 refresh = True
             self.__cache = LRUCache(
                 maxsize=maxsize, expiration=expiration, refresh=refresh
             )
+        self.__expiration = expiration
+        self.__stale = stale_while_revalidate
+        self.__single_flight = single_flight or stale_while_revalidate is not None
         self.__key = key
         self.__filter = filter
 
     def __call__(self, f):
-        @functools.wraps(f)
-        def wrapper(*args, **kw):
-            key = self.__key(f, args, kw)
+        cache = self.__cache
+        expiration = self.__expiration
+        stale = self.__stale is not None
+        flights = {}
+        # Protects flights and counts.
+        lock = threading.Lock()
+        counts = {"hits": 0, "misses": 0, "waits": 0, "stale": 0}
+
+        def count(name):
+            with lock:
+                counts[name] += 1
+
+        def lookup(key):
+            # Return (found, fresh, value).
             try:
-                return self.__cache[key]
+                value = cache[key]
             except KeyError:
-                pass
+                return False, False, None
+            if not stale:
+                return True, True, value
+            value, ctime = value
+            return True, ctime >= time.monotonic() - expiration, value
+
+        def store(key, args, kw, value):
+            if self.__filter(f, args, kw, value):
+                cache[key] = (value, time.monotonic()) if stale else value
+
+        def compute(key, args, kw):
             ret = f(*args, **kw)
-            with self.__cache.lock:
+            with cache.lock:
                 try:
-                    return self.__cache[key]
+                    return cache[key]
                 except KeyError:
                     pass
-                if self.__filter(f, args, kw, ret):
-                    self.__cache[key] = ret
+                store(key, args, kw, ret)
                 return ret
 
-        wrapper.lock = self.__cache.lock
-        wrapper.cache = self.__cache
+        def compute_single_flight(key, args, kw, found, value):
+            # The cache is never accessed with lock held, so that lock
+            # comes last in the lock order.
+            with lock:
+                flight = flights.get(key)
+                leader = flight is None
+                if leader:
+                    flight = flights[key] = _Flight()
+            if not leader:
+                if found:
+                    count("stale")
+                    return value
+                if flight.owner == threading.get_ident():
+                    raise RuntimeError(f"Recursive call of {f.__qualname__}")
+                count("waits")
+                flight.done.wait()
+                if flight.error is not None:
+                    raise flight.error
+                return flight.value
+            try:
+                # Another leader may have stored the value just before
+                # we got the flight.
+                _, fresh, flight.value = lookup(key)
+                if fresh:
+                    count("hits")
+                else:
+                    count("misses")
+                    flight.value = f(*args, **kw)
+                    store(key, args, kw, flight.value)
+                return flight.value
+            except BaseException as e:
+                flight.error = e
+                raise
+            finally:
+                with lock:
+                    del flights[key]
+                flight.done.set()
+
+        @functools.wraps(f)
+        def wrapper(*args, **kw):
+            key = self.__key(f, args, kw)
+            found, fresh, value = lookup(key)
+            if fresh:
+                count("hits")
+                return value
+            if self.__single_flight:
+                return compute_single_flight(key, args, kw, found, value)
+            count("misses")
+            return compute(key, args, kw)
+
+        def cache_info():
+            maxsize, currsize = cache.maxsize, len(cache)
+            with lock:
+                return CacheInfo(maxsize=maxsize, currsize=currsize, **counts)
+
+        def cache_clear():
+            cache.clear()
+            with lock:
+                for name in counts:
+                    counts[name] = 0
+
+        wrapper.lock = cache.lock
+        wrapper.cache = cache
         wrapper.key = self.__key
         wrapper.filter = self.__filter
+        wrapper.single_flight = self.__single_flight
 
         # for compatibility with the built-in functools.lru_cache
-        wrapper.cache_clear = self.__cache.clear
+        wrapper.cache_info = cache_info
+        wrapper.cache_clear = cache_clear
         return wrapper
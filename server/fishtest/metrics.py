@@ -0,0 +1,191 @@
+import bisect
+import math
+import threading
+
+from pymongo import monitoring
+
+# Seconds.
+DEFAULT_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+)
+
+_registry = []
+_registry_lock = threading.Lock()
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer() and abs(value) < 2**53:
+        return str(int(value))
+    return repr(value)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs.extend(f'{name}="{_escape(value)}"' for name, value in extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    """A metric family in the Prometheus text exposition format.
+
+    The label values are passed positionally, in the order of the label
+    names given to the constructor. Metrics are registered for render()
+    unless register=False (e.g. for values computed at scrape time).
+    """
+
+    type = "untyped"
+
+    def __init__(self, name, help, labels=(), register=True):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        if register:
+            with _registry_lock:
+                _registry.append(self)
+
+    def _check(self, label_values):
+        if len(label_values) != len(self.labels):
+            raise ValueError(
+                f"{self.name}: expected the labels {self.labels}, got {label_values}"
+            )
+
+    def _samples(self):
+        with self._lock:
+            return [
+                (self.name, self.labels, label_values, value)
+                for label_values, value in sorted(self._values.items())
+            ]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        for name, labels, label_values, value in self._samples():
+            lines.append(
+                f"{name}{_format_labels(labels, label_values)} {_format_value(value)}"
+            )
+        return lines
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, *label_values, amount=1):
+        self._check(label_values)
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value, *label_values):
+        self._check(label_values)
+        with self._lock:
+            self._values[label_values] = value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS, register=True):
+        super().__init__(name, help, labels=labels, register=register)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *label_values):
+        self._check(label_values)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(label_values)
+            if state is None:
+                # [counts per bucket (the last one is +Inf), sum]
+                state = self._values[label_values] = [
+                    [0] * (len(self.buckets) + 1),
+                    0.0,
+                ]
+            state[0][index] += 1
+            state[1] += value
+
+    def _samples(self):
+        with self._lock:
+            values = [
+                (label_values, list(counts), total)
+                for label_values, (counts, total) in sorted(self._values.items())
+            ]
+        samples = []
+        for label_values, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                samples.append(
+                    (
+                        f"{self.name}_bucket",
+                        self.labels + ("le",),
+                        label_values + (_format_value(float(bound)),),
+                        cumulative,
+                    )
+                )
+            samples.append((f"{self.name}_sum", self.labels, label_values, total))
+            samples.append(
+                (f"{self.name}_count", self.labels, label_values, cumulative)
+            )
+        return samples
+
+
+def render(extra=()):
+    """Return the registered metrics, followed by the metrics in extra,
+    in the text exposition format."""
+    with _registry_lock:
+        metrics = list(_registry)
+    lines = []
+    for metric in metrics + list(extra):
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+MONGO_COMMAND_DURATION = Histogram(
+    "fishtest_mongo_command_duration_seconds",
+    "Duration of the MongoDB commands.",
+    labels=("command", "outcome"),
+)
+
+REQUEST_TASK_REJECTIONS = Counter(
+    "fishtest_request_task_rejections_total",
+    "Calls of /api/request_task rejected because the task semaphore was full.",
+)
+
+
+class MongoCommandTimer(monitoring.CommandListener):
+    """Records the duration of the MongoDB commands of a client."""
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        MONGO_COMMAND_DURATION.observe(
+            event.duration_micros / 1e6, event.command_name, "success"
+        )
+
+    def failed(self, event):
+        MONGO_COMMAND_DURATION.observe(
+            event.duration_micros / 1e6, event.command_name, "failure"
+        )
@@ -0,0 +1,85 @@
+import json
+import tarfile
+
+BLOCK_SIZE = tarfile.BLOCKSIZE
+INDEX_NAME = "index.json"
+
+
+def tar_header(name, size, mtime):
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mtime = mtime
+    info.mode = 0o644
+    return info.tobuf(format=tarfile.USTAR_FORMAT)
+
+
+def tar_padding(size):
+    return b"\0" * (-size % BLOCK_SIZE)
+
+
+class PgnTar:
+    """Tar archive of the pgns of a run.
+
+    The stored gzip compressed pgns become the members <run_id>-<task_id>.pgn.gz
+    of the archive, without recompression. The last member index.json gives
+    for each of them the task_id, the offset of the data in the archive,
+    the size and the number of games of the task, so that the pgns can be
+    extracted (and decompressed) independently.
+
+    The layout, and hence the size of the archive, is computed from the
+    list of (_id, run_id, task_id, size) of the pgns before any data is read.
+    """
+
+    def __init__(self, run_id, pgns, games, mtime):
+        self.mtime = mtime
+        self.__ids = []
+        self.__headers = []
+        tasks = []
+        offset = 0
+        for pgn in pgns:
+            name = f"{pgn['run_id']}.pgn.gz"
+            self.__ids.append(pgn["_id"])
+            self.__headers.append(tar_header(name, pgn["size"], mtime))
+            offset += BLOCK_SIZE
+            tasks.append(
+                {
+                    "task_id": pgn["task_id"],
+                    "name": name,
+                    "offset": offset,
+                    "size": pgn["size"],
+                    "games": games.get(pgn["task_id"]),
+                }
+            )
+            offset += pgn["size"] + len(tar_padding(pgn["size"]))
+        self.index = json.dumps({"run_id": run_id, "tasks": tasks}, indent=1).encode()
+        index_size = len(self.index)
+        self.size = (
+            offset
+            + BLOCK_SIZE
+            + index_size
+            + len(tar_padding(index_size))
+            + 2 * BLOCK_SIZE
+        )
+
+    def iter_blobs(self, pgns):
+        """Yield the archive as a sequence of bytes objects. The argument is
+        an iterator over the pgns (with keys _id and pgn_zip) in the order of
+        the layout. Pgns which are not in the layout (uploaded later) are
+        skipped."""
+        expected = 0
+        for pgn in pgns:
+            if expected == len(self.__ids):
+                break
+            if pgn["_id"] != self.__ids[expected]:
+                continue
+            yield self.__headers[expected]
+            yield pgn["pgn_zip"]
+            yield tar_padding(len(pgn["pgn_zip"]))
+            expected += 1
+        if expected != len(self.__ids):
+            # The response has already started, so we can only abort it.
+            raise RuntimeError("The pgns were deleted during the download")
+        yield tar_header(INDEX_NAME, len(self.index), self.mtime)
+        yield self.index
+        yield tar_padding(len(self.index))
+        yield b"\0" * (2 * BLOCK_SIZE)
@@ -2,13 +2,13 @@ import threading
 import time
 from enum import IntEnum
 
+import bson
 from bson.errors import InvalidId
 from bson.objectid import ObjectId
-from vtjson import validate
+from bson.raw_bson import RawBSONDocument
+from pymongo import ReplaceOne, UpdateOne
 
-from fishtest.lru_cache import lru_cache
-from fishtest.schemas import cache_schema
-from fishtest.schemas import run_id as run_id_schema
+from fishtest.validators import validate_run_cache
 
 
 class Prio(IntEnum):
@@ -18,24 +18,83 @@ class Prio(IntEnum):
     SAVE_NOW = 1000
 
 
+def get_path(run, path):
+    """Return the value at a dotted MongoDB path such as "tasks.3.stats".
+    Raises KeyError or IndexError if the path does not exist."""
+    value = run
+    for component in path.split("."):
+        if isinstance(value, list):
+            value = value[int(component)]
+        else:
+            value = value[component]
+    return value
+
+
+def collapse_paths(paths):
+    """Drop the paths that are contained in another path of the set.
+    MongoDB refuses update documents with overlapping paths such as
+    "tasks.3" and "tasks.3.stats"."""
+    collapsed = set()
+    for path in sorted(paths, key=lambda p: p.count(".")):
+        components = path.split(".")
+        if not any(
+            ".".join(components[:i]) in collapsed for i in range(1, len(components))
+        ):
+            collapsed.add(path)
+    return collapsed
+
+
+def update_document(run, dirty_paths):
+    """Build an update document for the dirty paths of a run. Paths which
+    no longer exist in the run are unset."""
+    set_fields = {}
+    unset_fields = {}
+    for path in collapse_paths(dirty_paths):
+        try:
+            set_fields[path] = get_path(run, path)
+        except KeyError, IndexError:
+            unset_fields[path] = ""
+    update = {}
+    if set_fields:
+        update["$set"] = set_fields
+    if unset_fields:
+        update["$unset"] = unset_fields
+    return update
+
+
 class RunCache:
-    def __init__(self, runs):
+    def __init__(self, runs, flush_batch_size=20, max_staleness=60.0, lock_shards=1024):
         # For documentation of the cache format see "cache_schema" in schemas.py.
         self.runs = runs
+        # The runs are mapped onto a fixed set of locks, so handing out a
+        # lock needs neither bookkeeping nor a global lock. Since several
+        # runs share a lock, code holding an active_run_lock should never
+        # acquire the lock of another run.
+        self.__run_locks = tuple(threading.RLock() for _ in range(lock_shards))
         self.run_cache_lock = threading.Lock()
         self.run_cache = {}
+        # flush_buffers() writes at most flush_batch_size dirty runs per call,
+        # except for runs that have been dirty for longer than their deadline.
+        # The deadline is max_staleness seconds for Prio.NORMAL and
+        # max_staleness/(1 + priority) seconds for higher priorities.
+        self.flush_batch_size = flush_batch_size
+        self.max_staleness = max_staleness
+        self.__flush_stats = {
+            "flushes": 0,  # Number of bulk writes.
+            "runs_flushed": 0,
+            "last_flush_latency": 0.0,  # Seconds.
+            "max_flush_latency": 0.0,
+            "total_flush_latency": 0.0,
+            "queue_depth": 0,  # Dirty runs left after the last flush_buffers().
+            "max_queue_depth": 0,
+            "oldest_dirty_age": 0.0,  # Seconds, at the last flush_buffers().
+        }
 
     def active_run_lock(self, run_id):
-        run_id = str(run_id)
-        return self.__active_run_lock(run_id)
+        # run_id may be a str or an ObjectId, possibly coming from a client.
+        return self.__run_locks[hash(str(run_id)) % len(self.__run_locks)]
 
-    @lru_cache(expiration=10000)
-    def __active_run_lock(self, run_id):
-        # assertion!
-        validate(run_id_schema, run_id)
-        return threading.RLock()
-
-    def buffer(self, run, *, priority=Prio.NORMAL, create=False):
+    def buffer(self, run, *, priority=Prio.NORMAL, create=False, paths=None):
         """
         Guidelines for priority
         =======================
@@ -44,6 +103,15 @@ class RunCache:
         Prio.SAVE_NOW: new run (combined with create=True),
                        finished run, modify/approve/purge run
         Prio.NORMAL: all other uses
+
+        Partial updates
+        ===============
+        paths: the dotted MongoDB paths (e.g. "results", "tasks.3.stats")
+               that have changed since the last call. The paths are
+               accumulated until the run is flushed and then written
+               with $set/$unset. If paths is None (the default) then the
+               whole run is written with replace_one. This is ignored
+               with Prio.SAVE_NOW which always writes the whole run.
         """
         if create and priority != Prio.SAVE_NOW:
             print(
@@ -62,19 +130,31 @@ class RunCache:
                     "last_access_time": time.time(),
                     "last_sync_time": time.time(),
                     "priority": 0,
+                    "dirty_paths": set(),
                     "run": run,
                 }
             else:
                 if run_id in self.run_cache:
-                    last_sync_time = self.run_cache[run_id]["last_sync_time"]
-                    priority = max(priority, self.run_cache[run_id]["priority"])
+                    entry = self.run_cache[run_id]
+                    last_sync_time = entry["last_sync_time"]
+                    priority = max(priority, entry["priority"])
+                    dirty_paths = entry["dirty_paths"]
+                    # Paths are relative to the cached run object.
+                    if entry["run"] is not run:
+                        dirty_paths = None
                 else:
                     last_sync_time = time.time()
+                    dirty_paths = None
+                if paths is None:
+                    dirty_paths = None
+                elif dirty_paths is not None:
+                    dirty_paths = dirty_paths | set(paths)
                 self.run_cache[run_id] = {
                     "is_changed": True,
                     "last_access_time": time.time(),
                     "last_sync_time": last_sync_time,
                     "priority": priority,
+                    "dirty_paths": dirty_paths,
                     "run": run,
                 }
         if flush:
@@ -100,46 +180,141 @@ class RunCache:
                     "last_access_time": time.time(),
                     "last_sync_time": time.time(),
                     "priority": 0,
+                    "dirty_paths": set(),
                     "run": run,
                     "is_changed": False,
                 }
                 return run
         return None
 
+    def __flush_key(self, cache_entry):
+        # Make sure that every run will be saved to disk eventually,
+        # even if there are always cache entries with priority 1.
+        return -60 * cache_entry["priority"] + cache_entry["last_sync_time"]
+
+    def __deadline(self, cache_entry):
+        # Higher priorities have proportionally shorter deadlines.
+        return cache_entry["last_sync_time"] + self.max_staleness / (
+            1 + cache_entry["priority"]
+        )
+
+    def __take(self, entries):
+        # Helper method. Not synchronized!
+        # Marks the entries as clean and returns what is needed to write them.
+        now = time.time()
+        taken = []
+        for run_id, cache_entry in entries:
+            taken.append((run_id, cache_entry["run"], cache_entry["dirty_paths"]))
+            cache_entry["is_changed"] = False
+            cache_entry["last_sync_time"] = now
+            cache_entry["priority"] = 0
+            cache_entry["dirty_paths"] = set()
+        return taken
+
+    def __write_request(self, run, dirty_paths):
+        # Helper method. The caller should hold the active_run_lock.
+        # dirty_paths=None means that the whole run should be written.
+        # The document is encoded right away so that the run can be
+        # modified again as soon as the lock is released.
+        if dirty_paths is None:
+            return ReplaceOne({"_id": run["_id"]}, RawBSONDocument(bson.encode(run)))
+        update = update_document(run, dirty_paths)
+        if not update:
+            return None
+        return UpdateOne({"_id": run["_id"]}, RawBSONDocument(bson.encode(update)))
+
+    def __write(self, taken):
+        requests = []
+        for run_id, run, dirty_paths in taken:
+            with self.active_run_lock(run_id):
+                request = self.__write_request(run, dirty_paths)
+            if request is not None:
+                requests.append(request)
+        if not requests:
+            return
+        t0 = time.monotonic()
+        try:
+            self.runs.bulk_write(requests, ordered=False)
+        except Exception:
+            # We do not know which writes succeeded, so we make sure that
+            # the runs are written in full at the next flush.
+            with self.run_cache_lock:
+                for run_id, run, _ in taken:
+                    cache_entry = self.run_cache.get(run_id)
+                    if cache_entry is not None and cache_entry["run"] is run:
+                        cache_entry["is_changed"] = True
+                        cache_entry["dirty_paths"] = None
+            raise
+        latency = time.monotonic() - t0
+        with self.run_cache_lock:
+            stats = self.__flush_stats
+            stats["flushes"] += 1
+            stats["runs_flushed"] += len(requests)
+            stats["last_flush_latency"] = latency
+            stats["max_flush_latency"] = max(stats["max_flush_latency"], latency)
+            stats["total_flush_latency"] += latency
+
     def flush_buffers(self):
-        oldest_entry = None
-        old = float("inf")
+        now = time.time()
         with self.run_cache_lock:
-            for cache_entry in self.run_cache.values():
-                # Make sure that every run will be saved to disk eventually,
-                # even if there are always cache entries with priority 1.
-                t = -60 * cache_entry["priority"] + cache_entry["last_sync_time"]
-                if cache_entry["is_changed"] and t < old:
-                    old = t
-                    oldest_entry = cache_entry
-            if oldest_entry is not None:
-                oldest_run = oldest_entry["run"]
-                oldest_run_id = oldest_run["_id"]
-                oldest_entry["is_changed"] = False
-                oldest_entry["last_sync_time"] = time.time()
-                oldest_entry["priority"] = 0
-
-        if oldest_entry is not None:
-            with self.active_run_lock(str(oldest_run_id)):
-                self.runs.replace_one({"_id": oldest_run_id}, oldest_run)
+            dirty = sorted(
+                (
+                    (run_id, cache_entry)
+                    for run_id, cache_entry in self.run_cache.items()
+                    if cache_entry["is_changed"]
+                ),
+                key=lambda item: self.__flush_key(item[1]),
+            )
+            # Flush the oldest entries, and in any case all entries
+            # that have reached their deadline.
+            selected = dirty[: self.flush_batch_size] + [
+                item
+                for item in dirty[self.flush_batch_size :]
+                if self.__deadline(item[1]) <= now
+            ]
+            stats = self.__flush_stats
+            stats["queue_depth"] = len(dirty) - len(selected)
+            stats["max_queue_depth"] = max(stats["max_queue_depth"], len(dirty))
+            stats["oldest_dirty_age"] = (
+                now - min(cache_entry["last_sync_time"] for _, cache_entry in dirty)
+                if dirty
+                else 0.0
+            )
+            taken = self.__take(selected)
+
+        self.__write(taken)
 
     def flush_all(self):
-        flush_list = []
         with self.run_cache_lock:
-            for run_id, entry in self.run_cache.items():
-                if entry["is_changed"]:
-                    entry["is_changed"] = False
-                    entry["last_sync_time"] = time.time()
-                    entry["priority"] = 0
-                    flush_list.append((run_id, entry))
-        for run_id, entry in flush_list:
-            with self.active_run_lock(run_id):
-                self.runs.replace_one({"_id": ObjectId(run_id)}, entry["run"])
+            dirty = [
+                (run_id, cache_entry)
+                for run_id, cache_entry in self.run_cache.items()
+                if cache_entry["is_changed"]
+            ]
+            self.__flush_stats["queue_depth"] = 0
+        # Each batch is taken right before it is written, so that the
+        # batches after a failed write are still dirty. They are written
+        # anyway, and the first error is raised at the end.
+        error = None
+        for i in range(0, len(dirty), self.flush_batch_size):
+            with self.run_cache_lock:
+                taken = self.__take(
+                    [
+                        (run_id, cache_entry)
+                        for run_id, cache_entry in dirty[i : i + self.flush_batch_size]
+                        if cache_entry["is_changed"]
+                    ]
+                )
+            try:
+                self.__write(taken)
+            except Exception as e:
+                error = error or e
+        if error is not None:
+            raise error
+
+    def flush_stats(self):
+        with self.run_cache_lock:
+            return dict(self.__flush_stats)
 
     def clean_cache(self):
         now = time.time()
@@ -158,9 +333,4 @@ class RunCache:
 
     def validate(self):
         with self.run_cache_lock:
-            validate(
-                cache_schema,
-                self.run_cache,
-                name="run_cache",
-                subs={"runs_schema": dict},
-            )
+            validate_run_cache(self.run_cache)
@@ -9,11 +9,12 @@ import textwrap
 import threading
 import time
 from datetime import UTC, datetime
+from typing import NamedTuple
 
 import regex
 from bson.codec_options import CodecOptions
 from bson.objectid import ObjectId
-from pymongo import DESCENDING, MongoClient
+from pymongo import ASCENDING, DESCENDING, MongoClient
 from pymongo.errors import OperationFailure
 from vtjson import ValidationError, validate
 
@@ -22,10 +23,27 @@ import fishtest.run_cache
 import fishtest.spsa_handler
 import fishtest.stats.stat_util
 from fishtest.actiondb import ActionDb
-from fishtest.http.settings import TASK_SEMAPHORE_SIZE
+from fishtest.active_runs_snapshot import (
+    ActiveRunsSnapshot,
+    Snapshot,
+    lightweight_run,
+)
+from fishtest.active_tasks import ActiveTasks
+from fishtest.chi2_cache import Chi2Cache
+from fishtest.http.settings import (
+    ACTIVE_RUNS_SNAPSHOT_MAX_AGE_S,
+    ACTIVE_RUNS_SNAPSHOT_PERIOD_S,
+    RUN_CACHE_FLUSH_BATCH_SIZE,
+    RUN_CACHE_MAX_STALENESS_S,
+    RUN_PGNS_CURSOR_BATCH_SIZE,
+    TASK_SEMAPHORE_SIZE,
+)
 from fishtest.kvstore import KeyValueStore
 from fishtest.lru_cache import lru_cache
+from fishtest.metrics import REQUEST_TASK_REJECTIONS, MongoCommandTimer
+from fishtest.pgn_tar import PgnTar
 from fishtest.run_cache import Prio
+from fishtest.schedule_index import ScheduleIndex
 from fishtest.scheduler import Scheduler
 from fishtest.schemas import (
     RUN_VERSION,
@@ -39,28 +57,30 @@ from fishtest.schemas import (
     connections_counter_schema,
     is_undecided,
     nn_schema,
-    pgns_schema,
-    runs_schema,
     unfinished_runs_schema,
     worker_runs_schema,
     wtt_map_schema,
 )
+from fishtest.spsa_history import SpsaHistory
 from fishtest.stats.stat_util import SPRT_elo
+from fishtest.stats_journal import StatsJournal
+from fishtest.task_deadlines import TaskDeadlines
 from fishtest.userdb import UserDb
 from fishtest.util import (
     FISHTEST,
-    GeneratorAsFileReader,
     count_games,
     crash_or_time,
     estimate_game_duration,
     get_bad_workers,
     get_chi2,
-    get_hash,
     get_tc_ratio,
     remaining_hours,
     residual_to_color,
+    run_pgns_query,
+    split_pgn_id,
     worker_name,
 )
+from fishtest.validators import validate_pgns, validate_run
 from fishtest.workerdb import WorkerDb
 
 _UNFINISHED_RUNS_LIGHTWEIGHT_PROJECTION = {
@@ -82,11 +102,39 @@ _UNFINISHED_RUNS_STATS_PROJECTION = {
 }
 
 
+class _ScheduleState(NamedTuple):
+    """The fields of a run used by request_task to pick a run, read once.
+    The run itself is compared by identity."""
+
+    run: dict
+    finished: bool
+    approved: bool
+    cores: int
+    committed_games: int
+    num_games: int
+    priority: float
+    itp: float
+
+    @classmethod
+    def of(cls, run):
+        args = run["args"]
+        return cls(
+            run,
+            run["finished"],
+            run["approved"],
+            run["cores"],
+            run["committed_games"],
+            args["num_games"],
+            args["priority"],
+            args["itp"],
+        )
+
+
 class RunDb:
     def __init__(self, db_name=FISHTEST, port=-1, is_primary_instance=True):
         # MongoDB server is assumed to be on the same machine, if not user should
         # use ssh with port forwarding to access the remote host.
-        self.conn = MongoClient("localhost")
+        self.conn = MongoClient("localhost", event_listeners=[MongoCommandTimer()])
         codec_options = CodecOptions(tz_aware=True, tzinfo=UTC)
         self.db = self.conn[db_name].with_options(codec_options=codec_options)
         self.userdb = UserDb(self.db)
@@ -97,11 +145,31 @@ class RunDb:
         self.runs = self.db["runs"]
         self.deltas = self.db["deltas"]
         self.kvstore = KeyValueStore(self.db)
+        # Only the primary instance writes and replays the journal, so the
+        # secondary instances do not create (or resize) the collection.
+        self.stats_journal = StatsJournal(self.db) if is_primary_instance else None
+        self.spsa_history = SpsaHistory(self.db)
         self.port = port
         self.unfinished_runs = set()
         self.unfinished_runs_lock = threading.Lock()
+        # Pre-filter for request_task, see schedule_index.py.
+        self.schedule_index = ScheduleIndex()
+        # Active tasks ordered by last_updated, see task_deadlines.py.
+        self.task_deadlines = TaskDeadlines()
+        # Active tasks per run with running nps/gpm sums, see active_tasks.py.
+        self.active_tasks = ActiveTasks()
+        # Task stats aggregated by worker and memoized chi2 results,
+        # see chi2_cache.py. Only used on the primary instance.
+        self.chi2_cache = Chi2Cache()
+        # Lightweight unfinished runs, see active_runs_snapshot.py.
+        self.active_runs_snapshot = ActiveRunsSnapshot(
+            self.kvstore, self.__get_lightweight_unfinished_runs
+        )
         self.wtt_map = {}
         self.wtt_lock = threading.RLock()
+        # short worker name -> unique_key of the worker, for the workers
+        # with a request_task in progress. Protected by wtt_lock.
+        self.request_task_workers = {}
 
         self.connections_counter = {}
         self.connections_lock = threading.Lock()
@@ -122,23 +190,39 @@ class RunDb:
 
         self.__is_primary_instance = is_primary_instance
 
-        self.run_cache = fishtest.run_cache.RunCache(self.runs)
+        self.run_cache = fishtest.run_cache.RunCache(
+            self.runs,
+            flush_batch_size=RUN_CACHE_FLUSH_BATCH_SIZE,
+            max_staleness=RUN_CACHE_MAX_STALENESS_S,
+        )
         self.active_run_lock = self.run_cache.active_run_lock
         if is_primary_instance:
-            self.buffer = self.run_cache.buffer
+            self.buffer = self.__buffer
         url = os.getenv("FISHTEST_URL")
         self.base_url = url.rstrip("/") if url else "http://127.0.0.1"
         self._base_url_set = bool(url)
 
         self.worker_runs_lock = threading.Lock()
 
-        self.request_task_lock = threading.Lock()
         self.scheduler = None
         self._shutdown = False
 
         self.spsa_handler = fishtest.spsa_handler.SPSAHandler(self)
 
-    @lru_cache(maxsize=1, expiration=30, refresh=False)
+    def __buffer(self, run, *, priority=Prio.NORMAL, create=False, paths=None):
+        # Prio.SAVE_NOW is used for all the state changes of a run
+        # (creation, approval, modification, finish, purge) that may
+        # affect its eligibility for new tasks.
+        if priority == Prio.SAVE_NOW:
+            self.schedule_index.update(run)
+            self.active_runs_snapshot.invalidate()
+        self.run_cache.buffer(run, priority=priority, create=create, paths=paths)
+
+    # The names of the indexes of the runs collection (not the runs), used
+    # to validate query hints. They only change when an index is created
+    # or dropped. A stale value at worst skips a hint, or uses a dropped
+    # index, which fails and is retried without hint.
+    @lru_cache(maxsize=1, expiration=30, refresh=False, stale_while_revalidate=30)
     def get_runs_index_names(self):
         return set(self.runs.index_information())
 
@@ -147,12 +231,34 @@ class RunDb:
         # pattern is already known to compile
         return regex.compile(pattern)
 
+    def get_chi2(self, run):
+        # Only the primary instance sees the task updates.
+        if self.__is_primary_instance:
+            return self.chi2_cache.get_chi2(run)
+        else:
+            return get_chi2(run["tasks"])
+
     def get_run(self, run_id):
         if self.__is_primary_instance:
             return self.run_cache.get_run(run_id)
         else:
             return self.runs.find_one({"_id": ObjectId(run_id)})
 
+    def get_runs_results(self, run_ids):
+        """Return a dict run_id -> run for the existing runs in run_ids.
+        The runs contain at least the keys "args" and "results". On the
+        secondary instances only these keys are fetched, in a single query.
+        """
+        run_ids = [run_id for run_id in run_ids if ObjectId.is_valid(run_id)]
+        if self.__is_primary_instance:
+            runs = (self.run_cache.get_run(run_id) for run_id in run_ids)
+        else:
+            runs = self.runs.find(
+                {"_id": {"$in": [ObjectId(run_id) for run_id in run_ids]}},
+                {"args.sprt": 1, "results": 1},
+            )
+        return {str(run["_id"]): run for run in runs if run is not None}
+
     def schedule_tasks(self):
         if self.scheduler is None:
             self.scheduler = Scheduler(jitter=0.05)
@@ -167,6 +273,9 @@ class RunDb:
             900.0, self.validate_data_structures, initial_delay=60.0
         )
         self.scheduler.create_task(60.0, self.update_nps_gpm)
+        self.scheduler.create_task(
+            ACTIVE_RUNS_SNAPSHOT_PERIOD_S, self.active_runs_snapshot.publish
+        )
         self.scheduler.create_task(300.0, self.clean_worker_runs, initial_delay=60.0)
         self.scheduler.create_task(
             900.0, self.update_books, initial_delay=60.0, background=True
@@ -213,31 +322,14 @@ class RunDb:
         with self.unfinished_runs_lock:
             unfinished_runs = [self.get_run(run_id) for run_id in self.unfinished_runs]
         for run in unfinished_runs:
-            nps = 0.0
-            games_per_minute = 0.0
-            # excess of caution
             run_id = str(run["_id"])
-            with self.active_run_lock(run_id):
-                tasks = copy.copy(run["tasks"])
-            for task in tasks:
-                if task["active"]:
-                    concurrency = task["worker_info"]["concurrency"]
-                    nps += concurrency * float(task["worker_info"]["nps"])
-                    if task["worker_info"]["nps"] != 0:
-                        games_per_minute += (
-                            (task["worker_info"]["nps"] / 628000)
-                            * (60.0 / estimate_game_duration(run["args"]["tc"]))
-                            * (
-                                int(task["worker_info"]["concurrency"])
-                                // run["args"].get("threads", 1)
-                            )
-                        )
+            nps, games_per_minute = self.active_tasks.totals(run_id)
             with self.active_run_lock(run_id):
                 # the run may finish during the time the lock is released
                 if not run["finished"]:
                     run["nps"] = nps
                     run["games_per_minute"] = games_per_minute
-                    self.buffer(run)
+                    self.buffer(run, paths=("nps", "games_per_minute"))
 
     def validate_data_structures(self):
         # The main purpose of task is to ensure that the schemas
@@ -295,7 +387,7 @@ class RunDb:
 
         for run in unfinished_runs:
             self.calc_itp(run, user_active.count(run["args"].get("username")))
-            self.buffer(run)
+            self.buffer(run, paths=("args.itp",))
 
     def clean_wtt_map(self):
         with self.wtt_lock:
@@ -336,7 +428,7 @@ class RunDb:
         try:
             with self.active_run_lock(run_id):
                 print(f"Validating random run {run_id}...")
-                validate(runs_schema, run, "run")
+                validate_run(run)
         except ValidationError as e:
             message = f"The run object {run_id} does not validate: {str(e)}"
             if "version" in run and run["version"] >= RUN_VERSION:
@@ -357,6 +449,8 @@ class RunDb:
             for task_id in range(len(run["tasks"])):
                 self.set_inactive_task(task_id, run)
             self.unfinished_runs.discard(run_id)
+            self.schedule_index.remove(run_id)
+            self.active_tasks.remove_run(run_id)
             run["finished"] = True
             run["nps"] = 0.0
             run["games_per_minute"] = 0.0
@@ -393,6 +487,8 @@ class RunDb:
                 if "spsa_params" in task:
                     del task["spsa_params"]
                 task["active"] = False
+                self.task_deadlines.discard(run_id, task_id)
+                self.active_tasks.remove(run_id, task_id)
                 with self.connections_lock:
                     try:
                         remote_addr = task["worker_info"]["remote_addr"]
@@ -407,7 +503,11 @@ class RunDb:
                             message=message,
                         )
 
-        self.buffer(run, priority=Prio.MEDIUM)
+        self.buffer(
+            run,
+            priority=Prio.MEDIUM,
+            paths=("workers", "cores", "committed_games", f"tasks.{task_id}"),
+        )
 
     def set_bad_task(self, task_id, run, residual=None, residual_color=None):
         zero_stats = {
@@ -448,6 +548,7 @@ class RunDb:
             # to zero.
             task["bad"] = True
             task["stats"] = copy.deepcopy(zero_stats)
+            self.chi2_cache.update_task(run, task_id)
             self.buffer(run, priority=Prio.MEDIUM)
 
     # Do not run two copies of this function in parallel!
@@ -458,12 +559,33 @@ class RunDb:
             self.connections_counter = {}
         with self.unfinished_runs_lock:
             self.unfinished_runs = set()
+        self.schedule_index.clear()
+        self.task_deadlines.clear()
+        self.active_tasks.clear()
+
+        # Task stats which were received but not yet flushed to the db
+        # before the last shutdown.
+        journal = self.stats_journal.latest()
+        replayed = 0
 
         for r in self.get_unfinished_runs_id():
             run_id = str(r["_id"])
             run = self.get_run(run_id)
             changed = False
             with self.active_run_lock(run_id):
+                for task_id, task in enumerate(run["tasks"]):
+                    record = journal.get((run_id, task_id))
+                    if (
+                        record is None
+                        or task.get("bad", False)
+                        or count_games(record["stats"])
+                        <= count_games(task.get("stats", {}))
+                    ):
+                        continue
+                    task["stats"] = record["stats"]
+                    task["last_updated"] = record["time"]
+                    replayed += 1
+                    changed = True
                 results = compute_results(run)
                 if results != run["results"]:
                     print(
@@ -472,6 +594,10 @@ class RunDb:
                         flush=True,
                     )
                     run["results"] = results
+                    if "sprt" in run["args"]:
+                        fishtest.stats.stat_util.update_SPRT(
+                            run["results"], run["args"]["sprt"]
+                        )
                     changed = True
                 cores = compute_cores(run)
                 if cores != run["cores"]:
@@ -524,9 +650,12 @@ class RunDb:
 
                 with self.unfinished_runs_lock:
                     self.unfinished_runs.add(run_id)
+                self.schedule_index.update(run)
 
                 for task_id, task in enumerate(run["tasks"]):
                     if task["active"]:
+                        self.task_deadlines.touch(run_id, task_id, task["last_updated"])
+                        self.active_tasks.update(run, task_id)
                         with self.connections_lock:
                             remote_addr = task["worker_info"]["remote_addr"]
                             if remote_addr in self.connections_counter:
@@ -550,6 +679,11 @@ class RunDb:
                 for task_id in range(len(run["tasks"])):
                     self.insert_in_wtt_map(run_id, task_id)
 
+        if replayed > 0:
+            print(
+                f"Replayed {replayed} task updates from the stats journal", flush=True
+            )
+
         self.update_itp()
         self.update_nps_gpm()
         self.update_books()
@@ -706,7 +840,7 @@ class RunDb:
             new_run["rescheduled_from"] = rescheduled_from
 
         try:
-            validate(runs_schema, new_run, "run")
+            validate_run(new_run)
         except ValidationError as e:
             message = f"The new run object does not validate: {str(e)}"
             print(message, flush=True)
@@ -717,15 +851,24 @@ class RunDb:
         run_id = str(new_run["_id"])
         with self.unfinished_runs_lock:
             self.unfinished_runs.add(run_id)
+        self.active_runs_snapshot.invalidate()
         return run_id
 
     def is_primary_instance(self):
         return self.__is_primary_instance
 
     def upload_pgn(self, run_id, pgn_zip):
-        record = {"run_id": run_id, "pgn_zip": pgn_zip, "size": len(pgn_zip)}
+        # run_id is the name of the pgn, i.e. <run_id>-<task_id>.
+        run, task_id = split_pgn_id(run_id)
+        record = {
+            "run_id": run_id,
+            "run": run,
+            "task_id": task_id,
+            "pgn_zip": pgn_zip,
+            "size": len(pgn_zip),
+        }
         try:
-            validate(pgns_schema, record)
+            validate_pgns(record)
         except ValidationError as e:
             message = f"Internal Error. Pgn record has the wrong format: {str(e)}"
             print(message, flush=True)
@@ -742,40 +885,71 @@ class RunDb:
         pgn = self.pgndb.find_one({"run_id": run_id})
         return (pgn["pgn_zip"], pgn["size"]) if pgn else (None, 0)
 
+    def __iter_run_pgns(self, pgns_query, documents=False):
+        # Yield the compressed pgns, or the documents {_id, pgn_zip}.
+        pgns = self.pgndb.find(
+            pgns_query,
+            {"pgn_zip": 1} if documents else {"pgn_zip": 1, "_id": 0},
+            sort=[("task_id", ASCENDING), ("_id", ASCENDING)],
+            batch_size=RUN_PGNS_CURSOR_BATCH_SIZE,
+        )
+        try:
+            for pgn in pgns:
+                yield pgn if documents else pgn["pgn_zip"]
+        finally:
+            pgns.close()
+
     def get_run_pgns(self, run_id):
-        # Compute the total size using MongoDB's aggregation framework
-        pgns_query = {"run_id": {"$regex": f"^{run_id}-\\d+"}}
+        """Return (pgns, total_size) where pgns is an iterator over the
+        gzip compressed pgns of the run, sorted by task_id (together they
+        form a valid multi-member gzip file), or None if there are none.
+        The pgns of a run are found (and sorted) through the (run, task_id)
+        index.
+        """
+        pgns_query = run_pgns_query(run_id)
         total_size_agg = self.pgndb.aggregate(
             [
                 {"$match": pgns_query},
-                {"$project": {"size": 1, "_id": 0}},
                 {"$group": {"_id": None, "totalSize": {"$sum": "$size"}}},
             ]
         )
         total_size = total_size_agg.next()["totalSize"] if total_size_agg.alive else 0
-
-        if total_size > 0:
-            # Create a file reader from a generator that yields each pgn.gz file sorted for task_id
-            pipeline = [
-                {"$match": pgns_query},
-                {
-                    "$set": {
-                        "task_id": {
-                            "$toInt": {
-                                "$arrayElemAt": [{"$split": ["$run_id", "-"]}, 1]
-                            }
-                        }
-                    }
-                },
-                {"$sort": {"task_id": 1}},
-                {"$project": {"pgn_zip": 1, "_id": 0}},
-            ]
-            pgns = self.pgndb.aggregate(pipeline)
-            pgns_reader = GeneratorAsFileReader(pgn["pgn_zip"] for pgn in pgns)
-        else:
-            pgns_reader = None
-
-        return pgns_reader, total_size
+        if total_size == 0:
+            return None, 0
+        return self.__iter_run_pgns(pgns_query), total_size
+
+    def get_run_pgns_tar(self, run_id):
+        """Return (pgns, total_size) where pgns is an iterator over the
+        chunks of a tar archive of the gzip compressed pgns of the run,
+        with an index of the offsets and game counts of the tasks (see
+        PgnTar), or None if there are none.
+        """
+        pgns_query = run_pgns_query(run_id)
+        layout = list(
+            self.pgndb.find(
+                pgns_query,
+                {"run_id": 1, "task_id": 1, "size": 1},
+                sort=[("task_id", ASCENDING), ("_id", ASCENDING)],
+            )
+        )
+        if not layout:
+            return None, 0
+        for pgn in layout:
+            if "task_id" not in pgn:
+                # Not migrated yet.
+                pgn["task_id"] = split_pgn_id(pgn["run_id"])[1]
+        games = {}
+        if ObjectId.is_valid(run_id):
+            run = self.runs.find_one({"_id": ObjectId(run_id)}, {"tasks.stats": 1})
+            if run is not None:
+                games = {
+                    task_id: count_games(task["stats"])
+                    for task_id, task in enumerate(run.get("tasks", []))
+                    if "stats" in task
+                }
+        pgn_tar = PgnTar(run_id, layout, games, int(time.time()))
+        pgns = self.__iter_run_pgns(pgns_query, documents=True)
+        return pgn_tar.iter_blobs(pgns), pgn_tar.size
 
     def write_nn(self, net):
         validate(nn_schema, net, "net")
@@ -829,17 +1003,25 @@ class RunDb:
         gh.save()
 
     def scavenge_dead_tasks(self):
-        with self.unfinished_runs_lock:
-            unfinished_runs = [
-                (run_id, self.get_run(run_id)) for run_id in self.unfinished_runs
-            ]
-        now = time.time()
+        cutoff = time.time() - 360
         dead_tasks = []
-        for run_id, run in unfinished_runs:
+        # Only the tasks whose recorded last update is older than the
+        # cutoff are examined. Their state is verified under the run lock
+        # since a refresh of the deadline may have been missed.
+        for run_id, task_id in self.task_deadlines.pop_expired(cutoff):
+            run = self.get_run(run_id)
+            if run is None:
+                continue
             with self.active_run_lock(run_id):
-                for task_id, task in enumerate(run["tasks"]):
-                    if task["active"] and task["last_updated"].timestamp() < now - 360:
-                        dead_tasks.append((task_id, task, run))
+                if task_id >= len(run["tasks"]):
+                    continue
+                task = run["tasks"][task_id]
+                if not task["active"]:
+                    continue
+                if task["last_updated"].timestamp() < cutoff:
+                    dead_tasks.append((task_id, task, run))
+                else:
+                    self.task_deadlines.touch(run_id, task_id, task["last_updated"])
 
         for task_id, task, run in dead_tasks:
             print(
@@ -890,7 +1072,7 @@ class RunDb:
         )
         return unfinished_runs
 
-    @lru_cache(maxsize=1, expiration=5, refresh=False)
+    @lru_cache(maxsize=1, expiration=5, refresh=False, stale_while_revalidate=10)
     def _get_machine_runs_from_db(self):
         return list(self.runs.find({"finished": False}, {"tasks": 1, "args": 1}))
 
@@ -899,27 +1081,31 @@ class RunDb:
             with self.unfinished_runs_lock:
                 run_ids = list(self.unfinished_runs)
 
+            # (run, [(task_id, task)]) with only the active tasks.
             active_runs = []
             for run_id in run_ids:
                 run = self.get_run(run_id)
                 if run is None:
                     continue
                 with self.active_run_lock(run_id):
+                    task_ids = self.active_tasks.task_ids(run_id)
+                    if not task_ids:
+                        continue
                     active_runs.append(
-                        {
-                            "_id": run["_id"],
-                            "args": copy.copy(run["args"]),
-                            "tasks": copy.copy(run["tasks"]),
-                        }
+                        (
+                            {"_id": run["_id"], "args": copy.copy(run["args"])},
+                            [(task_id, run["tasks"][task_id]) for task_id in task_ids],
+                        )
                     )
         else:
-            active_runs = self._get_machine_runs_from_db()
+            active_runs = [
+                (run, list(enumerate(run["tasks"])))
+                for run in self._get_machine_runs_from_db()
+            ]
 
         machines = []
-        for run in active_runs:
-            if not any(task["active"] for task in reversed(run["tasks"])):
-                continue
-            for task_id, task in enumerate(run["tasks"]):
+        for run, tasks in active_runs:
+            for task_id, task in tasks:
                 if task["active"]:
                     machines.append(
                         task["worker_info"]
@@ -935,8 +1121,45 @@ class RunDb:
                     )
         return machines
 
+    def __get_lightweight_unfinished_runs(self):
+        # Primary instance: the unfinished runs from the run cache.
+        with self.unfinished_runs_lock:
+            run_ids = list(self.unfinished_runs)
+        runs = []
+        for run_id in run_ids:
+            run = self.get_run(run_id)
+            if run is None:
+                continue
+            with self.active_run_lock(run_id):
+                if not run["finished"]:
+                    runs.append(lightweight_run(run))
+        runs.sort(key=lambda run: run["_id"])
+        return runs
+
+    @lru_cache(maxsize=1, expiration=1, refresh=False)
+    def _load_active_runs_snapshot(self):
+        snapshot = self.active_runs_snapshot.load(ACTIVE_RUNS_SNAPSHOT_MAX_AGE_S)
+        if snapshot is None:
+            # The primary instance does not publish the snapshot.
+            runs = sorted(self.get_unfinished_runs(), key=lambda run: run["_id"])
+            snapshot = Snapshot(runs)
+        return snapshot
+
+    def get_active_runs_snapshot(self):
+        """The (shared, read only) Snapshot of the unfinished runs."""
+        if self.__is_primary_instance:
+            return self.active_runs_snapshot.get()
+        else:
+            return self._load_active_runs_snapshot()
+
     def aggregate_unfinished_runs(self, username=None):
-        unfinished_runs = self.get_unfinished_runs(username=username)
+        snapshot = self.get_active_runs_snapshot()
+        runs, *totals = snapshot.aggregate(username or "", self._aggregate_runs)
+        # the lists are shared with other readers
+        return {state: list(state_runs) for state, state_runs in runs.items()}, *totals
+
+    @staticmethod
+    def _aggregate_runs(unfinished_runs):
         runs = {"pending": [], "active": []}
         for run in unfinished_runs:
             state = "active" if run["workers"] > 0 else "pending"
@@ -1355,8 +1578,9 @@ class RunDb:
 
     # Caps concurrent /api/request_task threadpool usage to
     # TASK_SEMAPHORE_SIZE (5) out of THREADPOOL_TOKENS (200).
-    # Only 1 thread is active inside request_task_lock; the other 4
-    # absorb arrival jitter.  195 tokens stay free for beat/update_task.
+    # The admitted threads select runs concurrently and only serialize
+    # on the lock of the chosen run. 195 tokens stay free for
+    # beat/update_task.
     # Derivation: docs/2-threading-model.md "Task scheduling throttle".
     task_semaphore = threading.Semaphore(TASK_SEMAPHORE_SIZE)
 
@@ -1395,11 +1619,11 @@ After fixing the issues you can unblock the worker at
     def request_task(self, worker_info):
         if self.task_semaphore.acquire(False):
             try:
-                with self.request_task_lock:
-                    return self.sync_request_task(worker_info)
+                return self.sync_request_task(worker_info)
             finally:
                 self.task_semaphore.release()
         else:
+            REQUEST_TASK_REJECTIONS.inc()
             message = "Request_task: the server is currently too busy..."
             print(message, flush=True)
             return {"task_waiting": False, "info": message}
@@ -1425,6 +1649,16 @@ After fixing the issues you can unblock the worker at
         my_name_long = worker_name(worker_info)
         unique_key = worker_info["unique_key"]
         with self.wtt_lock:
+            # The name is reserved until the task is in the wtt_map, so that
+            # two workers with the same name cannot both get a task.
+            reserved_key = self.request_task_workers.get(my_name)
+            if reserved_key is not None and reserved_key != unique_key:
+                error = (
+                    f'Request_task: There is already a worker running with name "{my_name}" '
+                    f'which is requesting a task (my name is "{my_name_long}")'
+                )
+                print(error, flush=True)
+                return {"task_waiting": False, "error": error}
             if my_name in self.wtt_map:
                 wtt_run_id, wtt_task_id = self.wtt_map[my_name]
                 wtt_run = self.get_run(wtt_run_id)
@@ -1442,7 +1676,17 @@ After fixing the issues you can unblock the worker at
                             )
                             print(error, flush=True)
                             return {"task_waiting": False, "error": error}
+            reserved = reserved_key is None
+            if reserved:
+                self.request_task_workers[my_name] = unique_key
+        try:
+            return self.__assign_task(worker_info, my_name)
+        finally:
+            if reserved:
+                with self.wtt_lock:
+                    del self.request_task_workers[my_name]
 
+    def __assign_task(self, worker_info, my_name):
         # We see if the worker has reached the number of allowed connections from the same ip
         # address.
         with self.connections_lock:
@@ -1466,157 +1710,137 @@ After fixing the issues you can unblock the worker at
         # Now we sort the list of unfinished runs according to priority.
         last_run_id = self.worker_runs.get(my_name, {}).get("last_run", None)
 
-        def priority(run):
+        def priority(state):
             # We re-add the number of cores that were freed by this worker when the previous
             # task on this run finished. If we don't do this then this worker is likely to pick
             # up this run again, especially if it has many cores.
-            adjusted_cores = run["cores"] + (
-                max_threads if str(run["_id"]) == last_run_id else 0
+            adjusted_cores = state.cores + (
+                max_threads if str(state.run["_id"]) == last_run_id else 0
             )
 
             # lower is better
             return (
                 # Always consider the higher priority runs first
-                -run["args"]["priority"],
+                -state.priority,
                 # Make sure all runs at this priority level get _some_ cores
                 adjusted_cores > 0,
                 # Try to match run["args"]["itp"].
                 # The added term max_threads/2 is to mitigate granularity issues with large core workers.
-                (adjusted_cores + max_threads / 2) / run["args"]["itp"],
+                (adjusted_cores + max_threads / 2) / state.itp,
             )
 
-        # Use a local copy of (the sorted) unfinished runs list so that it does
-        # not change under our nose.
-        with self.unfinished_runs_lock:
-            unfinished_runs = [self.get_run(run_id) for run_id in self.unfinished_runs]
-        unfinished_runs = sorted(unfinished_runs, key=priority)
-
-        # Now go through the sorted list of unfinished runs.
-        # We will add a task to the first run that is suitable.
-
-        run_found = False
-
-        for run in unfinished_runs:
-            run_id = str(run["_id"])
-
-            if run["finished"]:
-                continue
-
-            if not run["approved"]:
-                continue
+        def arch_filter_ok(arch_filter):
+            arch_filter_re = self.compile_regex(arch_filter)
+            # We use a timeout to protect against redos attacks.
+            # The timeout of 100ms should never trigger with a legitimate
+            # arch string.
+            # See https://github.com/official-stockfish/fishtest/pull/2428#issuecomment-3715147268
+            try:
+                return arch_filter_re.search(worker_arch, timeout=0.1) is not None
+            except Exception as e:
+                message = f"Matching {worker_arch} against {arch_filter} failed: {e}"
+                self.actiondb.log_message(
+                    username="fishtest.system",
+                    message=message,
+                )
+                print(
+                    message,
+                    flush=True,
+                )
+                return True
+
+        # The schedule index only returns the runs whose threads, memory,
+        # compiler and arch filter requirements are met by the worker.
+        # We sort only those. The selection works on a snapshot of the
+        # scheduling state of every candidate (see _ScheduleState), taken
+        # without locks. Changes made to the runs meanwhile are detected
+        # below.
+        candidates = []
+        for run_id, entry in self.schedule_index.candidates(
+            max_threads,
+            min_threads,
+            max_memory,
+            worker_compiler,
+            arch_filter_ok=arch_filter_ok,
+        ):
+            run = self.get_run(run_id)
+            if run is not None:
+                candidates.append((_ScheduleState.of(run), entry))
+        candidates.sort(key=lambda candidate: priority(candidate[0]))
 
-            if run["args"]["threads"] > max_threads:
-                continue
+        def suitable(state, entry):
+            # The index may lag behind a concurrent state change.
+            if state.finished:
+                return False
 
-            if run["args"]["threads"] < min_threads:
-                continue
+            if not state.approved:
+                return False
 
             # Check if there aren't already enough workers
             # working on this run.
-            committed_games = run["committed_games"]
-
-            remaining = run["args"]["num_games"] - committed_games
+            remaining = state.num_games - state.committed_games
             if remaining <= 0:
-                continue
-
-            # We check if the worker has reserved enough memory
-            need_tt = 0
-            need_tt += get_hash(run["args"]["new_options"])
-            need_tt += get_hash(run["args"]["base_options"])
-            need_tt *= max_threads // run["args"]["threads"]
-            # Needed for fastchess with the fairly large UHO_Lichess_4852_v1.epd opening book
-            need_base = 220
-            # Needed for binaries
-            need_base += 2 * 80
-            # Needed for python
-            need_base += 64
-            # estimate another 12 per process, 16MB per thread, and 133+6MB for large and small net
-            # Note that changes here need the corresponding worker change to STC_memory, which limits concurrency
-            need_base += (
-                2
-                * (max_threads // run["args"]["threads"])
-                * (12 + 139 + 31 * run["args"]["threads"])
-            )
-
-            if need_base + need_tt > max_memory:
-                continue
+                return False
 
             # GitHub API limit...
             if near_github_api_limit:
                 have_binary = (
-                    my_name in self.worker_runs and run_id in self.worker_runs[my_name]
+                    my_name in self.worker_runs
+                    and str(state.run["_id"]) in self.worker_runs[my_name]
                 )
                 if not have_binary:
-                    continue
+                    return False
 
-            # Limit the number of cores.
-            # Currently this is only done for spsa.
-            if "spsa" in run["args"]:
-                limit_cores = 200000 / math.sqrt(len(run["args"]["spsa"]["params"]))
-            else:
-                limit_cores = 1000000  # infinity
-
-            if run["cores"] > limit_cores:
-                continue
+            if state.cores > entry["limit_cores"]:
+                return False
 
-            # check if we satisfy the arch filter
-            arch_filter = run["args"].get("arch_filter", "")
-            if arch_filter != "":
-                arch_filter_re = self.compile_regex(arch_filter)
-                # We use a timeout to protect against redos attacks.
-                # The timeout of 100ms should never trigger with a legitimate
-                # arch string.
-                # See https://github.com/official-stockfish/fishtest/pull/2428#issuecomment-3715147268
-                try:
-                    if arch_filter_re.search(worker_arch, timeout=0.1) is None:
-                        continue
-                except Exception as e:
-                    message = (
-                        f"Matching {worker_arch} against {arch_filter} failed: {e}"
-                    )
-                    self.actiondb.log_message(
-                        username="fishtest.system",
-                        message=message,
-                    )
-                    print(
-                        message,
-                        flush=True,
-                    )
+            return True
 
-            # check if we have the correct compiler
-            compiler = run["args"].get("compiler", "")
-            if compiler != "" and compiler != worker_compiler:
+        # Now go through the sorted list of candidate runs.
+        # We will add a task to the first run that is suitable.
+        # The selection is done without locks. The run lock is only taken
+        # to create the task. If in the meantime another thread has changed
+        # the run (which we detect by comparing its scheduling state with
+        # the snapshot) then we check the run again and go on with the next
+        # candidate if it is no longer suitable.
+
+        for state, entry in candidates:
+            if not suitable(state, entry):
+                continue
+            run = state.run
+            run_id = str(run["_id"])
+            lock = self.active_run_lock(run_id)
+            lock.acquire()
+            current = _ScheduleState.of(run)
+            if current != state and not suitable(current, entry):
+                lock.release()
                 continue
-
             # If we make it here, it means we have found a run
-            # suitable for a new task.
-            run_found = True
+            # suitable for a new task and we hold its lock.
             break
-
-        # If there is no suitable run, tell the worker.
-        if not run_found:
+        else:
+            # If there is no suitable run, tell the worker.
             return {"task_waiting": False}
 
         # Now we create a new task for this run.
-        run_id = str(run["_id"])
-        with self.active_run_lock(run_id):
-            # It may happen that the run we have selected is now finished or
-            # has enough games.
-            # Since this is very rare we just return instead of cluttering the
-            # code with remedial actions.
+        try:
+            # We reserve a connection. The limit was already checked above,
+            # but another thread may have reserved a connection for the same
+            # ip address in the meantime.
+            with self.connections_lock:
+                remote_addr = worker_info["remote_addr"]
+                if self.connections_counter.get(remote_addr, 0) >= connections_limit:
+                    error = "Request_task: Machine limit reached for user {}".format(
+                        worker_info["username"]
+                    )
+                    print(error, flush=True)
+                    return {"task_waiting": False, "error": error}
+                self.connections_counter[remote_addr] = (
+                    self.connections_counter.get(remote_addr, 0) + 1
+                )
 
-            # First recompute "remaining" because the value computed above was not
-            # synchronized.
             remaining = run["args"]["num_games"] - run["committed_games"]
 
-            if run["finished"] or remaining <= 0:
-                info = (
-                    f"Request_task: alas the run {run_id} corresponding to the "
-                    "assigned task no longer needs games. Please try again..."
-                )
-                print(info, flush=True)
-                return {"task_waiting": False, "info": info}
-
             opening_offset = run["total_games"]
 
             if "sprt" in run["args"]:
@@ -1643,25 +1867,32 @@ After fixing the issues you can unblock the worker at
             }
             run["tasks"].append(task)
 
-            with self.connections_lock:
-                remote_addr = worker_info["remote_addr"]
-                if remote_addr in self.connections_counter:
-                    self.connections_counter[remote_addr] += 1
-                else:
-                    self.connections_counter[remote_addr] = 1
-
             task_id = len(run["tasks"]) - 1
 
             run["workers"] += 1
             run["cores"] += task["worker_info"]["concurrency"]
             run["committed_games"] += task["num_games"]
             run["total_games"] += task["num_games"]
+            self.task_deadlines.touch(run_id, task_id, task["last_updated"])
+            self.active_tasks.update(run, task_id)
+        finally:
+            lock.release()
 
         # We give up the lock to avoid deadlock
 
         self.insert_in_wtt_map(run_id, task_id)
 
-        self.buffer(run, priority=Prio.HIGH)
+        self.buffer(
+            run,
+            priority=Prio.HIGH,
+            paths=(
+                "workers",
+                "cores",
+                "committed_games",
+                "total_games",
+                f"tasks.{task_id}",
+            ),
+        )
 
         # Cache some data. Currently we record the id's
         # the worker has seen, as well as the last id that was seen.
@@ -1825,6 +2056,10 @@ After fixing the issues you can unblock the worker at
         task["stats"] = stats
         task["last_updated"] = update_time
         task["worker_info"] = worker_info  # updates rate, ARCH, nps
+        self.task_deadlines.touch(run_id, task_id, update_time)
+        self.active_tasks.update(run, task_id)
+        self.chi2_cache.update_task(run, task_id)
+        self.stats_journal.record(run_id, task_id, stats)
 
         if "spsa" in run["args"] and spsa_games == spsa_results["num_games"]:
             self.spsa_handler.update_spsa_data(run_id, task_id, spsa_results)
@@ -1845,7 +2080,7 @@ After fixing the issues you can unblock the worker at
         # Stop the run if finished.
 
         if not is_undecided(run):
-            self.stop_run(run_id)
+            self.stop_run(run_id, task_id=task_id)
             # stop run may not actually stop a run because of autopurging!
             if run["finished"]:
                 self.actiondb.finished_run(
@@ -1857,7 +2092,10 @@ After fixing the issues you can unblock the worker at
             # done by stop_run.
             ret = {"task_alive": False}
         else:
-            self.buffer(run)
+            paths = ["results", "last_updated", f"tasks.{task_id}"]
+            if "sprt" in run["args"]:
+                paths.append("args.sprt")
+            self.buffer(run, paths=paths)
             ret = {"task_alive": task["active"]}
 
         return ret
@@ -1892,18 +2130,22 @@ After fixing the issues you can unblock the worker at
         )
         return {}
 
-    def stop_run(self, run_id):
+    def stop_run(self, run_id, task_id=None):
         """Stops a run and runs auto-purge if it was enabled
         - Used by the website and API for manually stopping runs
         - Called during /api/update_task:
           - for stopping SPRT runs if the test is accepted or rejected
           - for stopping a run after all games are finished
+        In the latter case task_id is the updated task. It is then the
+        only task which is validated, since validating all the tasks
+        of a large run would delay the update (validate_random_run()
+        takes care of the other tasks).
         """
         run = self.get_run(run_id)
         self.set_inactive_run(run)
 
         try:
-            validate(runs_schema, run, "run")
+            validate_run(run, task_ids=None if task_id is None else (task_id,))
         except ValidationError as e:
             message = f"The run object {run_id} does not validate: {str(e)}"
             if "version" in run and run["version"] >= RUN_VERSION:
@@ -1981,13 +2223,18 @@ After fixing the issues you can unblock the worker at
                 # The residual or residual color may not have been set yet
                 self.set_bad_task(task_id, run, residual=10.0, residual_color="red")
 
-        chi2 = get_chi2(run["tasks"])
+        chi2 = self.get_chi2(run)
         bad_workers = get_bad_workers(
             run["tasks"],
             cached_chi2=chi2,
             p=p,
             res=res,
             iters=iters - 1 if message == "" else iters,
+            worker_stats=(
+                self.chi2_cache.worker_stats(run)
+                if self.__is_primary_instance
+                else None
+            ),
         )
         tasks = copy.copy(run["tasks"])
         for task_id, task in enumerate(tasks):
@@ -0,0 +1,158 @@
+import bisect
+import math
+import threading
+
+from fishtest.util import get_hash
+
+
+def task_memory_base(threads, max_threads):
+    # Memory (in MB) needed by a worker with max_threads cores for a run
+    # with the given number of threads, not counting the hash tables.
+    # Needed for fastchess with the fairly large UHO_Lichess_4852_v1.epd opening book
+    need_base = 220
+    # Needed for binaries
+    need_base += 2 * 80
+    # Needed for python
+    need_base += 64
+    # estimate another 12 per process, 16MB per thread, and 133+6MB for large and small net
+    # Note that changes here need the corresponding worker change to STC_memory, which limits concurrency
+    need_base += 2 * (max_threads // threads) * (12 + 139 + 31 * threads)
+    return need_base
+
+
+class ScheduleIndex:
+    """Eligibility pre-filter for request_task.
+
+    The index contains the unfinished approved runs, grouped in buckets
+    keyed by (threads, compiler, arch_filter). Inside a bucket the runs
+    are sorted by the amount of hash they need per game, so that the
+    runs fitting in the memory of a worker form a prefix of the bucket
+    which can be found by bisection.
+
+    The properties stored in the index are precomputed when a run is
+    added, so they only change through update(). The dynamic conditions
+    (finished, remaining games, cores) still have to be checked by the
+    caller.
+
+    The writers (which are rare) are serialized by a lock and publish a
+    new immutable snapshot of the index. The readers just pick up the
+    current snapshot, so they never wait.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (entries, buckets) with
+        # entries: run_id -> entry
+        # buckets: (threads, compiler, arch_filter) -> ((hash, run_id),...) sorted
+        self.__snapshot = ({}, {})
+
+    @staticmethod
+    def is_eligible(run):
+        return run["approved"] and not run["finished"]
+
+    @staticmethod
+    def make_entry(run):
+        args = run["args"]
+        if "spsa" in args:
+            # Limit the number of cores.
+            # Currently this is only done for spsa.
+            limit_cores = 200000 / math.sqrt(len(args["spsa"]["params"]))
+        else:
+            limit_cores = 1000000  # infinity
+        return {
+            "threads": args["threads"],
+            "hash": get_hash(args["new_options"]) + get_hash(args["base_options"]),
+            "compiler": args.get("compiler", ""),
+            "arch_filter": args.get("arch_filter", ""),
+            "limit_cores": limit_cores,
+        }
+
+    @staticmethod
+    def __bucket_key(entry):
+        return entry["threads"], entry["compiler"], entry["arch_filter"]
+
+    def __replace(self, run_id, entry):
+        # Helper method. The caller should hold the lock.
+        entries, buckets = self.__snapshot
+        old_entry = entries.get(run_id)
+        if old_entry is None and entry is None:
+            return
+        entries = dict(entries)
+        buckets = dict(buckets)
+        if old_entry is not None:
+            del entries[run_id]
+            key = self.__bucket_key(old_entry)
+            bucket = tuple(e for e in buckets[key] if e[1] != run_id)
+            if bucket:
+                buckets[key] = bucket
+            else:
+                del buckets[key]
+        if entry is not None:
+            entries[run_id] = entry
+            key = self.__bucket_key(entry)
+            bucket = list(buckets.get(key, ()))
+            bisect.insort(bucket, (entry["hash"], run_id))
+            buckets[key] = tuple(bucket)
+        self.__snapshot = (entries, buckets)
+
+    def update(self, run):
+        """Add, refresh or remove the run, depending on its current state."""
+        run_id = str(run["_id"])
+        entry = self.make_entry(run) if self.is_eligible(run) else None
+        with self.lock:
+            self.__replace(run_id, entry)
+
+    def remove(self, run_id):
+        with self.lock:
+            self.__replace(str(run_id), None)
+
+    def clear(self):
+        with self.lock:
+            self.__snapshot = ({}, {})
+
+    def get(self, run_id):
+        return self.__snapshot[0].get(str(run_id))
+
+    def __len__(self):
+        return len(self.__snapshot[0])
+
+    def __contains__(self, run_id):
+        return str(run_id) in self.__snapshot[0]
+
+    def candidates(
+        self,
+        max_threads,
+        min_threads,
+        max_memory,
+        compiler,
+        arch_filter_ok=lambda arch_filter: True,
+    ):
+        """Return the list of (run_id, entry) for the runs whose static
+        requirements are satisfied by the worker. The callable arch_filter_ok
+        decides if the worker architecture matches a given (non-empty) arch
+        filter. It is called at most once per filter.
+        """
+        entries, buckets = self.__snapshot
+        arch_filter_matches = {"": True}
+        candidates = []
+        for (threads, run_compiler, arch_filter), bucket in buckets.items():
+            if threads > max_threads or threads < min_threads:
+                continue
+            if run_compiler != "" and run_compiler != compiler:
+                continue
+            # We check if the worker has reserved enough memory.
+            max_hash = (max_memory - task_memory_base(threads, max_threads)) // (
+                max_threads // threads
+            )
+            if max_hash < 0:
+                continue
+            end = bisect.bisect_right(bucket, max_hash, key=lambda e: e[0])
+            if end == 0:
+                continue
+            if arch_filter not in arch_filter_matches:
+                arch_filter_matches[arch_filter] = arch_filter_ok(arch_filter)
+            if arch_filter_matches[arch_filter]:
+                candidates.extend(
+                    (run_id, entries[run_id]) for _, run_id in bucket[:end]
+                )
+        return candidates
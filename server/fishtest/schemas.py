@@ -109,14 +109,21 @@ def size_is_length(pgn_doc):
     return pgn_doc["size"] == len(pgn_doc["pgn_zip"])
 
 
+def run_and_task_id_match(pgn_doc):
+    return pgn_doc["run_id"] == f"{pgn_doc['run']}-{pgn_doc['task_id']}"
+
+
 pgns_schema = intersect(
     {
         "_id?": ObjectId,
         "run_id": run_id_pgns,
+        "run": run_id,
+        "task_id": uint,
         "pgn_zip": intersect(bytes, gzip_data),
         "size": uint,
     },
     size_is_length,
+    run_and_task_id_match,
 )
 
 user_schema = {
@@ -496,12 +503,45 @@ results_schema = intersect(
 )
 
 
+stats_journal_schema = {
+    "_id?": ObjectId,
+    "run_id": run_id,
+    "task_id": task_id,
+    "stats": results_schema,
+    "time": datetime_utc,
+}
+
+
+# The sample contains the (theta, R, c) values of the params as float32
+# (see spsa_history.py).
+spsa_history_schema = {
+    "_id?": ObjectId,
+    "run_id": run_id,
+    "index": uint,
+    "iter": uint,
+    "sample": intersect(
+        bytes, set_name(lambda x: len(x) % 12 == 0, "spsa_history_sample")
+    ),
+}
+
+
 def valid_spsa_results(stats):
     return stats["wins"] + stats["losses"] + stats["draws"] == stats["num_games"]
 
 
 api_access_schema = lax({"password": str, "worker_info": {"username": username}})
 
+_api_spsa_schema = intersect(
+    {
+        "wins": uint,
+        "losses": uint,
+        "draws": uint,
+        "num_games": intersect(uint, even),
+        "sig": uint,
+    },
+    valid_spsa_results,
+)
+
 api_schema = intersect(
     {
         "password": str,
@@ -510,21 +550,30 @@ api_schema = intersect(
         "pgn?": str,
         "message?": str,
         "worker_info": worker_info_schema_api,
-        "spsa?": intersect(
-            {
-                "wins": uint,
-                "losses": uint,
-                "draws": uint,
-                "num_games": intersect(uint, even),
-                "sig": uint,
-            },
-            valid_spsa_results,
-        ),
+        "spsa?": _api_spsa_schema,
         "stats?": results_schema,
     },
     ifthen(keys("task_id"), keys("run_id")),
 )
 
+# The requests sent by every worker at a high rate: api_schema without
+# the optional keys that these endpoints do not use.
+api_update_task_schema = {
+    "password": str,
+    "run_id": run_id,
+    "task_id": task_id,
+    "worker_info": worker_info_schema_api,
+    "spsa?": _api_spsa_schema,
+    "stats?": results_schema,
+}
+
+api_beat_schema = {
+    "password": str,
+    "run_id": run_id,
+    "task_id": task_id,
+    "worker_info": worker_info_schema_api,
+}
+
 
 zero_results = {
     "wins": 0,
@@ -699,6 +748,24 @@ valid_aggregated_data = intersect(
     flags_must_match,
 )
 
+task_schema = intersect(
+    {
+        "num_games": intersect(uint, even),
+        "active": bool,
+        "last_updated": datetime_utc,
+        "start": uint,
+        "bad?": True,
+        "stats": results_schema,
+        "spsa_params?": {
+            "iter": uint,
+            "packed_flips": bytes,  # TODO: check length
+        },
+        "worker_info": worker_info_schema_runs,
+    },
+    ifthen(keys("bad"), lax({"active": False, "stats": quote(zero_results)})),
+    ifthen(keys("spsa_params"), lax({"active": True})),
+)
+
 # The following schema only matches new runs. The old runs
 # are not compatible with it. For documentation purposes
 # it would also be useful to have a "universal schema"
@@ -711,159 +778,140 @@ valid_aggregated_data = intersect(
 
 RUN_VERSION = 24
 
-runs_schema = intersect(
-    {
-        "_id": ObjectId,
-        "version": uint,
-        "start_time": datetime_utc,
-        "last_updated": datetime_utc,
-        "tc_base": unumber,
-        "rescheduled_from?": run_id,
-        "approved": bool,
-        "approver": union(username, ""),
-        "finished": bool,
-        "deleted": bool,
-        "failed": bool,
-        "failures": uint,
-        "is_green": bool,
-        "is_yellow": bool,
-        "workers": uint,
-        "cores": uint,
-        "committed_games": uint,
-        "total_games": uint,
-        "results": results_schema,
-        "nps": ufloat,
-        "games_per_minute": ufloat,
-        "args": intersect(
-            {
-                "base_tag": str,
-                "new_tag": str,
-                "base_nets": intersect([net_name, ...], unique),
-                "new_nets": intersect([net_name, ...], unique),
-                "num_games": intersect(uint, even),
-                "tc": tc,
-                "new_tc": tc,
-                "book": book,
-                "book_depth": str_int,
-                "threads": suint,
-                "resolved_base": sha,
-                "resolved_new": sha,
-                "msg_base": str,
-                "msg_new": str,
-                "base_options": option_list,
-                "new_options": option_list,
-                "info": str,
-                "base_signature": str_int,
-                "new_signature": str_int,
-                "username": username,
-                "tests_repo": github_repo,
-                "master_repo?": github_repo,  # present only when non-standard (rare)
-                "auto_purge": bool,
-                "throughput": unumber,
-                "itp": unumber,
-                "priority": float,
-                "adjudication": bool,
-                "arch_filter?": regex_pattern,
-                "compiler?": compiler,
-                "sprt?": intersect(
-                    {
-                        "alpha": 0.05,
-                        "beta": 0.05,
-                        "elo0": float,
-                        "elo1": float,
-                        "elo_model": "normalized",
-                        "state": union("", "accepted", "rejected"),
-                        "llr": float,
-                        "batch_size": suint,
-                        "lower_bound": -math.log(19),
-                        "upper_bound": math.log(19),
-                        "lost_samples?": uint,
-                        "illegal_update?": uint,
-                        "overshoot?": {
-                            "last_update": uint,
-                            "skipped_updates": uint,
-                            "ref0": float,
-                            "m0": float,
-                            "sq0": unumber,
-                            "ref1": float,
-                            "m1": float,
-                            "sq1": unumber,
-                        },
-                    },
-                    one_of("overshoot", "lost_samples"),
-                ),
-                "spsa?": {
-                    "algorithm?": "classic",
-                    "A": unumber,
-                    "alpha": unumber,
-                    "gamma": unumber,
-                    "raw_params": str,
-                    "iter": uint,
-                    "num_iter": uint,
-                    "params": [
-                        {
-                            "name": str,
-                            "start": float,
-                            "min": float,
-                            "max": float,
-                            "c_end": sunumber,
-                            "r_end": unumber,
-                            "c": sunumber,
-                            "a_end": unumber,
-                            "a": unumber,
-                            "theta": float,
-                        },
-                        ...,
-                    ],
-                    "param_history?": [
-                        [
-                            {"theta": float, "R": unumber, "c": unumber},
-                            ...,
-                        ],
-                        ...,
-                    ],
-                },
-            },
-            at_most_one_of("sprt", "spsa"),
-        ),
-        "tasks": [
-            intersect(
+_runs_fields = {
+    "_id": ObjectId,
+    "version": uint,
+    "start_time": datetime_utc,
+    "last_updated": datetime_utc,
+    "tc_base": unumber,
+    "rescheduled_from?": run_id,
+    "approved": bool,
+    "approver": union(username, ""),
+    "finished": bool,
+    "deleted": bool,
+    "failed": bool,
+    "failures": uint,
+    "is_green": bool,
+    "is_yellow": bool,
+    "workers": uint,
+    "cores": uint,
+    "committed_games": uint,
+    "total_games": uint,
+    "results": results_schema,
+    "nps": ufloat,
+    "games_per_minute": ufloat,
+    "args": intersect(
+        {
+            "base_tag": str,
+            "new_tag": str,
+            "base_nets": intersect([net_name, ...], unique),
+            "new_nets": intersect([net_name, ...], unique),
+            "num_games": intersect(uint, even),
+            "tc": tc,
+            "new_tc": tc,
+            "book": book,
+            "book_depth": str_int,
+            "threads": suint,
+            "resolved_base": sha,
+            "resolved_new": sha,
+            "msg_base": str,
+            "msg_new": str,
+            "base_options": option_list,
+            "new_options": option_list,
+            "info": str,
+            "base_signature": str_int,
+            "new_signature": str_int,
+            "username": username,
+            "tests_repo": github_repo,
+            "master_repo?": github_repo,  # present only when non-standard (rare)
+            "auto_purge": bool,
+            "throughput": unumber,
+            "itp": unumber,
+            "priority": float,
+            "adjudication": bool,
+            "arch_filter?": regex_pattern,
+            "compiler?": compiler,
+            "sprt?": intersect(
                 {
-                    "num_games": intersect(uint, even),
-                    "active": bool,
-                    "last_updated": datetime_utc,
-                    "start": uint,
-                    "bad?": True,
-                    "stats": results_schema,
-                    "spsa_params?": {
-                        "iter": uint,
-                        "packed_flips": bytes,  # TODO: check length
+                    "alpha": 0.05,
+                    "beta": 0.05,
+                    "elo0": float,
+                    "elo1": float,
+                    "elo_model": "normalized",
+                    "state": union("", "accepted", "rejected"),
+                    "llr": float,
+                    "batch_size": suint,
+                    "lower_bound": -math.log(19),
+                    "upper_bound": math.log(19),
+                    "lost_samples?": uint,
+                    "illegal_update?": uint,
+                    "overshoot?": {
+                        "last_update": uint,
+                        "skipped_updates": uint,
+                        "ref0": float,
+                        "m0": float,
+                        "sq0": unumber,
+                        "ref1": float,
+                        "m1": float,
+                        "sq1": unumber,
                     },
-                    "worker_info": worker_info_schema_runs,
                 },
-                ifthen(
-                    keys("bad"), lax({"active": False, "stats": quote(zero_results)})
-                ),
-                ifthen(keys("spsa_params"), lax({"active": True})),
+                one_of("overshoot", "lost_samples"),
             ),
-            ...,
-        ],
-        "bad_tasks": [
-            {
-                "num_games": intersect(uint, even),
-                "active": False,
-                "last_updated": datetime_utc,
-                "start": uint,
-                "residual": float,
-                "residual_color": residual_color,
-                "bad": True,
-                "task_id": task_id,
-                "stats": results_schema,
-                "worker_info": worker_info_schema_runs,
+            "spsa?": {
+                "algorithm?": "classic",
+                "A": unumber,
+                "alpha": unumber,
+                "gamma": unumber,
+                "raw_params": str,
+                "iter": uint,
+                "num_iter": uint,
+                "params": [
+                    {
+                        "name": str,
+                        "start": float,
+                        "min": float,
+                        "max": float,
+                        "c_end": sunumber,
+                        "r_end": unumber,
+                        "c": sunumber,
+                        "a_end": unumber,
+                        "a": unumber,
+                        "theta": float,
+                    },
+                    ...,
+                ],
+                # Legacy, the history is now stored in spsa_history.
+                "param_history?": [
+                    [
+                        {"theta": float, "R": unumber, "c": unumber},
+                        ...,
+                    ],
+                    ...,
+                ],
             },
-            ...,
-        ],
-    },
+        },
+        at_most_one_of("sprt", "spsa"),
+    ),
+    "tasks": [task_schema, ...],
+    "bad_tasks": [
+        {
+            "num_games": intersect(uint, even),
+            "active": False,
+            "last_updated": datetime_utc,
+            "start": uint,
+            "residual": float,
+            "residual_color": residual_color,
+            "bad": True,
+            "task_id": task_id,
+            "stats": results_schema,
+            "worker_info": worker_info_schema_runs,
+        },
+        ...,
+    ],
+}
+
+_runs_conditions = (
     lax(ifthen({"failed": True}, {"failures": suint})),
     lax(ifthen({"approved": True}, {"approver": username}, {"approver": ""})),
     lax(ifthen({"is_green": True}, {"is_yellow": False})),
@@ -892,8 +940,16 @@ runs_schema = intersect(
     valid_aggregated_data,
 )
 
+runs_schema = intersect(_runs_fields, *_runs_conditions)
+
 runs_schema = set_label(runs_schema, "runs_schema")
 
+# A run whose tasks only have to be dicts. The consistency checks of the
+# run still use them (see validators.py).
+runs_schema_without_tasks = intersect(
+    {**_runs_fields, "tasks": [dict, ...]}, *_runs_conditions
+)
+
 cache_schema = {
     run_id: {
         "run": runs_schema,
@@ -901,6 +957,8 @@ cache_schema = {
         "last_sync_time": timestamp,  # Last sync time (reading from or writing to db). If never synced then creation time.
         "last_access_time": timestamp,  # Last time the cache entry was touched (via buffer() or get_run()).
         "priority": int,  # Entries with higher priority are synced first.
+        # Paths changed since last_sync_time. None means that the whole run should be written.
+        "dirty_paths": union({str}, None),
     },
 }
 
@@ -1,89 +1,79 @@
-import random
 import zlib
 
 import numpy as np
 
+from fishtest.http.settings import SPSA_STATE_CACHE_SIZE
+from fishtest.lru_cache import LRUCache
 from fishtest.spsa_workflow import (
-    apply_spsa_result_updates,
     build_spsa_chart_payload,
-    build_spsa_worker_step,
-    clip_spsa_param_value,
+    build_spsa_worker_steps,
+    clip_spsa_param_values,
     get_spsa_history_period,
 )
 
+_rng = np.random.default_rng()
 
-def _pack_flips(flips):
-    """
-    This transforms a list of +-1 into a sequence of bytes
-    with the meaning of the individual bits being 1:1, 0:-1.
-    """
-    return np.packbits(np.array(flips, dtype=np.int8) == 1).tobytes() if flips else b""
 
+class _SpsaState:
+    """The params of a tune as numpy arrays (c, a, min, max and theta).
 
-def _unpack_flips(packed_flips, length=None):
+    The state is derived from the list spsa["params"] of the run and it
+    is only valid as long as that list is the one of the cached run (a
+    run reloaded from the database gets a new state). The thetas are
+    only modified through set_theta(), which also writes them back to the
+    params, so that the run document stays the reference.
     """
-    The inverse function.
-    """
-    if not packed_flips:
-        return []
-    bits = np.unpackbits(np.frombuffer(packed_flips, dtype=np.uint8))
-    flips = np.where(bits, 1, -1)
-    return flips.tolist() if length is None else flips[:length].tolist()
-
-
-def _generate_data(spsa, iter=None):
-    result = {"w_params": [], "b_params": []}
-
-    if iter is None:
-        iter = spsa["iter"]
-
-    for param in spsa["params"]:
-        flip = random.choice((-1, 1))
-        worker_step = build_spsa_worker_step(
-            spsa,
-            param,
-            iter_value=iter,
-            flip=flip,
-        )
-        result["w_params"].append(
-            {
-                "name": param["name"],
-                "value": clip_spsa_param_value(param, worker_step["c"] * flip),
-                **worker_step,
-            }
-        )
-        result["b_params"].append(
-            {
-                "name": param["name"],
-                "value": clip_spsa_param_value(param, -worker_step["c"] * flip),
-            }
-        )
 
-    return result
+    __slots__ = ("params", "names", "c", "a", "min", "max", "theta", "history_length")
 
+    def __init__(self, params, history_length):
+        self.params = params
+        # Number of samples in the parameter history.
+        self.history_length = history_length
+        self.names = [param["name"] for param in params]
+        for field in ("c", "a", "min", "max", "theta"):
+            setattr(
+                self, field, np.array([param[field] for param in params], dtype=float)
+            )
 
-def _add_to_history(spsa, num_games, w_params):
-    n_params = len(spsa["params"])
-    period = get_spsa_history_period(num_iter=num_games / 2, param_count=n_params)
+    def clip(self, increment):
+        return clip_spsa_param_values(self.theta, self.min, self.max, increment)
+
+    def set_theta(self, theta):
+        self.theta = theta
+        for param, value in zip(self.params, theta.tolist()):
+            param["theta"] = value
+
+
+def _generate_flips(n_params):
+    """Return (flips, packed_flips) for n_params random flips."""
+    bits = _rng.integers(0, 2, size=n_params, dtype=np.uint8)
+    flips = 2 * bits.astype(np.int8) - 1
+    return flips, np.packbits(bits).tobytes()
 
-    if len(spsa["params"]) != len(w_params):
-        msg = (
-            "SPSA history length mismatch: "
-            f"{len(spsa['params'])} params, {len(w_params)} worker params"
-        )
-        raise ValueError(msg)
 
-    if period <= 0:
-        return
+def _generate_data(spsa, state, flips):
+    c, R = build_spsa_worker_steps(spsa, state.c, state.a, iter_value=spsa["iter"])
+    increment = c * flips
+    w_values = state.clip(increment).tolist()
+    b_values = state.clip(-increment).tolist()
+    return {
+        "w_params": [
+            {"name": name, "value": value, "c": c_i, "R": R_i, "flip": flip}
+            for name, value, c_i, R_i, flip in zip(
+                state.names, w_values, c.tolist(), R.tolist(), flips.tolist()
+            )
+        ],
+        "b_params": [
+            {"name": name, "value": value} for name, value in zip(state.names, b_values)
+        ],
+    }
+
 
-    if "param_history" not in spsa:
-        spsa["param_history"] = []
-    if len(spsa["param_history"]) + 1 <= spsa["iter"] / period:
-        summary = [
-            {"theta": spsa_param["theta"], "R": w_param["R"], "c": w_param["c"]}
-            for spsa_param, w_param in zip(spsa["params"], w_params)
-        ]
-        spsa["param_history"].append(summary)
+def _history_due(spsa, num_games, history_length):
+    n_params = len(spsa["params"])
+    period = get_spsa_history_period(num_iter=num_games / 2, param_count=n_params)
+    return period > 0 and history_length + 1 <= spsa["iter"] / period
 
 
 class SPSAHandler:
@@ -92,6 +82,22 @@ class SPSAHandler:
         if rundb.is_primary_instance():
             self.buffer = rundb.buffer
         self.active_run_lock = rundb.active_run_lock
+        self.spsa_history = rundb.spsa_history
+        # run_id -> _SpsaState. The entries are only accessed under the
+        # run lock.
+        self.states = LRUCache(maxsize=SPSA_STATE_CACHE_SIZE)
+
+    def __get_state(self, run_id, spsa):
+        state = self.states.get(run_id)
+        if state is None or state.params is not spsa["params"]:
+            # The indices of the stored samples continue after the legacy
+            # ones, and skipped samples leave gaps.
+            history_length = max(
+                len(spsa.get("param_history", [])),
+                self.spsa_history.next_index(run_id),
+            )
+            state = self.states[run_id] = _SpsaState(spsa["params"], history_length)
+        return state
 
     def request_spsa_data(self, run_id, task_id):
         with self.active_run_lock(run_id):
@@ -108,12 +114,13 @@ class SPSAHandler:
             print(info, flush=True)
             return {"task_alive": False, "info": info}
 
-        result = _generate_data(spsa)
-        packed_flips = _pack_flips([w_param["flip"] for w_param in result["w_params"]])
+        state = self.__get_state(run_id, spsa)
+        flips, packed_flips = _generate_flips(len(state.names))
+        result = _generate_data(spsa, state, flips)
         task["spsa_params"] = {}
         task["spsa_params"]["iter"] = spsa["iter"]
         task["spsa_params"]["packed_flips"] = packed_flips
-        self.buffer(run)
+        self.buffer(run, paths=(f"tasks.{task_id}.spsa_params",))
         # The signature defends against server crashes and worker bugs
         sig = zlib.crc32(packed_flips)
         result["sig"] = sig
@@ -151,27 +158,49 @@ class SPSAHandler:
             return
 
         # Reconstruct spsa data from the task data
-        w_params = _generate_data(spsa, iter=task_spsa_params["iter"])["w_params"]
-        flips = _unpack_flips(task_spsa_params["packed_flips"], length=len(w_params))
-        for idx, w_param in enumerate(w_params):
-            w_param["flip"] = flips[idx]
-            del w_param["value"]  # for safety!
+        state = self.__get_state(run_id, spsa)
+        n_params = len(state.names)
+        c, R = build_spsa_worker_steps(
+            spsa, state.c, state.a, iter_value=task_spsa_params["iter"]
+        )
+        packed_flips = task_spsa_params["packed_flips"]
+        if 8 * len(packed_flips) < n_params:
+            msg = (
+                "SPSA parameter update length mismatch: "
+                f"{n_params} params, {8 * len(packed_flips)} packed flips"
+            )
+            raise ValueError(msg)
+        bits = np.unpackbits(
+            np.frombuffer(packed_flips, dtype=np.uint8), count=n_params
+        )
+        flips = 2 * bits.astype(np.int8) - 1
 
         result = spsa_results["wins"] - spsa_results["losses"]
         game_pairs = spsa_results["num_games"] // 2
         spsa["iter"] += game_pairs
 
-        apply_spsa_result_updates(
-            spsa,
-            w_params,
-            result=result,
-            game_pairs=game_pairs,
-        )
-
-        _add_to_history(spsa, run["args"]["num_games"], w_params)
+        state.set_theta(state.clip(R * c * result * flips))
 
-        self.buffer(run)
+        if _history_due(spsa, run["args"]["num_games"], state.history_length):
+            self.spsa_history.append(
+                run_id, state.history_length, spsa["iter"], state.theta, R, c
+            )
+            state.history_length += 1
+
+        self.buffer(
+            run,
+            paths=(
+                f"tasks.{task_id}.spsa_params",
+                "args.spsa.iter",
+                "args.spsa.params",
+            ),
+        )
 
     def get_spsa_data(self, run_id):
         run = self.get_run(run_id)
-        return build_spsa_chart_payload(run["args"].get("spsa"))
+        spsa = run["args"].get("spsa")
+        if spsa is None:
+            return build_spsa_chart_payload(spsa)
+        return build_spsa_chart_payload(
+            spsa, self.spsa_history.load(run_id, len(spsa["params"]))
+        )
@@ -0,0 +1,59 @@
+from pymongo import ASCENDING, DESCENDING
+from vtjson import ValidationError
+
+from fishtest.spsa_workflow import pack_spsa_history_sample, unpack_spsa_history
+from fishtest.validators import validate_spsa_history
+
+
+class SpsaHistory:
+    """Parameter history of the SPSA tunes.
+
+    Every history sample of a tune is a document of a side collection,
+    with the (theta, R, c) values of all the params packed as a float32
+    array of shape (3, number of params). This keeps the history out of
+    the run documents, which are rewritten by the run cache, and lets
+    the chart decode it with numpy.
+
+    Old runs may still have (part of) their history as the list
+    spsa["param_history"] of dicts. Their samples come first, so the
+    indices of the samples stored here continue after them (see
+    utils/migrate_spsa_history.py).
+    """
+
+    def __init__(self, db, collection="spsa_history"):
+        self.collection = db[collection]
+
+    def append(self, run_id, index, iter_value, theta, R, c):
+        record = {
+            "run_id": str(run_id),
+            "index": index,
+            "iter": iter_value,
+            "sample": pack_spsa_history_sample(theta, R, c),
+        }
+        try:
+            validate_spsa_history(record)
+        except ValidationError as e:
+            print(f"SPSA history: skipping sample: {str(e)}", flush=True)
+            return
+        self.collection.insert_one(record)
+
+    def next_index(self, run_id):
+        """Return the index after the last stored sample of the run."""
+        last = self.collection.find_one(
+            {"run_id": str(run_id)},
+            {"index": 1, "_id": 0},
+            sort=[("index", DESCENDING)],
+        )
+        return 0 if last is None else last["index"] + 1
+
+    def load(self, run_id, param_count):
+        """Return the samples of the run as an array of shape
+        (number of samples, 3, param_count)."""
+        samples = self.collection.find(
+            {"run_id": str(run_id)},
+            {"sample": 1, "_id": 0},
+            sort=[("index", ASCENDING)],
+        )
+        return unpack_spsa_history(
+            [sample["sample"] for sample in samples], param_count
+        )
@@ -7,6 +7,8 @@ from collections.abc import Mapping
 from math import isclose, isfinite
 from typing import Any
 
+import numpy as np
+
 CLASSIC_SPSA_ALGORITHM = "classic"
 
 _CLASSIC_SPSA_FORM_DEFAULTS = {
@@ -73,7 +75,8 @@ def _chart_numbers_match(left: object, right: object) -> bool:
     if left_number is None or right_number is None:
         return False
 
-    return isclose(left_number, right_number, rel_tol=0.0, abs_tol=1e-9)
+    # The packed history samples are float32.
+    return isclose(left_number, right_number, rel_tol=1e-6, abs_tol=1e-9)
 
 
 def _chart_sample_matches(
@@ -293,10 +296,6 @@ def _read_spsa_algorithm_name(spsa: Mapping[str, Any] | None) -> str:
     return _normalize_algorithm_name(algorithm)
 
 
-def clip_spsa_param_value(param: Mapping[str, Any], increment: float) -> float:
-    return min(max(param["theta"] + increment, param["min"]), param["max"])
-
-
 def get_spsa_history_period(*, num_iter: int | float, param_count: int) -> float:
     if num_iter <= 0 or param_count <= 0:
         return 0.0
@@ -483,49 +482,60 @@ def format_spsa_value(
     return spsa_value
 
 
-def build_spsa_worker_step(
+def build_spsa_worker_steps(
     spsa: Mapping[str, Any],
-    param: Mapping[str, Any],
+    c: np.ndarray,
+    a: np.ndarray,
     *,
     iter_value: int,
-    flip: int,
-) -> dict[str, Any]:
+) -> tuple[np.ndarray, np.ndarray]:
+    """Return the arrays (c, R) of the SPSA step of all the params, given
+    the arrays of their base c and a."""
     _read_spsa_algorithm_name(spsa)
 
     iter_local = iter_value + 1
-    c = param["c"] / iter_local ** spsa["gamma"]
-    return {
-        "c": c,
-        "R": param["a"] / (spsa["A"] + iter_local) ** spsa["alpha"] / c**2,
-        "flip": flip,
-    }
-
-
-def apply_spsa_result_updates(
-    spsa: dict[str, Any],
-    w_params: list[dict[str, Any]],
-    *,
-    result: int,
-    game_pairs: int,
-) -> None:
-    _read_spsa_algorithm_name(spsa)
-    del game_pairs
-
-    if len(spsa["params"]) != len(w_params):
-        msg = (
-            "SPSA parameter update length mismatch: "
-            f"{len(spsa['params'])} params, {len(w_params)} worker params"
-        )
-        raise ValueError(msg)
-
-    for param, w_param in zip(spsa["params"], w_params):
-        param["theta"] = clip_spsa_param_value(
-            param,
-            w_param["R"] * w_param["c"] * result * w_param["flip"],
-        )
+    c = c / iter_local ** spsa["gamma"]
+    return c, a / (spsa["A"] + iter_local) ** spsa["alpha"] / c**2
+
+
+def clip_spsa_param_values(
+    theta: np.ndarray,
+    minimum: np.ndarray,
+    maximum: np.ndarray,
+    increment: np.ndarray,
+) -> np.ndarray:
+    """Return theta + increment, clipped to [minimum, maximum]."""
+    return np.minimum(np.maximum(theta + increment, minimum), maximum)
+
+
+def pack_spsa_history_sample(
+    theta: np.ndarray,
+    R: np.ndarray,
+    c: np.ndarray,
+) -> bytes:
+    """Pack the (theta, R, c) arrays of a history sample as float32."""
+    return np.array([theta, R, c], dtype=np.float32).tobytes()
+
+
+def unpack_spsa_history(samples: list[bytes], param_count: int) -> np.ndarray:
+    """Decode packed history samples into an array of shape
+    (len(samples), 3, param_count). Samples of the wrong length are dropped."""
+    size = 3 * param_count * np.dtype(np.float32).itemsize
+    samples = [sample for sample in samples if len(sample) == size]
+    return (
+        np.frombuffer(b"".join(samples), dtype=np.float32)
+        .reshape(len(samples), 3, param_count)
+        .astype(float)
+    )
 
 
-def build_spsa_chart_payload(spsa: Mapping[str, Any] | None) -> dict[str, Any]:
+def build_spsa_chart_payload(
+    spsa: Mapping[str, Any] | None,
+    packed_history: np.ndarray | None = None,
+) -> dict[str, Any]:
+    """Build the chart of the SPSA tune. The history consists of the
+    legacy samples spsa["param_history"], followed by the samples of
+    packed_history (see unpack_spsa_history)."""
     if not isinstance(spsa, Mapping):
         return {}
 
@@ -581,6 +591,15 @@ def build_spsa_chart_payload(spsa: Mapping[str, Any] | None) -> dict[str, Any]:
 
             chart_history.append(normalized_params)
 
+    if packed_history is not None and len(packed_history) > 0:
+        # Non finite values are handled like missing ones by the chart rows.
+        for thetas, cs in zip(
+            packed_history[:, 0, :].tolist(), packed_history[:, 2, :].tolist()
+        ):
+            chart_history.append(
+                [{"theta": theta, "c": c} for theta, c in zip(thetas, cs)]
+            )
+
     return {
         "param_names": param_names,
         "chart_rows": _build_spsa_chart_rows(
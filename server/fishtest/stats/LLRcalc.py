@@ -35,8 +35,12 @@ def secular(pdf):
     lower_bound = -1 / w
     upper_bound = -1 / v
 
+    # f is evaluated many times by the root finder so we do
+    # not rebuild the (ai, pi) tuples on every call
+    values_probs = [(ai, pi * ai) for ai, pi in pdf]
+
     def f(x):
-        return sum([pi * ai / (1 + x * ai) for ai, pi in pdf])
+        return sum([piai / (1 + x * ai) for ai, piai in values_probs])
 
     x, res = scipy.optimize.brentq(
         f, lower_bound + epsilon, upper_bound - epsilon, full_output=True, disp=False
@@ -2,13 +2,21 @@ from __future__ import division
 
 import math
 
-import scipy.stats
+import numpy as np
+import scipy.special
+
+# Number of terms of the Fourier series which are evaluated at once
+# in the vectorized version of outcome_cdf_alt1.
+SERIES_BLOCK = 32
 
 
 def Phi(x):
     """
-    Cumulative standard normal distribution."""
-    return scipy.stats.norm.cdf(x)
+    Cumulative standard normal distribution. For scalars this is much
+    faster than scipy.stats.norm.cdf."""
+    if isinstance(x, np.ndarray):
+        return scipy.special.ndtr(x)
+    return math.erfc(-x / math.sqrt(2)) / 2
 
 
 def U(n, gamma, A, y):
@@ -21,7 +29,23 @@ def U(n, gamma, A, y):
     ) / (A**2 * gamma**2 + math.pi**2 * n**2)
 
 
+def U_vec(n, gamma, A, y):
+    """
+    Vectorized version of U."""
+    return (
+        2 * A * gamma * np.sin(math.pi * n * y / A)
+        - 2 * math.pi * n * np.cos(math.pi * n * y / A)
+    ) / (A**2 * gamma**2 + math.pi**2 * n**2)
+
+
 class Brownian:
+    """
+    Brownian motion with drift mu and volatility sigma between the
+    absorbing barriers a<0 and b>0. The drift mu may also be a numpy
+    array, in which case outcome_cdf evaluates all drifts at once and
+    returns an array.
+    """
+
     def __init__(self, a=-1.0, b=1.0, mu=0.0, sigma=0.005):
         self.a = a
         self.b = b
@@ -30,6 +54,8 @@ class Brownian:
         self.sigma2 = sigma**2
 
     def outcome_cdf(self, T=None, y=None):
+        if isinstance(self.mu, np.ndarray):
+            return self.outcome_cdf_vec(T, y)
         # in case of slow convergence use Siegmund approximation.
         sigma2 = self.sigma2
         mu = self.mu
@@ -106,3 +132,87 @@ class Brownian:
         else:
             t3 = math.exp(2 * gamma * b) * Phi(zb)
         return t1 + t2 - t3
+
+    def outcome_cdf_vec(self, T=None, y=None):
+        """
+        Vectorized version of outcome_cdf for an array of drifts."""
+        mu = np.asarray(self.mu, dtype=float)
+        sigma2 = self.sigma2
+        gamma = mu / sigma2
+        A = self.b - self.a
+        alt2 = np.abs(gamma * A) > 15
+        if sigma2 * T / A**2 < 1e-2:
+            alt2[...] = True
+        ret = np.empty_like(mu)
+        if alt2.any():
+            ret[alt2] = self.__outcome_cdf_alt2_vec(mu[alt2], T, y)
+        if not alt2.all():
+            ret[~alt2] = self.__outcome_cdf_alt1_vec(mu[~alt2], T, y)
+        assert np.all((-1e-3 <= ret) & (ret <= 1 + 1e-3))
+        return ret
+
+    def __outcome_cdf_alt1_vec(self, mu, T, y):
+        sigma2 = self.sigma2
+        A = self.b - self.a
+        x = 0 - self.a
+        y = y - self.a
+        gamma = mu / sigma2
+        lambda_1 = ((math.pi / A) ** 2) * sigma2 / 2 + (mu**2 / sigma2) / 2
+        t0 = np.exp(-lambda_1 * T - x * gamma + y * gamma)
+        # The series is evaluated in blocks of terms. As in the scalar
+        # version, for each drift we sum up to (and including) the first
+        # term which is negligible.
+        s = np.zeros_like(mu)
+        todo = np.arange(len(mu))
+        n0 = 1
+        while len(todo) > 0:
+            n = np.arange(n0, n0 + SERIES_BLOCK)
+            # lambda_n - lambda_1 does not depend on the drift
+            t1 = np.exp(-((n**2 - 1) * (math.pi / A) ** 2 * sigma2 / 2) * T)
+            t3 = U_vec(n, gamma[todo, None], A, y)
+            t4 = np.sin(n * math.pi * x / A)
+            small = np.abs(t0[todo, None] * t1 * t3) <= 1e-9
+            done = small.any(axis=1)
+            last = np.where(done, small.argmax(axis=1), SERIES_BLOCK - 1)
+            terms = np.where(n <= n0 + last[:, None], t1 * t3 * t4, 0)
+            s[todo] += terms.sum(axis=1)
+            todo = todo[~done]
+            n0 += SERIES_BLOCK
+        pre = np.empty_like(mu)
+        overflow = gamma * A > 30  # avoid numerical overflow
+        pre[overflow] = np.exp(-2 * gamma[overflow] * x)
+        zero = ~overflow & (np.abs(gamma * A) < 1e-8)  # avoid division by zero
+        pre[zero] = (A - x) / A
+        other = ~overflow & ~zero
+        g = gamma[other]
+        pre[other] = (1 - np.exp(2 * g * (A - x))) / (1 - np.exp(2 * g * A))
+        return pre + t0 * s
+
+    def __outcome_cdf_alt2_vec(self, mu, T, y):
+        denom = math.sqrt(T * self.sigma2)
+        offset = mu * T
+        gamma = mu / self.sigma2
+        z = (y - offset) / denom
+        za = (-y + offset + 2 * self.a) / denom
+        zb = (y - offset - 2 * self.b) / denom
+        return (
+            Phi(z)
+            + self.__tail_vec(gamma, self.a, za)
+            - self.__tail_vec(gamma, self.b, zb)
+        )
+
+    @staticmethod
+    def __tail_vec(gamma, c, zc):
+        # exp(2*gamma*c)*Phi(zc), using the asymptotic development
+        # of Phi when gamma*c is large.
+        ret = np.empty_like(gamma)
+        asymptotic = gamma * c >= 5
+        g, z = gamma[asymptotic], zc[asymptotic]
+        ret[asymptotic] = (
+            -np.exp(-(z**2) / 2 + 2 * g * c)
+            / math.sqrt(2 * math.pi)
+            * (1 / z - 1 / z**3)
+        )
+        g, z = gamma[~asymptotic], zc[~asymptotic]
+        ret[~asymptotic] = np.exp(2 * g * c) * Phi(z)
+        return ret
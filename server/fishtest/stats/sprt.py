@@ -3,11 +3,16 @@ from __future__ import division
 import argparse
 import math
 
+import numpy as np
 import scipy.optimize
 
 from fishtest.stats import LLRcalc
 from fishtest.stats.brownian import Brownian
 
+# Number of points at which the outcome probability is evaluated (at once)
+# to find a small bracket for the root solver in lower_cb.
+BRACKET_GRID_SIZE = 65
+
 
 class sprt:
     """
@@ -27,6 +32,8 @@ class sprt:
         self.elo1 = elo1
         self.clamped = False
         self.LLR_drift_variance = LLRcalc.LLR_drift_variance_alt2
+        # (elo0, elo1) -> (grid, outcome probabilities), see lower_cb
+        self.__brackets = {}
 
     def elo_to_score(self, elo):
         """
@@ -48,6 +55,7 @@ class sprt:
         return nt * LLRcalc.nelo_divided_by_nt
 
     def set_state(self, results):
+        self.__brackets = {}
         N, self.pdf = LLRcalc.results_to_pdf(results)
         if self.elo_model == "normalized":
             mu, var = LLRcalc.stats(self.pdf)  # code duplication with LLRcalc
@@ -88,6 +96,24 @@ class sprt:
             T=self.T, y=self.llr
         )
 
+    def outcome_prob_batch(self, elos):
+        """
+        Vectorized version of outcome_prob for an array of elo values."""
+        s = LLRcalc.L_(np.asarray(elos, dtype=float))
+        mu_LLR, var_LLR = self.LLR_drift_variance(self.pdf, self.s0, self.s1, s)
+        sigma_LLR = math.sqrt(var_LLR)
+        return Brownian(a=self.a, b=self.b, mu=mu_LLR, sigma=sigma_LLR).outcome_cdf(
+            T=self.T, y=self.llr
+        )
+
+    def __bracket(self, elo0, elo1):
+        # The outcome probabilities on a grid covering [elo0, elo1]. They
+        # do not depend on p so they are shared by the calls of lower_cb.
+        if (elo0, elo1) not in self.__brackets:
+            grid = np.linspace(elo0, elo1, BRACKET_GRID_SIZE)
+            self.__brackets[elo0, elo1] = (grid, self.outcome_prob_batch(grid))
+        return self.__brackets[elo0, elo1]
+
     def lower_cb(self, p):
         """
         Maximal elo value such that the observed outcome of the test has probability
@@ -99,23 +125,26 @@ class sprt:
         while True:
             elo0 = max(avg_elo - N * delta, -1000)
             elo1 = min(avg_elo + N * delta, 1000)
-            try:
-                sol, res = scipy.optimize.brentq(
-                    lambda elo: self.outcome_prob(elo) - (1 - p),
-                    elo0,
-                    elo1,
-                    full_output=True,
-                    disp=False,
-                )
-            except ValueError:
+            grid, probs = self.__bracket(elo0, elo1)
+            values = probs - (1 - p)
+            if values[0] * values[-1] > 0:
                 if elo0 > -1000 or elo1 < 1000:
                     N *= 2
                     continue
                 else:
-                    if self.outcome_prob(elo0) - (1 - p) > 0:
+                    if values[0] > 0:
                         return elo1
                     else:
                         return elo0
+            # Narrow down the bracket using the grid before solving.
+            i = int(np.argmax(values[:-1] * values[1:] <= 0))
+            sol, res = scipy.optimize.brentq(
+                lambda elo: self.outcome_prob(elo) - (1 - p),
+                grid[i],
+                grid[i + 1],
+                full_output=True,
+                disp=False,
+            )
             assert res.converged
             break
         return sol
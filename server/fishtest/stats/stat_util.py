@@ -2,22 +2,30 @@ from __future__ import division
 
 import math
 
-import scipy.stats
+import scipy.special
 
+from fishtest.lru_cache import LRUCache
 from fishtest.stats import LLRcalc, sprt
 
+# SPRT_elo is expensive (several root solves) while the same results are
+# polled over and over by the api and the views. The results of a run only
+# change on update_task, so we memoize on the actual inputs.
+SPRT_ELO_CACHE_SIZE = 5000
+_SPRT_elo_cache = LRUCache(SPRT_ELO_CACHE_SIZE)
+_SPRT_elo_cache_counters = {"hits": 0, "misses": 0}
+
 
 def Phi(q):
     """
     Cumulative distribution function for the standard Gaussian law: quantile -> probability
     """
-    return scipy.stats.norm.cdf(q)
+    return scipy.special.ndtr(q)
 
 
 def Phi_inv(p):
     """
     Quantile function for the standard Gaussian law: probability -> quantile"""
-    return scipy.stats.norm.ppf(p)
+    return scipy.special.ndtri(p)
 
 
 def elo(x):
@@ -119,8 +127,65 @@ def elo_to_bayeselo(elo, draw_ratio):
 
 def SPRT_elo(R, alpha=0.05, beta=0.05, p=0.05, elo0=None, elo1=None, elo_model=None):
     """
-    Calculate an elo estimate from an SPRT test."""
+    Calculate an elo estimate from an SPRT test. The results are memoized
+    on (R, alpha, beta, p, elo0, elo1, elo_model)."""
     assert elo_model in ["BayesElo", "logistic", "normalized"]
+    pentanomial = R.get("pentanomial")
+    key = (
+        R.get("losses", 0),
+        R.get("draws", 0),
+        R.get("wins", 0),
+        tuple(pentanomial) if pentanomial is not None else None,
+        alpha,
+        beta,
+        p,
+        elo0,
+        elo1,
+        elo_model,
+    )
+    with _SPRT_elo_cache.lock:
+        a = _SPRT_elo_cache.get(key)
+        _SPRT_elo_cache_counters["hits" if a is not None else "misses"] += 1
+    if a is None:
+        a = _SPRT_elo(R, alpha, beta, p, elo0, elo1, elo_model)
+        _SPRT_elo_cache[key] = a
+    # The callers may modify the returned dict.
+    return {**a, "ci": list(a["ci"])}
+
+
+def SPRT_elo_batch(tests, p=0.05):
+    """
+    Calculate the elo estimates for a list of SPRT tests. Each test is a
+    dict with keys "results", "alpha", "beta", "elo0", "elo1" and
+    "elo_model". Tests which were seen before (or which occur more than
+    once) are served from the cache."""
+    return [
+        SPRT_elo(
+            test["results"],
+            alpha=test["alpha"],
+            beta=test["beta"],
+            p=p,
+            elo0=test["elo0"],
+            elo1=test["elo1"],
+            elo_model=test["elo_model"],
+        )
+        for test in tests
+    ]
+
+
+def SPRT_elo_cache_stats():
+    with _SPRT_elo_cache.lock:
+        return {**_SPRT_elo_cache_counters, "size": len(_SPRT_elo_cache)}
+
+
+def SPRT_elo_cache_clear():
+    with _SPRT_elo_cache.lock:
+        _SPRT_elo_cache.clear()
+        for counter in _SPRT_elo_cache_counters:
+            _SPRT_elo_cache_counters[counter] = 0
+
+
+def _SPRT_elo(R, alpha, beta, p, elo0, elo1, elo_model):
 
     # Estimate drawelo out of sample
     R3 = LLRcalc.regularize([R.get("losses", 0), R.get("draws", 0), R.get("wins", 0)])
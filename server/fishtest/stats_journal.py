@@ -0,0 +1,75 @@
+from datetime import UTC, datetime, timedelta
+
+from pymongo import WriteConcern
+from pymongo.errors import CollectionInvalid, OperationFailure
+from vtjson import ValidationError
+
+from fishtest.http.settings import STATS_JOURNAL_SIZE_BYTES
+from fishtest.validators import validate_stats_journal
+
+
+class StatsJournal:
+    """Append-only journal of the task stats received through update_task.
+
+    The run cache writes runs to the db with some delay, so the game
+    results received in the meantime would be lost if the primary
+    instance crashes. Every accepted update is therefore also appended
+    to a capped collection, which is cheap to write and never needs
+    to be cleaned. On startup the latest snapshot of each task is
+    replayed into the run cache.
+
+    The records are written with w=0, so update_task does not wait for
+    the acknowledgement of the db while it holds the run lock. A record
+    lost this way only matters if the server crashes before the run is
+    flushed.
+    """
+
+    def __init__(self, db, collection="stats_journal", size=STATS_JOURNAL_SIZE_BYTES):
+        self.db = db
+        if collection not in self.db.list_collection_names():
+            try:
+                self.db.create_collection(collection, capped=True, size=size)
+            except CollectionInvalid:
+                pass  # created concurrently
+        else:
+            self.__resize(collection, size)
+        self.journal = self.db[collection]
+        self.__writer = self.journal.with_options(write_concern=WriteConcern(w=0))
+
+    def __resize(self, collection, size):
+        if self.db[collection].options().get("size", 0) >= size:
+            return
+        try:
+            self.db.command("collMod", collection, cappedSize=size)
+        except OperationFailure as e:
+            print(f"Stats journal: cannot resize to {size} bytes: {str(e)}", flush=True)
+
+    def record(self, run_id, task_id, stats):
+        self.__writer.insert_one(
+            {
+                "run_id": str(run_id),
+                "task_id": task_id,
+                "stats": stats,
+                "time": datetime.now(UTC),
+            }
+        )
+
+    def latest(self, max_age=timedelta(days=1)):
+        """Return the most recent record for every (run_id, task_id) which
+        has been updated during the last max_age."""
+        cutoff = datetime.now(UTC) - max_age
+        latest = {}
+        # Capped collections preserve insertion order.
+        for record in self.journal.find({}, sort=[("$natural", -1)]):
+            if record["time"] < cutoff:
+                break
+            key = record["run_id"], record["task_id"]
+            if key in latest:
+                continue
+            try:
+                validate_stats_journal(record)
+            except ValidationError as e:
+                print(f"Stats journal: skipping record: {str(e)}", flush=True)
+                continue
+            latest[key] = record
+        return latest
@@ -0,0 +1,74 @@
+import heapq
+import threading
+
+
+class TaskDeadlines:
+    """Index of the active tasks ordered by the time of their last update.
+
+    The dead task scavenger only needs the tasks that have not been
+    updated for some time. Instead of scanning all the tasks of all the
+    unfinished runs we keep the active tasks in a heap keyed by
+    last_updated, so that the expired tasks can be popped in
+    O(k log n).
+
+    Refreshing a task pushes a new heap entry. The superseded entries
+    are discarded lazily when they reach the top of the heap, or when
+    they start to dominate the heap.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (run_id, task_id) -> timestamp of the last update
+        self.__last_updated = {}
+        # [(timestamp, run_id, task_id)], may contain superseded entries
+        self.__heap = []
+
+    def __compact(self):
+        # Helper method. Not synchronized!
+        self.__heap = [
+            (timestamp, run_id, task_id)
+            for (run_id, task_id), timestamp in self.__last_updated.items()
+        ]
+        heapq.heapify(self.__heap)
+
+    def touch(self, run_id, task_id, last_updated):
+        """Record that the active task has been updated at last_updated
+        (a datetime)."""
+        run_id = str(run_id)
+        timestamp = last_updated.timestamp()
+        with self.lock:
+            self.__last_updated[run_id, task_id] = timestamp
+            heapq.heappush(self.__heap, (timestamp, run_id, task_id))
+            if len(self.__heap) > 2 * len(self.__last_updated) + 1000:
+                self.__compact()
+
+    def discard(self, run_id, task_id):
+        """Forget the task, e.g. because it became inactive."""
+        with self.lock:
+            self.__last_updated.pop((str(run_id), task_id), None)
+
+    def clear(self):
+        with self.lock:
+            self.__last_updated.clear()
+            self.__heap.clear()
+
+    def pop_expired(self, cutoff):
+        """Remove and return the list of (run_id, task_id) of the tasks
+        whose last update is older than cutoff (a timestamp)."""
+        expired = []
+        with self.lock:
+            while self.__heap and self.__heap[0][0] < cutoff:
+                timestamp, run_id, task_id = heapq.heappop(self.__heap)
+                if self.__last_updated.get((run_id, task_id)) == timestamp:
+                    del self.__last_updated[run_id, task_id]
+                    expired.append((run_id, task_id))
+        return expired
+
+    def __len__(self):
+        with self.lock:
+            return len(self.__last_updated)
+
+    def __contains__(self, key):
+        run_id, task_id = key
+        with self.lock:
+            return (str(run_id), task_id) in self.__last_updated
@@ -81,7 +81,7 @@ class UserDb:
     def get_users(self):
         return self.users.find(sort=[("_id", ASCENDING)])
 
-    @lru_cache(maxsize=1, expiration=30, refresh=False)
+    @lru_cache(maxsize=1, expiration=30, refresh=False, stale_while_revalidate=60)
     def get_usernames(self):
         usernames = self.users.distinct("username")
         return sorted(
@@ -97,7 +97,8 @@ class UserDb:
     def get_pending(self):
         return list(self.users.find({"pending": True}, sort=[("_id", ASCENDING)]))
 
-    @lru_cache(expiration=1, refresh=False)
+    # No stale values: a blocked user should be locked out promptly.
+    @lru_cache(expiration=1, refresh=False, single_flight=True)
     def get_blocked(self):
         return list(self.users.find({"blocked": True}, sort=[("_id", ASCENDING)]))
 
@@ -18,28 +18,54 @@ PASSWORD_MAX_LENGTH = 72
 VALID_USERNAME_PATTERN = "[A-Za-z0-9]{2,}"
 
 
-class GeneratorAsFileReader:
-    def __init__(self, generator):
-        self.generator = generator
-        self.buffer = b""
-
-    def read(self, size=-1):
-        while size < 0 or len(self.buffer) < size:
-            try:
-                self.buffer += next(self.generator)
-            except StopIteration:
-                break
-        result, self.buffer = self.buffer[:size], self.buffer[size:]
-        return result
-
-    def close(self):
-        pass  # No cleanup needed, but method is required
+def iter_chunks(blobs, chunk_size=1024 * 1024):
+    """Re-chunk an iterable of bytes objects into chunks of about chunk_size
+    bytes. Small blobs are joined (each one is copied once) and large blobs
+    are sliced with memoryviews (without copying)."""
+    pending, pending_size = [], 0
+    for blob in blobs:
+        if len(blob) >= chunk_size:
+            if pending:
+                yield b"".join(pending)
+                pending, pending_size = [], 0
+            view = memoryview(blob)
+            for start in range(0, len(view), chunk_size):
+                yield view[start : start + chunk_size]
+            continue
+        pending.append(blob)
+        pending_size += len(blob)
+        if pending_size >= chunk_size:
+            yield b"".join(pending)
+            pending, pending_size = [], 0
+    if pending:
+        yield b"".join(pending)
 
 
 def hex_print(run_id):
     return hashlib.md5(str(run_id).encode("utf-8")).digest().hex()
 
 
+def split_pgn_id(pgn_id):
+    """Split the name <run_id>-<task_id> of a pgn into (run_id, task_id)."""
+    run_id, _, task_id = pgn_id.rpartition("-")
+    return run_id, int(task_id)
+
+
+def run_pgns_query(run_id):
+    """The query for the pgns of a run. The pgns stored before the "run"
+    and "task_id" fields were added (see utils/migrate_pgns.py) are
+    matched by the name <run_id>-<task_id> instead."""
+    return {
+        "$or": [
+            {"run": run_id},
+            {
+                "run": {"$exists": False},
+                "run_id": {"$regex": f"^{re.escape(run_id)}-\\d+$"},
+            },
+        ]
+    }
+
+
 def worker_name(worker_info, short=False):
     # A user friendly name for the worker.
     username = worker_info["username"]
@@ -58,18 +84,30 @@ def worker_name(worker_info, short=False):
     return name
 
 
+def worker_wld(stats, has_pentanomial):
+    """Return the [wins, losses, draws] contribution of a task to the
+    contingency table of get_chi2()."""
+    if not has_pentanomial:
+        return [
+            float(stats.get("wins", 0)),
+            float(stats.get("losses", 0)),
+            float(stats.get("draws", 0)),
+        ]
+    p = stats.get("pentanomial", 5 * [0])  # there was a small window
+    # in time where we could have both trinomial and pentanomial
+    # workers
+
+    # The ww and ll frequencies will typically be too small for
+    # the full pentanomial chi2 test to be valid. See e.g. the last page of
+    # https://www.open.ac.uk/socialsciences/spsstutorial/files/tutorials/chi-square.pdf.
+    # So we combine the ww and ll frequencies with the wd and ld frequencies,
+    # this is equivalent to use the frequencies for the pair of games.
+    return [float(p[4] + p[3]), float(p[0] + p[1]), float(p[2])]
+
+
 def get_chi2(tasks, exclude_workers=set()):
     """Perform chi^2 test on the stats from each worker."""
 
-    default_results = {
-        "chi2": float("nan"),
-        "dof": 0,
-        "p": float("nan"),
-        "residual": {},
-        "z_95": float("nan"),
-        "z_99": float("nan"),
-    }
-
     # Aggregate results by worker
     users = {}
     has_pentanomial = None
@@ -84,28 +122,27 @@ def get_chi2(tasks, exclude_workers=set()):
         stats = task.get("stats", {})
         if has_pentanomial is None:
             has_pentanomial = "pentanomial" in stats
-        if not has_pentanomial:
-            wld = [
-                float(stats.get("wins", 0)),
-                float(stats.get("losses", 0)),
-                float(stats.get("draws", 0)),
-            ]
-        else:
-            p = stats.get("pentanomial", 5 * [0])  # there was a small window
-            # in time where we could have both trinomial and pentanomial
-            # workers
-
-            # The ww and ll frequencies will typically be too small for
-            # the full pentanomial chi2 test to be valid. See e.g. the last page of
-            # https://www.open.ac.uk/socialsciences/spsstutorial/files/tutorials/chi-square.pdf.
-            # So we combine the ww and ll frequencies with the wd and ld frequencies,
-            # this is equivalent to use the frequencies for the pair of games.
-            wld = [float(p[4] + p[3]), float(p[0] + p[1]), float(p[2])]
-
+        wld = worker_wld(stats, has_pentanomial)
         users[key] = [
             user_val + wld_val
             for user_val, wld_val in zip(users.get(key, [0] * len(wld)), wld)
         ]
+    return get_chi2_from_worker_stats(users)
+
+
+def get_chi2_from_worker_stats(users):
+    """Perform chi^2 test on the aggregated stats users[unique_key] =
+    [wins, losses, draws]. The argument is consumed."""
+
+    default_results = {
+        "chi2": float("nan"),
+        "dof": 0,
+        "p": float("nan"),
+        "residual": {},
+        "z_95": float("nan"),
+        "z_99": float("nan"),
+    }
+
     # We filter out the workers whose expected frequences are <= 5 as
     # they break the chi2 test.
     filtering_done = False
@@ -185,16 +222,28 @@ def crash_or_time(task):
     return crashes > 3 or (total > 20 and time_losses / total > 0.1)
 
 
-def get_bad_workers(tasks, cached_chi2=None, p=0.001, res=7.0, iters=1):
+def get_bad_workers(
+    tasks, cached_chi2=None, p=0.001, res=7.0, iters=1, worker_stats=None
+):
     # If we have an up-to-date result of get_chi2() we can pass
     # it as cached_chi2 to avoid needless recomputation.
+    # Likewise worker_stats may contain the up-to-date stats aggregated by
+    # worker (as used by get_chi2_from_worker_stats()), which saves
+    # scanning the tasks in the later iterations.
     bad_workers = set()
     for i in range(iters):
-        chi2 = (
-            get_chi2(tasks, exclude_workers=bad_workers)
-            if i > 0 or cached_chi2 is None
-            else cached_chi2
-        )
+        if i == 0 and cached_chi2 is not None:
+            chi2 = cached_chi2
+        elif worker_stats is not None:
+            chi2 = get_chi2_from_worker_stats(
+                {
+                    key: list(wld)
+                    for key, wld in worker_stats.items()
+                    if key not in bad_workers
+                }
+            )
+        else:
+            chi2 = get_chi2(tasks, exclude_workers=bad_workers)
         worst_user = {}
         residuals = chi2["residual"]
         for worker_key in residuals:
@@ -551,16 +600,6 @@ def strip_run(run):
     for k1, v1 in run.items():
         if k1 in ("tasks", "bad_tasks"):
             stripped[k1] = []
-        elif k1 == "args":
-            stripped[k1] = {}
-            for k2, v2 in v1.items():
-                if k2 == "spsa":
-                    stripped[k1][k2] = {
-                        k3: [] if k3 == "param_history" else copy.deepcopy(v3)
-                        for k3, v3 in v2.items()
-                    }
-                else:
-                    stripped[k1][k2] = copy.deepcopy(v2)
         else:
             stripped[k1] = copy.deepcopy(v1)
 
@@ -0,0 +1,76 @@
+import vtjson
+from vtjson import ValidationError
+
+from fishtest.schemas import (
+    action_schema,
+    api_access_schema,
+    api_beat_schema,
+    api_schema,
+    api_update_task_schema,
+    cache_schema,
+    gzip_data,
+    pgns_schema,
+    runs_schema,
+    runs_schema_without_tasks,
+    spsa_history_schema,
+    stats_journal_schema,
+    task_schema,
+)
+
+
+class Validator:
+    """A schema compiled once.
+
+    vtjson.validate() compiles its schema on every call. For the schemas
+    of the worker api this takes much longer than the validation itself.
+    """
+
+    __slots__ = ("__compiled", "__name", "__subs")
+
+    def __init__(self, schema, name="object", subs=None):
+        self.__compiled = vtjson.compile(schema)
+        self.__name = name
+        # vtjson compiles the substituted schemas on every use too.
+        self.__subs = {
+            label: vtjson.compile(sub) for label, sub in (subs or {}).items()
+        }
+
+    def __call__(self, obj, name=None):
+        message = self.__compiled.__validate__(
+            obj,
+            name=self.__name if name is None else name,
+            strict=True,
+            subs=self.__subs,
+        )
+        if message != "":
+            raise ValidationError(message)
+
+
+validate_api_access = Validator(api_access_schema, "request")
+validate_api_request = Validator(api_schema, "request")
+validate_api_update_task = Validator(api_update_task_schema, "request")
+validate_api_beat = Validator(api_beat_schema, "request")
+validate_gzip_data = Validator(gzip_data, "pgn")
+validate_action = Validator(action_schema, "action")
+validate_stats_journal = Validator(stats_journal_schema, "stats_journal")
+validate_spsa_history = Validator(spsa_history_schema, "spsa_history")
+validate_pgns = Validator(pgns_schema, "pgn")
+validate_run_cache = Validator(cache_schema, "run_cache", subs={"runs_schema": dict})
+
+_validate_run = Validator(runs_schema, "run")
+_validate_run_without_tasks = Validator(runs_schema_without_tasks, "run")
+_validate_task = Validator(task_schema, "task")
+
+
+def validate_run(run, task_ids=None):
+    """Validate a run. If task_ids is not None, only the tasks with these
+    ids are validated, the others only have to be dicts (they are still
+    used in the consistency checks of the run). This is for runs whose
+    other tasks did not change since they were validated, as validating
+    all the tasks of a large run is slow."""
+    if task_ids is None:
+        _validate_run(run)
+        return
+    _validate_run_without_tasks(run)
+    for task_id in task_ids:
+        _validate_task(run["tasks"][task_id], name=f"run['tasks'][{task_id}]")
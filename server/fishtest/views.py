@@ -25,7 +25,6 @@ import regex
 import requests
 from fastapi import APIRouter
 from markupsafe import Markup
-from starlette.concurrency import run_in_threadpool
 from starlette.exceptions import HTTPException as StarletteHTTPException
 from starlette.requests import Request  # noqa: TC002
 from starlette.responses import HTMLResponse, RedirectResponse, Response
@@ -52,6 +51,7 @@ from fishtest.http.dependencies import (
     get_userdb,
     get_workerdb,
 )
+from fishtest.http.metrics import run_in_threadpool
 from fishtest.http.open_graph import (
     build_actions_open_graph,
     build_tests_view_open_graph,
@@ -112,7 +112,6 @@ from fishtest.schemas import (
     RUN_VERSION,
     github_repo_input,
     is_undecided,
-    runs_schema,
     short_worker_name,
 )
 from fishtest.spsa_workflow import build_spsa_form_values, format_spsa_value
@@ -123,7 +122,6 @@ from fishtest.util import (
     format_group,
     format_results,
     format_time_ago,
-    get_chi2,
     get_tc_ratio,
     is_sprt_ltc_data,
     password_strength,
@@ -133,6 +131,7 @@ from fishtest.util import (
     supported_compilers,
     tests_repo,
 )
+from fishtest.validators import validate_run
 from fishtest.views_actions import actions as _actions_impl
 from fishtest.views_finished import get_paginated_finished_runs
 from fishtest.views_helpers import (
@@ -2653,7 +2652,7 @@ def tests_delete(request: _ViewContext) -> RedirectResponse | dict[str, Any]:
         request.rundb.set_inactive_run(run)
         run["deleted"] = True
         try:
-            validate(runs_schema, run, "run")
+            validate_run(run)
         except ValidationError as e:
             message = (
                 f"The run object {request.POST['run-id']} does not validate: {e!s}"
@@ -3399,7 +3398,7 @@ def _build_tests_view_detail_context(
         **_build_tests_view_status_context(run),
         "run_args": _build_tests_view_run_args(run),
         "approver": request.has_permission("approve_run"),
-        "chi2": get_chi2(run["tasks"]),
+        "chi2": request.rundb.get_chi2(run),
         "document_size": len(bson.BSON.encode(run)),
         "spsa_data": request.rundb.spsa_handler.get_spsa_data(run_id),
         "spsa_percentage_checked": read_cookie_bool(
@@ -3466,7 +3465,7 @@ def tests_tasks(request: _ViewContext) -> dict[str, Any] | Response:
     run = request.rundb.get_run(request.matchdict["id"])
     if run is None:
         raise StarletteHTTPException(status_code=404)
-    chi2 = get_chi2(run["tasks"])
+    chi2 = request.rundb.get_chi2(run)
     show_task = _parse_show_task_param(request)
 
     context = _task_table_state(
@@ -0,0 +1,113 @@
+"""Test the snapshot of the unfinished runs."""
+
+import contextlib
+import io
+import json
+import unittest
+from datetime import UTC, datetime, timedelta
+
+from bson.objectid import ObjectId
+
+from fishtest.active_runs_snapshot import ActiveRunsSnapshot, lightweight_run
+
+
+def make_run(username="user00"):
+    # MongoDB stores the times with a millisecond precision.
+    now = datetime.now(UTC).replace(microsecond=0)
+    return {
+        "_id": ObjectId(),
+        "start_time": now,
+        "last_updated": now,
+        "args": {
+            "username": username,
+            "spsa": {"iter": 2, "param_history": [[{"theta": 1}]]},
+        },
+        "results": {"wins": 1, "losses": 2, "draws": 3},
+        "tasks": [{"num_games": 10}],
+        "bad_tasks": [],
+    }
+
+
+class CreateActiveRunsSnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.kvstore = {}
+        self.runs = [make_run(), make_run(username="user01")]
+        self.builds = 0
+        self.snapshots = ActiveRunsSnapshot(self.kvstore, self.build)
+
+    def build(self):
+        self.builds += 1
+        return [lightweight_run(run) for run in self.runs]
+
+    def test_lightweight_run(self):
+        run = lightweight_run(self.runs[0])
+        self.assertNotIn("tasks", run)
+        self.assertNotIn("bad_tasks", run)
+        self.assertEqual(run["args"]["spsa"], {"iter": 2})
+        self.assertIn("param_history", self.runs[0]["args"]["spsa"])
+
+    def test_get_and_invalidate(self):
+        snapshot = self.snapshots.get()
+        self.assertIs(self.snapshots.get(), snapshot)
+        self.assertEqual(self.builds, 1)
+        body = json.loads(snapshot.body)
+        run_id = str(self.runs[0]["_id"])
+        self.assertEqual(body[run_id]["_id"], run_id)
+        self.assertEqual(body[run_id]["start_time"], str(self.runs[0]["start_time"]))
+
+        self.snapshots.invalidate()
+        self.assertEqual(self.snapshots.get().etag, snapshot.etag)
+        self.assertEqual(self.builds, 2)
+        self.runs[0]["results"]["wins"] += 1
+        self.snapshots.invalidate()
+        self.assertNotEqual(self.snapshots.get().etag, snapshot.etag)
+
+    def test_aggregate(self):
+        snapshot = self.snapshots.get()
+        calls = []
+
+        def compute(runs):
+            calls.append(len(runs))
+            return len(runs)
+
+        self.assertEqual(snapshot.aggregate("", compute), 2)
+        self.assertEqual(snapshot.aggregate("", compute), 2)
+        self.assertEqual(snapshot.aggregate("user01", compute), 1)
+        self.assertEqual(calls, [2, 1])
+
+    def test_publish_and_load(self):
+        secondary = ActiveRunsSnapshot(self.kvstore, None)
+        self.assertIsNone(secondary.load(max_age=60))
+        self.snapshots.publish()
+        snapshot = secondary.load(max_age=60)
+        self.assertEqual(snapshot.body, self.snapshots.get().body)
+        self.assertIs(secondary.load(max_age=60), snapshot)
+        value = self.kvstore[ActiveRunsSnapshot.KVSTORE_KEY]
+        value["time"] -= timedelta(seconds=61)
+        self.assertIsNone(secondary.load(max_age=60))
+
+    def test_publish_compressed(self):
+        self.runs[0]["args"]["spsa"]["params"] = [
+            {"name": f"p{i}", "theta": 0.0, "c": 1.0} for i in range(1000)
+        ]
+        self.snapshots.publish()
+        value = self.kvstore[ActiveRunsSnapshot.KVSTORE_KEY]
+        self.assertIsInstance(value["runs_zlib"], bytes)
+        self.assertLess(len(value["runs_zlib"]), len(self.snapshots.get().body) // 4)
+        snapshot = ActiveRunsSnapshot(self.kvstore, None).load(max_age=60)
+        self.assertEqual(snapshot.runs, self.snapshots.get().runs)
+
+    def test_publish_failure(self):
+        class FailingStore(dict):
+            def __setitem__(self, key, value):
+                raise ValueError("document too large")
+
+        snapshots = ActiveRunsSnapshot(FailingStore(), self.build)
+        with contextlib.redirect_stdout(io.StringIO()) as out:
+            snapshots.publish()
+        self.assertIn("Unable to publish", out.getvalue())
+        self.assertIsNotNone(snapshots.get())
+
+
+if __name__ == "__main__":
+    unittest.main()
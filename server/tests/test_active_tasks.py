@@ -0,0 +1,54 @@
+"""Test the per run index of the active tasks."""
+
+import unittest
+
+from bson.objectid import ObjectId
+
+from fishtest.active_tasks import ActiveTasks
+
+
+def make_task(concurrency, nps, active=True):
+    return {
+        "active": active,
+        "worker_info": {"concurrency": concurrency, "nps": nps},
+    }
+
+
+class CreateActiveTasksTest(unittest.TestCase):
+    def setUp(self):
+        self.active_tasks = ActiveTasks()
+        self.run = {
+            "_id": ObjectId(),
+            "args": {"tc": "10+0.1", "threads": 1},
+            "tasks": [
+                make_task(4, 1000000, active=False),
+                make_task(8, 500000),
+                make_task(2, 0),
+            ],
+        }
+        self.run_id = str(self.run["_id"])
+        for task_id in range(len(self.run["tasks"])):
+            self.active_tasks.update(self.run, task_id)
+
+    def test_task_ids_and_totals(self):
+        self.assertEqual(self.active_tasks.task_ids(self.run_id), [1, 2])
+        nps, games_per_minute = self.active_tasks.totals(self.run_id)
+        self.assertEqual(nps, 8 * 500000.0)
+        self.assertAlmostEqual(
+            games_per_minute,
+            ActiveTasks.contribution(self.run, self.run["tasks"][1])[1],
+        )
+
+    def test_refresh_and_remove(self):
+        self.run["tasks"][1]["worker_info"]["nps"] = 250000
+        self.active_tasks.update(self.run, 1)
+        self.assertEqual(self.active_tasks.totals(self.run_id)[0], 8 * 250000.0)
+        self.run["tasks"][2]["active"] = False
+        self.active_tasks.update(self.run, 2)
+        self.active_tasks.remove(self.run_id, 1)
+        self.assertEqual(self.active_tasks.task_ids(self.run_id), [])
+        self.assertEqual(self.active_tasks.totals(self.run_id), (0.0, 0.0))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -5,7 +5,9 @@ import base64
 import copy
 import gzip
 import io
+import json
 import sys
+import tarfile
 import unittest
 from datetime import UTC, datetime
 
@@ -407,6 +409,27 @@ class TestHttpApi(unittest.TestCase):
         self.assertEqual(run["cores"], self.worker_info["concurrency"])
         self.assertTrue(run["tasks"][body["task_id"]]["active"])
 
+    def test_request_task_same_name_in_progress_is_rejected(self):
+        if worker_name is None:  # pragma: no cover
+            raise unittest.SkipTest("worker_name import missing")
+
+        self._stop_all_runs()
+        self._create_run()
+        worker_short = worker_name(self.worker_info, short=True)
+        # Another worker with the same name is requesting a task.
+        self.rundb.request_task_workers[worker_short] = "another unique key"
+        try:
+            response = self.client.post(
+                "/api/request_task",
+                json=self._payload(password=self.password),
+            )
+        finally:
+            del self.rundb.request_task_workers[worker_short]
+
+        self.assertEqual(response.status_code, 200)
+        body = response.json()
+        self.assertIn("is requesting a task", body["error"])
+
     def test_request_task_blocked_worker_is_application_error(self):
         if worker_name is None:  # pragma: no cover
             raise unittest.SkipTest("worker_name import missing")
@@ -876,12 +899,78 @@ class TestHttpApi(unittest.TestCase):
             path="/api/upload_pgn",
         )
 
+    def _post_pgn_stream(self, payload, content):
+        return self.client.post(
+            "/api/upload_pgn_stream",
+            content=json.dumps(payload).encode() + b"\n" + content,
+            headers={"content-type": "application/octet-stream"},
+        )
+
+    def test_upload_pgn_stream_ok(self):
+        run_id, task_id = self._create_run_with_task()
+        pgn_zip = base64.b64decode(self._build_pgn_payload(run_id, task_id))
+        response = self._post_pgn_stream(
+            {
+                **self._payload(password=self.password),
+                "run_id": run_id,
+                "task_id": task_id,
+            },
+            pgn_zip,
+        )
+        self.assertEqual(response.status_code, 200)
+        body = response.json()
+        self.assertTrue(isinstance(body.get("duration"), (int, float)))
+        self.assertEqual(
+            self.rundb.get_pgn(f"{run_id}-{task_id}"), (pgn_zip, len(pgn_zip))
+        )
+
+    def test_upload_pgn_stream_errors(self):
+        run_id, task_id = self._create_run_with_task()
+        pgn_zip = base64.b64decode(self._build_pgn_payload(run_id, task_id))
+        payload = {
+            **self._payload(password=self.password),
+            "run_id": run_id,
+            "task_id": task_id,
+        }
+        response = self._post_pgn_stream(
+            {**payload, "password": "wrong password"}, pgn_zip
+        )
+        self._assert_worker_error_response(
+            response, status_code=401, path="/api/upload_pgn_stream"
+        )
+        response = self._post_pgn_stream(payload, b"not-gzip")
+        self._assert_worker_error_response(
+            response, status_code=400, path="/api/upload_pgn_stream"
+        )
+        response = self.client.post("/api/upload_pgn_stream", content=pgn_zip)
+        self._assert_worker_error_response(
+            response,
+            status_code=400,
+            path="/api/upload_pgn_stream",
+            contains="request is not json encoded",
+        )
+        # The request must end within PGN_UPLOAD_REQUEST_MAX_SIZE_BYTES.
+        response = self._post_pgn_stream(
+            {**payload, "padding": 64 * 1024 * " "}, pgn_zip
+        )
+        self._assert_worker_error_response(
+            response,
+            status_code=400,
+            path="/api/upload_pgn_stream",
+            contains="request is not json encoded",
+        )
+
     def test_get_active_runs(self):
         run_id = self._create_run()
         response = self.client.get("/api/active_runs")
         self.assertEqual(response.status_code, 200)
         body = response.json()
         self.assertIn(run_id, body)
+        etag = response.headers.get("etag")
+        self.assertIsNotNone(etag)
+        response = self.client.get("/api/active_runs", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers.get("etag"), etag)
 
     def test_actions_post(self):
         response = self.client.post("/api/actions", json={})
@@ -931,6 +1020,44 @@ class TestHttpApi(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertFalse(response.json())
 
+    def test_get_elo_batch(self):
+        run_id = self._create_run()
+        sprt_run_id = self._create_run()
+        run = self.rundb.get_run(sprt_run_id)
+        run["args"]["sprt"] = {
+            "alpha": 0.05,
+            "beta": 0.05,
+            "elo0": 0.0,
+            "elo1": 2.0,
+            "elo_model": "normalized",
+            "state": "",
+            "llr": 0.0,
+        }
+        run["results"] = {
+            "wins": 1200,
+            "losses": 1100,
+            "draws": 3700,
+            "pentanomial": [40, 700, 1400, 800, 60],
+        }
+        unknown_run_id = "0" * 24
+        response = self.client.get(
+            "/api/get_elo_batch",
+            params={"ids": f"{run_id},{sprt_run_id},{unknown_run_id}"},
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers.get("access-control-allow-origin"), "*")
+        elos = response.json()
+        self.assertEqual(elos[run_id], {})
+        self.assertIsNone(elos[unknown_run_id])
+        self.assertEqual(elos[sprt_run_id]["sprt"]["elo_model"], "normalized")
+        self.assertEqual(elos[sprt_run_id]["results"], run["results"])
+        lower, upper = elos[sprt_run_id]["elo"]["ci"]
+        self.assertLess(lower, elos[sprt_run_id]["elo"]["elo"])
+        self.assertLess(elos[sprt_run_id]["elo"]["elo"], upper)
+
+        response = self.client.get("/api/get_elo_batch")
+        self.assertEqual(response.status_code, 400)
+
     def test_duplicate_workers(self):
         self._stop_all_runs()
         self._create_run(num_games=400)
@@ -1045,6 +1172,69 @@ class TestHttpApi(unittest.TestCase):
         self.assertEqual(response.headers.get("content-type"), "application/gzip")
         self.assertEqual(len(response.content), len(pgn_a) + len(pgn_b))
 
+    def test_download_run_pgns_sorted_by_task_id(self):
+        run_id = "0123456789abcdef01234567"
+        pgns = {task_id: gzip.compress(f"{task_id}".encode()) for task_id in (10, 2)}
+        for task_id, pgn_zip in pgns.items():
+            self.rundb.upload_pgn(f"{run_id}-{task_id}", pgn_zip)
+        pgn = self.rundb.pgndb.find_one({"run_id": f"{run_id}-10"})
+        self.assertEqual((pgn["run"], pgn["task_id"]), (run_id, 10))
+
+        response = self.client.get(f"/api/run_pgns/{run_id}.pgn.gz")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, pgns[2] + pgns[10])
+
+    def test_download_run_pgns_tar(self):
+        run_id = "0123456789abcdef01234567"
+        pgns = {task_id: gzip.compress(f"{task_id}".encode()) for task_id in (10, 2)}
+        for task_id, pgn_zip in pgns.items():
+            self.rundb.upload_pgn(f"{run_id}-{task_id}", pgn_zip)
+
+        response = self.client.get(f"/api/run_pgns/{run_id}.pgn.gz?format=tar")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers.get("content-type"), "application/x-tar")
+        self.assertEqual(
+            response.headers.get("content-length"), str(len(response.content))
+        )
+        with tarfile.open(fileobj=io.BytesIO(response.content)) as tar:
+            self.assertEqual(
+                tar.getnames(),
+                [f"{run_id}-2.pgn.gz", f"{run_id}-10.pgn.gz", "index.json"],
+            )
+            index = json.load(tar.extractfile("index.json"))
+        self.assertEqual([task["task_id"] for task in index["tasks"]], [2, 10])
+        for task in index["tasks"]:
+            data = response.content[task["offset"] : task["offset"] + task["size"]]
+            self.assertEqual(data, pgns[task["task_id"]])
+
+        response = self.client.get(f"/api/run_pgns/{run_id}.pgn.gz?format=zip")
+        self.assertEqual(response.status_code, 400)
+
+    def test_download_run_pgns_not_migrated(self):
+        run_id = "0123456789abcdef01234567"
+        legacy = gzip.compress(b"legacy")
+        # A pgn stored before the run and task_id fields were added.
+        self.rundb.pgndb.insert_one(
+            {"run_id": f"{run_id}-3", "pgn_zip": legacy, "size": len(legacy)}
+        )
+        self.rundb.pgndb.insert_one(
+            {"run_id": f"{run_id}0-3", "pgn_zip": legacy, "size": len(legacy)}
+        )
+        pgn_zip = gzip.compress(b"migrated")
+        self.rundb.upload_pgn(f"{run_id}-1", pgn_zip)
+
+        response = self.client.get(f"/api/run_pgns/{run_id}.pgn.gz")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, legacy + pgn_zip)
+
+        response = self.client.get(f"/api/run_pgns/{run_id}.pgn.gz?format=tar")
+        self.assertEqual(response.status_code, 200)
+        with tarfile.open(fileobj=io.BytesIO(response.content)) as tar:
+            index = json.load(tar.extractfile("index.json"))
+        self.assertEqual([task["task_id"] for task in index["tasks"]], [3, 1])
+
     def test_download_pgn_streaming_response(self):
         run_id = "0123456789abcdef01234567-0"
         raw_pgn = b"pgn-bytes"
@@ -80,6 +80,7 @@ class TestHttpApp(unittest.TestCase):
             }
             self.assertIn("ShutdownGuardMiddleware", middleware_names)
             self.assertIn("AttachRequestStateMiddleware", middleware_names)
+            self.assertIn("MetricsMiddleware", middleware_names)
             self.assertIn("RejectNonPrimaryWorkerApiMiddleware", middleware_names)
             self.assertIn("RedirectBlockedUiUsersMiddleware", middleware_names)
 
@@ -0,0 +1,81 @@
+"""Test that the incremental chi2 aggregate agrees with get_chi2()."""
+
+import math
+import random
+import unittest
+
+from bson.objectid import ObjectId
+
+from fishtest.chi2_cache import Chi2Cache
+from fishtest.util import get_bad_workers, get_chi2
+
+
+def make_task(unique_key, pentanomial):
+    return {
+        "worker_info": {"unique_key": unique_key},
+        "stats": {"pentanomial": pentanomial},
+    }
+
+
+def random_pentanomial(rng, pairs, bias=0.0):
+    weights = [0.05, 0.2, 0.5 - bias, 0.2 + bias, 0.05]
+    counts = 5 * [0]
+    for index in rng.choices(range(5), weights=weights, k=pairs):
+        counts[index] += 1
+    return counts
+
+
+class CreateChi2CacheTest(unittest.TestCase):
+    def setUp(self):
+        self.rng = random.Random(42)
+        self.cache = Chi2Cache()
+        self.run = {
+            "_id": ObjectId(),
+            "tasks": [
+                make_task(f"worker{i % 8}", random_pentanomial(self.rng, 200))
+                for i in range(40)
+            ],
+        }
+
+    def assertChi2Equal(self, cached, expected):
+        self.assertEqual(cached["dof"], expected["dof"])
+        self.assertTrue(math.isclose(cached["chi2"], expected["chi2"]))
+        self.assertEqual(cached["residual"].keys(), expected["residual"].keys())
+        for key, residual in expected["residual"].items():
+            self.assertTrue(math.isclose(cached["residual"][key], residual))
+
+    def test_memoization(self):
+        chi2 = self.cache.get_chi2(self.run)
+        self.assertChi2Equal(chi2, get_chi2(self.run["tasks"]))
+        self.assertIs(self.cache.get_chi2(self.run), chi2)
+
+    def test_incremental_updates(self):
+        self.cache.get_chi2(self.run)
+        self.run["tasks"].append(
+            make_task("worker3", random_pentanomial(self.rng, 400, bias=0.2))
+        )
+        self.cache.update_task(self.run, 40)
+        self.run["tasks"][5]["stats"]["pentanomial"] = random_pentanomial(self.rng, 300)
+        self.cache.update_task(self.run, 5)
+        self.run["tasks"][7]["bad"] = True
+        self.cache.update_task(self.run, 7)
+        self.assertChi2Equal(self.cache.get_chi2(self.run), get_chi2(self.run["tasks"]))
+
+    def test_bad_workers(self):
+        for task in self.run["tasks"][:5]:
+            task["worker_info"]["unique_key"] = "cheater"
+            task["stats"]["pentanomial"] = random_pentanomial(self.rng, 200, bias=0.3)
+        chi2 = self.cache.get_chi2(self.run)
+        self.assertEqual(
+            get_bad_workers(
+                self.run["tasks"],
+                cached_chi2=chi2,
+                iters=3,
+                worker_stats=self.cache.worker_stats(self.run),
+            ),
+            get_bad_workers(self.run["tasks"], iters=3),
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,6 +1,7 @@
 # ruff: noqa: ANN201, ANN206, D100, D101, D102, E501, INP001, PLC0415, PT009
 """Test HTTP boundary shims, template context, and fragment behavior."""
 
+import gzip
 import re
 import tempfile
 import unittest
@@ -241,6 +242,37 @@ class TestHttpBoundary(unittest.TestCase):
         self.assertTrue(body["error"])
         self.assertIsNone(body["body"])
 
+    def test_json_body_gzip(self):
+        from fishtest.http.boundary import (
+            JsonBodyResult,
+            get_json_body,
+            gunzip_body,
+        )
+
+        app = self._build_app()
+
+        @app.post("/json")
+        async def _json_probe(result: JsonBodyResult = Depends(get_json_body)):
+            return {"error": result.error, "body": result.body}
+
+        client = self.TestClient(app)
+        response = client.post(
+            "/json",
+            content=gzip.compress(b'{"ok": true}'),
+            headers={"content-type": "application/json", "content-encoding": "gzip"},
+        )
+        self.assertEqual(response.json(), {"error": False, "body": {"ok": True}})
+
+        response = client.post(
+            "/json",
+            content=b'{"ok": true}',
+            headers={"content-type": "application/json", "content-encoding": "gzip"},
+        )
+        self.assertTrue(response.json()["error"])
+
+        with self.assertRaises(ValueError):
+            gunzip_body(gzip.compress(b" " * 101), max_size=100)
+
     def test_dispatch_view_204_has_no_body(self):
         from fishtest.views import _dispatch_view
 
@@ -259,25 +259,9 @@ class ErrorHandlerWorkerPathsTests(unittest.TestCase):
 
 
 class BlockedUserCacheTests(unittest.TestCase):
-    @staticmethod
-    def _restore_blocked_cache(cache_obj, timestamp, value):
-        cache_obj.timestamp = timestamp
-        cache_obj.value = value
-
     def test_blocked_cache_uses_ttl(self):
-        from fishtest.http.middleware import _blocked_cache
-
-        original_timestamp = _blocked_cache.timestamp
-        original_value = _blocked_cache.value
-        self.addCleanup(
-            self._restore_blocked_cache,
-            _blocked_cache,
-            original_timestamp,
-            original_value,
-        )
-
-        _blocked_cache.timestamp = None
-        _blocked_cache.value = None
+        _get_blocked_cached.cache_clear()
+        self.addCleanup(_get_blocked_cached.cache_clear)
 
         class FakeUserDb:
             def __init__(self):
@@ -289,14 +273,18 @@ class BlockedUserCacheTests(unittest.TestCase):
 
         userdb = FakeUserDb()
 
-        with mock.patch("time.monotonic", side_effect=[1.0, 1.5, 5.0]):
+        now = [1.0]
+        with mock.patch("time.monotonic", lambda: now[0]):
             first = _get_blocked_cached(userdb)
+            now[0] = 1.5
             second = _get_blocked_cached(userdb)
+            now[0] = 5.0
             third = _get_blocked_cached(userdb)
 
         self.assertEqual(first, second)
         self.assertEqual(first, third)
         self.assertEqual(userdb.calls, 2)
+        self.assertEqual(_get_blocked_cached.cache_info().hits, 1)
 
 
 class HttpCacheHeaderTests(unittest.TestCase):
@@ -44,19 +44,10 @@ class TestHttpMiddleware(unittest.TestCase):
         cls.FastAPI, cls.TestClient = test_support.require_fastapi()
 
     def setUp(self):
-        from fishtest.http.middleware import _blocked_cache
+        from fishtest.http.middleware import _get_blocked_cached
 
-        original_timestamp = _blocked_cache.timestamp
-        original_value = _blocked_cache.value
-
-        def _restore_cache_state():
-            _blocked_cache.timestamp = original_timestamp
-            _blocked_cache.value = original_value
-
-        self.addCleanup(_restore_cache_state)
-
-        _blocked_cache.timestamp = None
-        _blocked_cache.value = None
+        _get_blocked_cached.cache_clear()
+        self.addCleanup(_get_blocked_cached.cache_clear)
 
     def test_shutdown_guard_returns_503(self):
         rundb = _RunDbStub(shutdown=True)
@@ -200,6 +191,55 @@ class TestHttpMiddleware(unittest.TestCase):
         response = client.head("/submit")
         self.assertEqual(response.status_code, 405)
 
+    def test_metrics_middleware_records_route_and_status(self):
+        from fishtest.http.metrics import router
+        from fishtest.http.middleware import HeadMethodMiddleware, MetricsMiddleware
+
+        app = self.FastAPI()
+        app.add_middleware(HeadMethodMiddleware)
+        app.add_middleware(MetricsMiddleware)
+        app.include_router(router)
+
+        @app.get("/items/{item_id}")
+        async def _item(item_id: int):
+            return {"item_id": item_id}
+
+        client = self.TestClient(app, client=("127.0.0.1", 50000))
+        client.get("/items/1")
+        client.head("/items/2")
+        client.get("/no/such/page")
+        response = client.get("/metrics")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(
+            'fishtest_http_requests_total{method="GET",route="/items/{item_id}",'
+            'status="200"}',
+            response.text,
+        )
+        self.assertIn(
+            'fishtest_http_requests_total{method="HEAD",route="/items/{item_id}",'
+            'status="200"}',
+            response.text,
+        )
+        self.assertIn(
+            'fishtest_http_requests_total{method="GET",route="unmatched",status="404"}',
+            response.text,
+        )
+        self.assertIn("fishtest_http_request_duration_seconds_bucket", response.text)
+
+    def test_metrics_endpoint_is_local_only(self):
+        from fishtest.http.metrics import router
+
+        app = self.FastAPI()
+        app.include_router(router)
+
+        client = self.TestClient(app, client=("127.0.0.1", 50000))
+        response = client.get("/metrics", headers={"X-Forwarded-For": "192.0.2.1"})
+        self.assertEqual(response.status_code, 404)
+
+        client = self.TestClient(app, client=("192.0.2.1", 50000))
+        response = client.get("/metrics")
+        self.assertEqual(response.status_code, 404)
+
 
 class TestHttpMiddlewareMongo(unittest.TestCase):
     @classmethod
@@ -230,13 +270,12 @@ class TestHttpMiddlewareMongo(unittest.TestCase):
 
     def test_redirect_blocked_ui_users_with_real_userdb(self):
         from fishtest.http.cookie_session import SESSION_COOKIE_NAME
-        from fishtest.http.middleware import _blocked_cache
+        from fishtest.http.middleware import _get_blocked_cached
 
         username = "httpmwblocked"
         self.rundb.userdb.users.delete_many({"username": username})
         self.rundb.userdb.clear_cache()
-        _blocked_cache.timestamp = None
-        _blocked_cache.value = None
+        _get_blocked_cached.cache_clear()
 
         self.rundb.userdb.create_user(
             username,
@@ -270,13 +309,12 @@ class TestHttpMiddlewareMongo(unittest.TestCase):
 
     def test_allows_non_blocked_ui_user_with_real_userdb(self):
         from fishtest.http.cookie_session import SESSION_COOKIE_NAME
-        from fishtest.http.middleware import _blocked_cache
+        from fishtest.http.middleware import _get_blocked_cached
 
         username = "httpmwallowed"
         self.rundb.userdb.users.delete_many({"username": username})
         self.rundb.userdb.clear_cache()
-        _blocked_cache.timestamp = None
-        _blocked_cache.value = None
+        _get_blocked_cached.cache_clear()
 
         self.rundb.userdb.create_user(
             username,
@@ -1,5 +1,6 @@
 """Test LRU cache storage, eviction, and decorator behavior."""
 
+import os
 import threading
 import time
 import unittest
@@ -11,7 +12,7 @@ class CreateLRUCacheTest(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
         cls.maxsize = 10
-        cls.lru_cache = LRUCache()
+        cls.lru_cache = LRUCache(ttls=(0.1, 10))
 
     def setUp(self):
         self.lru_cache.maxsize = self.maxsize
@@ -174,6 +175,54 @@ class CreateLRUCacheTest(unittest.TestCase):
         with self.assertRaises(KeyError):
             self.lru_cache["a"]
 
+    def test_lru_cache_ttl(self):
+        self.lru_cache.set("a", 1, ttl=0.1)
+        self.lru_cache["b"] = 2
+        self.lru_cache.set("c", 3, ttl=10)
+        time.sleep(0.2)
+        self.assertNotIn("a", self.lru_cache)
+        self.assertEqual(list(self.lru_cache.items()), [("b", 2), ("c", 3)])
+
+        self.lru_cache.clear()
+        self.lru_cache.expiration = 0.1
+        self.lru_cache.set("a", 1, ttl=10)
+        self.lru_cache["b"] = 2
+        self.lru_cache.set("c", 3, ttl=0.1)
+        self.lru_cache.set("c", 3)  # back to the expiration of the cache
+        time.sleep(0.2)
+        self.assertEqual(list(self.lru_cache.items()), [("a", 1)])
+        self.lru_cache.expiration = None
+        self.lru_cache["b"] = 2
+        self.assertEqual(len(self.lru_cache), 2)
+
+    def test_lru_cache_ttl_allowed(self):
+        with self.assertRaises(ValueError):
+            self.lru_cache.set("a", 1, ttl=0.2)
+        self.assertNotIn("a", self.lru_cache)
+        with self.assertRaises(ValueError):
+            LRUCache().set("a", 1, ttl=10)
+
+    def test_lru_cache_ttl_maxsize(self):
+        for i in range(self.maxsize + 1):
+            self.lru_cache.set(str(i), i, ttl=10 if i % 2 else None)
+        self.assertEqual(len(self.lru_cache), self.maxsize)
+        self.assertNotIn("0", self.lru_cache)
+        self.lru_cache.maxsize = 1
+        self.assertEqual(list(self.lru_cache.items()), [(str(self.maxsize), 10)])
+
+    def test_lru_cache_expiration_purge(self):
+        self.lru_cache.maxsize = None
+        self.lru_cache.expiration = 0.1
+        for i in range(1000):
+            self.lru_cache[i] = i
+        time.sleep(0.05)
+        self.lru_cache[0]  # refreshes the oldest entry
+        self.assertEqual(len(self.lru_cache), 1000)
+        time.sleep(0.07)
+        self.assertEqual(list(self.lru_cache.items()), [(0, 0)])
+        time.sleep(0.05)
+        self.assertEqual(list(self.lru_cache.keys()), [])
+
     def test_lru_cache_lock(self):
         self.lru_cache.maxsize = 1
         self.lru_cache["a"] = 1
@@ -472,3 +521,172 @@ class CreateLRUCacheTest(unittest.TestCase):
         self.assertIn("good", worker2.cache)
         worker2("bad")
         self.assertNotIn("bad", worker2.cache)
+
+    def test_lru_cache_decorator_single_flight(self):
+        calls = 0
+        release = threading.Event()
+
+        @lru_cache(expiration=10, single_flight=True)
+        def worker():
+            nonlocal calls
+            calls += 1
+            release.wait()
+            return calls
+
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(worker())) for _ in range(8)
+        ]
+        for t in threads:
+            t.start()
+        deadline = time.monotonic() + 5
+        while worker.cache_info().waits < 7 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        release.set()
+        for t in threads:
+            t.join()
+        self.assertEqual(calls, 1)
+        self.assertEqual(results, [1] * 8)
+        self.assertEqual(worker(), 1)
+        info = worker.cache_info()
+        self.assertEqual((info.hits, info.misses, info.waits), (1, 1, 7))
+        worker.cache_clear()
+        self.assertEqual(worker.cache_info().misses, 0)
+
+    def test_lru_cache_decorator_single_flight_exception(self):
+        release = threading.Event()
+
+        @lru_cache(single_flight=True)
+        def worker():
+            release.wait()
+            raise ValueError("no value")
+
+        errors = []
+
+        def call():
+            try:
+                worker()
+            except ValueError as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=call) for _ in range(4)]
+        for t in threads:
+            t.start()
+        deadline = time.monotonic() + 5
+        while worker.cache_info().waits < 3 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        release.set()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(errors), 4)
+        self.assertEqual(len(worker.cache), 0)
+
+    def test_lru_cache_decorator_stale_while_revalidate(self):
+        calls = 0
+        started = threading.Event()
+        release = threading.Event()
+
+        @lru_cache(expiration=0.1, refresh=False, stale_while_revalidate=10)
+        def worker():
+            nonlocal calls
+            calls += 1
+            if calls > 1:
+                started.set()
+                release.wait()
+            return calls
+
+        self.assertEqual(worker(), 1)
+        time.sleep(0.15)  # value is stale
+        refresher = threading.Thread(target=worker)
+        refresher.start()
+        self.assertTrue(started.wait(5))
+        self.assertEqual(worker(), 1)  # served while refreshing
+        release.set()
+        refresher.join()
+        self.assertEqual(worker(), 2)
+        info = worker.cache_info()
+        self.assertEqual((info.hits, info.misses, info.stale), (1, 2, 1))
+
+        with self.assertRaises(ValueError):
+
+            @lru_cache(stale_while_revalidate=10)
+            def worker2():
+                pass
+
+
+@unittest.skipUnless(
+    os.environ.get("FISHTEST_BENCHMARK"), "set FISHTEST_BENCHMARK=1 to run"
+)
+class LRUCacheBenchmark(unittest.TestCase):
+    duration = 0.5
+
+    def run_threads(self, cache, op, threads):
+        stop = threading.Event()
+        counts = [0] * threads
+
+        def worker(n):
+            i = n
+            while not stop.is_set():
+                for _ in range(100):
+                    op(cache, i)
+                    i += threads
+                counts[n] += 100
+
+        workers = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+        for w in workers:
+            w.start()
+        time.sleep(self.duration)
+        stop.set()
+        for w in workers:
+            w.join()
+        return sum(counts) / self.duration
+
+    def benchmark(self, name, make_cache, op):
+        for threads in (1, 8, 64):
+            ops = self.run_threads(make_cache(), op, threads)
+            print(f"\n{name}, {threads} threads: {ops:,.0f} ops/s", end="")
+
+    def test_get(self):
+        def make_cache():
+            cache = LRUCache(maxsize=1000, expiration=60)
+            for i in range(1000):
+                cache[i] = i
+            return cache
+
+        self.benchmark("get", make_cache, lambda c, i: c[i % 1000])
+        self.benchmark(
+            "get(refresh=False)",
+            make_cache,
+            lambda c, i: c.get(i % 1000, refresh=False),
+        )
+
+    def test_set(self):
+        self.benchmark(
+            "set",
+            lambda: LRUCache(maxsize=1000, expiration=60),
+            lambda c, i: c.__setitem__(i % 2000, i),
+        )
+
+    def test_set_expiring(self):
+        # Every entry expires, and is purged by a later operation.
+        self.benchmark(
+            "set (expiring)",
+            lambda: LRUCache(expiration=0.001),
+            lambda c, i: c.__setitem__(i, i),
+        )
+        ttls = (0.001, 0.002, 0.003, 0.004)
+        self.benchmark(
+            "set (ttl)",
+            lambda: LRUCache(ttls=ttls),
+            lambda c, i: c.set(i, i, ttl=ttls[i % 4]),
+        )
+
+    def test_decorator(self):
+        def make_cache():
+            @lru_cache(maxsize=1000, expiration=60, refresh=False)
+            def square(n):
+                return n * n
+
+            return square
+
+        self.benchmark("lru_cache", make_cache, lambda f, i: f(i % 1000))
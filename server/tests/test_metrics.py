@@ -0,0 +1,94 @@
+"""Test the metrics and their text exposition format."""
+
+import unittest
+from types import SimpleNamespace
+
+from fishtest.metrics import (
+    MONGO_COMMAND_DURATION,
+    Counter,
+    Gauge,
+    Histogram,
+    MongoCommandTimer,
+    render,
+)
+
+
+class MetricsTest(unittest.TestCase):
+    def test_counter(self):
+        counter = Counter(
+            "test_requests_total", "Requests.", labels=("route",), register=False
+        )
+        counter.inc("/b")
+        counter.inc("/a", amount=2)
+        counter.inc("/b")
+        self.assertEqual(
+            counter.render(),
+            [
+                "# HELP test_requests_total Requests.",
+                "# TYPE test_requests_total counter",
+                'test_requests_total{route="/a"} 2',
+                'test_requests_total{route="/b"} 2',
+            ],
+        )
+        with self.assertRaises(ValueError):
+            counter.inc()
+
+    def test_gauge(self):
+        gauge = Gauge("test_depth", 'A "quoted"\nhelp.', register=False)
+        gauge.set(0.5)
+        self.assertEqual(gauge.render()[-1], "test_depth 0.5")
+        gauge.set(3.0)
+        self.assertEqual(gauge.render()[-1], "test_depth 3")
+        labelled = Gauge("test_label", "Labels.", labels=("name",), register=False)
+        labelled.set(1, 'a"b\\c')
+        self.assertEqual(labelled.render()[-1], 'test_label{name="a\\"b\\\\c"} 1')
+
+    def test_histogram(self):
+        histogram = Histogram(
+            "test_duration_seconds",
+            "Durations.",
+            labels=("route",),
+            buckets=(0.1, 1),
+            register=False,
+        )
+        for value in (0.05, 0.1, 0.5, 2):
+            histogram.observe(value, "/a")
+        self.assertEqual(
+            histogram.render()[2:],
+            [
+                'test_duration_seconds_bucket{route="/a",le="0.1"} 2',
+                'test_duration_seconds_bucket{route="/a",le="1"} 3',
+                'test_duration_seconds_bucket{route="/a",le="+Inf"} 4',
+                'test_duration_seconds_sum{route="/a"} 2.65',
+                'test_duration_seconds_count{route="/a"} 4',
+            ],
+        )
+
+    def test_render(self):
+        extra = Gauge("test_extra", "Computed at scrape time.", register=False)
+        extra.set(7)
+        text = render([extra])
+        self.assertTrue(text.endswith("test_extra 7\n"))
+        self.assertIn("# TYPE fishtest_mongo_command_duration_seconds histogram", text)
+        self.assertNotIn("test_extra", render())
+
+    def test_mongo_command_timer(self):
+        timer = MongoCommandTimer()
+        event = SimpleNamespace(command_name="test_find", duration_micros=1500)
+        timer.succeeded(event)
+        timer.failed(event)
+        text = "\n".join(MONGO_COMMAND_DURATION.render())
+        self.assertIn(
+            'fishtest_mongo_command_duration_seconds_count{command="test_find",'
+            'outcome="success"} 1',
+            text,
+        )
+        self.assertIn(
+            'fishtest_mongo_command_duration_seconds_bucket{command="test_find",'
+            'outcome="failure",le="0.0025"} 1',
+            text,
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
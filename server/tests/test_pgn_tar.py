@@ -0,0 +1,59 @@
+"""Test the tar archive of the pgns of a run."""
+
+import gzip
+import io
+import json
+import tarfile
+import unittest
+
+from fishtest.pgn_tar import PgnTar
+
+
+class CreatePgnTarTest(unittest.TestCase):
+    def setUp(self):
+        self.run_id = "0123456789abcdef01234567"
+        self.pgns = []
+        for _id, task_id in enumerate((0, 1, 3)):
+            pgn_zip = gzip.compress(b"1. e4 e5 *\n" * (100 * task_id + 1))
+            self.pgns.append(
+                {
+                    "_id": _id,
+                    "run_id": f"{self.run_id}-{task_id}",
+                    "task_id": task_id,
+                    "size": len(pgn_zip),
+                    "pgn_zip": pgn_zip,
+                }
+            )
+        self.pgn_tar = PgnTar(self.run_id, self.pgns, {0: 10, 1: 20}, 1700000000)
+
+    def test_archive(self):
+        archive = b"".join(self.pgn_tar.iter_blobs(iter(self.pgns)))
+        self.assertEqual(len(archive), self.pgn_tar.size)
+        with tarfile.open(fileobj=io.BytesIO(archive)) as tar:
+            members = tar.getmembers()
+            self.assertEqual(
+                [member.name for member in members],
+                [pgn["run_id"] + ".pgn.gz" for pgn in self.pgns] + ["index.json"],
+            )
+            index = json.load(tar.extractfile("index.json"))
+            for pgn, member in zip(self.pgns, members):
+                self.assertEqual(tar.extractfile(member).read(), pgn["pgn_zip"])
+        self.assertEqual(index["run_id"], self.run_id)
+        self.assertEqual([task["games"] for task in index["tasks"]], [10, 20, None])
+        for pgn, task in zip(self.pgns, index["tasks"]):
+            data = archive[task["offset"] : task["offset"] + task["size"]]
+            self.assertEqual(data, pgn["pgn_zip"])
+
+    def test_later_uploads_are_skipped(self):
+        late = dict(self.pgns[0], _id=10)
+        pgns = [self.pgns[0], late, *self.pgns[1:]]
+        archive = b"".join(self.pgn_tar.iter_blobs(iter(pgns)))
+        self.assertEqual(len(archive), self.pgn_tar.size)
+
+    def test_deleted_pgns(self):
+        with self.assertRaises(RuntimeError):
+            b"".join(self.pgn_tar.iter_blobs(iter(self.pgns[:2])))
+
+
+if __name__ == "__main__":
+    unittest.main()
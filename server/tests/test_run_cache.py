@@ -0,0 +1,162 @@
+"""Test the partial update documents and the flushing of the run cache."""
+
+import time
+import unittest
+
+from bson.objectid import ObjectId
+
+from fishtest.run_cache import (
+    Prio,
+    RunCache,
+    collapse_paths,
+    get_path,
+    update_document,
+)
+
+
+class _RunsStub:
+    def __init__(self):
+        self.bulk_writes = []
+        # The (1-based) numbers of the bulk writes which fail.
+        self.failures = set()
+
+    def bulk_write(self, requests, ordered=True):
+        self.bulk_writes.append(requests)
+        if len(self.bulk_writes) in self.failures:
+            raise RuntimeError("bulk_write failed")
+
+
+class CreateRunCacheUpdateTest(unittest.TestCase):
+    def setUp(self):
+        self.run = {
+            "results": {"wins": 1, "losses": 2, "draws": 3},
+            "tasks": [
+                {"stats": {"wins": 0}, "active": False},
+                {"stats": {"wins": 1}, "active": True, "spsa_params": {"iter": 1}},
+            ],
+            "args": {"spsa": {"iter": 4, "param_history": [[], []]}},
+        }
+
+    def test_get_path(self):
+        self.assertEqual(get_path(self.run, "results.wins"), 1)
+        self.assertEqual(get_path(self.run, "tasks.1.stats"), {"wins": 1})
+        with self.assertRaises(KeyError):
+            get_path(self.run, "tasks.0.spsa_params")
+        with self.assertRaises(IndexError):
+            get_path(self.run, "tasks.2")
+
+    def test_collapse_paths(self):
+        self.assertEqual(
+            collapse_paths({"tasks.1", "tasks.1.stats", "tasks.10.stats", "results"}),
+            {"tasks.1", "tasks.10.stats", "results"},
+        )
+
+    def test_update_document(self):
+        del self.run["tasks"][1]["spsa_params"]
+        update = update_document(
+            self.run,
+            {
+                "results",
+                "tasks.1.stats",
+                "tasks.1.spsa_params",
+                "args.spsa.param_history.1",
+            },
+        )
+        self.assertEqual(
+            update,
+            {
+                "$set": {
+                    "results": self.run["results"],
+                    "tasks.1.stats": {"wins": 1},
+                    "args.spsa.param_history.1": [],
+                },
+                "$unset": {"tasks.1.spsa_params": ""},
+            },
+        )
+        self.assertEqual(update_document(self.run, set()), {})
+
+
+class CreateRunCacheFlushTest(unittest.TestCase):
+    def setUp(self):
+        self.runs = _RunsStub()
+        self.run_cache = RunCache(self.runs, flush_batch_size=2, max_staleness=60.0)
+        self.run_list = []
+        for _ in range(4):
+            run = {"_id": ObjectId(), "results": {"wins": 0}}
+            self.run_list.append(run)
+            self.run_cache.run_cache[str(run["_id"])] = {
+                "is_changed": False,
+                "last_access_time": time.time(),
+                "last_sync_time": time.time(),
+                "priority": 0,
+                "dirty_paths": set(),
+                "run": run,
+            }
+
+    def flushed_ids(self):
+        return [request._filter["_id"] for request in self.runs.bulk_writes[-1]]
+
+    def test_flush_buffers_is_batched_by_priority(self):
+        for run in self.run_list[:3]:
+            self.run_cache.buffer(run, paths=("results",))
+        self.run_cache.buffer(self.run_list[3], priority=Prio.HIGH, paths=("results",))
+        self.run_cache.flush_buffers()
+        self.assertEqual(len(self.runs.bulk_writes), 1)
+        self.assertEqual(len(self.flushed_ids()), 2)
+        self.assertEqual(self.flushed_ids()[0], self.run_list[3]["_id"])
+        self.assertEqual(self.run_cache.flush_stats()["queue_depth"], 2)
+        self.run_cache.flush_buffers()
+        self.run_cache.flush_buffers()
+        self.assertEqual(len(self.runs.bulk_writes), 2)
+        self.assertEqual(self.run_cache.flush_stats()["runs_flushed"], 4)
+
+    def test_flush_buffers_honors_deadlines(self):
+        for run in self.run_list:
+            self.run_cache.buffer(run, paths=("results",))
+        for cache_entry in self.run_cache.run_cache.values():
+            cache_entry["last_sync_time"] -= 61
+        self.run_cache.flush_buffers()
+        self.assertEqual(len(self.flushed_ids()), 4)
+        self.assertEqual(self.run_cache.flush_stats()["queue_depth"], 0)
+
+    def test_active_run_lock(self):
+        run_id = str(self.run_list[0]["_id"])
+        self.assertIs(
+            self.run_cache.active_run_lock(run_id),
+            self.run_cache.active_run_lock(self.run_list[0]["_id"]),
+        )
+        self.assertIs(
+            self.run_cache.active_run_lock("not a run id"),
+            self.run_cache.active_run_lock("not a run id"),
+        )
+
+    def test_flush_all(self):
+        for run in self.run_list:
+            self.run_cache.buffer(run)
+        self.run_cache.flush_all()
+        self.assertEqual(len(self.runs.bulk_writes), 2)
+        self.assertEqual(self.run_cache.flush_stats()["runs_flushed"], 4)
+
+    def test_flush_all_failure(self):
+        for run in self.run_list:
+            self.run_cache.buffer(run, paths=("results",))
+        self.runs.failures = {1}
+        with self.assertRaises(RuntimeError):
+            self.run_cache.flush_all()
+        # The failed batch is dirty again, the other one has been written.
+        self.assertEqual(len(self.runs.bulk_writes), 2)
+        dirty = [
+            cache_entry["dirty_paths"]
+            for cache_entry in self.run_cache.run_cache.values()
+            if cache_entry["is_changed"]
+        ]
+        self.assertEqual(dirty, [None, None])
+        self.run_cache.flush_all()
+        self.assertEqual(len(self.flushed_ids()), 2)
+        self.assertFalse(
+            any(entry["is_changed"] for entry in self.run_cache.run_cache.values())
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
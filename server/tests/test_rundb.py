@@ -11,7 +11,7 @@ from pymongo import DESCENDING
 
 from fishtest.api import WORKER_VERSION
 from fishtest.run_cache import Prio
-from fishtest.spsa_handler import _pack_flips, _unpack_flips
+from fishtest.rundb import RunDb
 
 
 class CreateRunDBTest(unittest.TestCase):
@@ -784,6 +784,14 @@ class CreateRunDBTest(unittest.TestCase):
                 }
             )
 
+    def test_56_stats_journal_primary_only(self):
+        self.assertIsNotNone(self.rundb.stats_journal)
+        secondary = RunDb(db_name="fishtest_tests", is_primary_instance=False)
+        try:
+            self.assertIsNone(secondary.stats_journal)
+        finally:
+            secondary.conn.close()
+
     def test_90_delete_runs(self):
         for run in self.rundb.runs.find():
             if run["args"]["username"] == "TestRunDbUser" and "deleted" not in run:
@@ -794,16 +802,6 @@ class CreateRunDBTest(unittest.TestCase):
                     w["pending"] = False
                 self.rundb.buffer(run, priority=Prio.SAVE_NOW)
 
-    def test_flips(self):
-        random.seed(0)
-        for _ in range(0, 100):
-            L = random.randint(0, 1000)
-            a = [random.choice((-1, 1)) for _ in range(0, L)]
-            b = _pack_flips(a)
-            self.assertTrue(isinstance(b, bytes))
-            c = _unpack_flips(b, length=L)
-            self.assertEqual(a, c)
-
 
 if __name__ == "__main__":
     unittest.main()
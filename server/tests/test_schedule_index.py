@@ -0,0 +1,104 @@
+"""Test the request_task eligibility pre-filter."""
+
+import unittest
+
+from bson.objectid import ObjectId
+
+from fishtest.schedule_index import ScheduleIndex, task_memory_base
+
+
+def make_run(
+    threads=1,
+    hash_new=16,
+    hash_base=16,
+    compiler=None,
+    arch_filter=None,
+    approved=True,
+    finished=False,
+):
+    args = {
+        "threads": threads,
+        "new_options": f"Hash={hash_new}",
+        "base_options": f"Hash={hash_base}",
+    }
+    if compiler is not None:
+        args["compiler"] = compiler
+    if arch_filter is not None:
+        args["arch_filter"] = arch_filter
+    return {
+        "_id": ObjectId(),
+        "args": args,
+        "approved": approved,
+        "finished": finished,
+    }
+
+
+class CreateScheduleIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = ScheduleIndex()
+
+    def candidate_ids(self, *args, **kwargs):
+        return {run_id for run_id, _ in self.index.candidates(*args, **kwargs)}
+
+    def test_update_follows_run_state(self):
+        run = make_run(approved=False)
+        run_id = str(run["_id"])
+        self.index.update(run)
+        self.assertNotIn(run_id, self.index)
+        run["approved"] = True
+        self.index.update(run)
+        self.assertIn(run_id, self.index)
+        run["finished"] = True
+        self.index.update(run)
+        self.assertNotIn(run_id, self.index)
+        self.assertEqual(len(self.index), 0)
+
+    def test_threads_and_compiler(self):
+        smp = make_run(threads=8)
+        clang = make_run(compiler="clang++")
+        self.index.update(smp)
+        self.index.update(clang)
+        self.assertEqual(self.candidate_ids(16, 1, 100000, "g++"), {str(smp["_id"])})
+        self.assertEqual(
+            self.candidate_ids(4, 1, 100000, "clang++"), {str(clang["_id"])}
+        )
+        self.assertEqual(self.candidate_ids(16, 16, 100000, "clang++"), set())
+
+    def test_memory(self):
+        small = make_run(hash_new=16, hash_base=16)
+        large = make_run(hash_new=1024, hash_base=1024)
+        self.index.update(small)
+        self.index.update(large)
+        base = task_memory_base(1, 4)
+        self.assertEqual(
+            self.candidate_ids(4, 1, base + 4 * 32, "g++"), {str(small["_id"])}
+        )
+        self.assertEqual(self.candidate_ids(4, 1, base + 4 * 32 - 1, "g++"), set())
+        self.assertEqual(
+            self.candidate_ids(4, 1, base + 4 * 2048, "g++"),
+            {str(small["_id"]), str(large["_id"])},
+        )
+
+    def test_arch_filter_is_checked_once(self):
+        runs = [make_run(arch_filter="avx2") for _ in range(3)]
+        for run in runs:
+            self.index.update(run)
+        calls = []
+
+        def arch_filter_ok(arch_filter):
+            calls.append(arch_filter)
+            return False
+
+        self.assertEqual(
+            self.candidate_ids(1, 1, 100000, "g++", arch_filter_ok=arch_filter_ok),
+            set(),
+        )
+        self.assertEqual(calls, ["avx2"])
+        self.assertEqual(
+            len(self.candidate_ids(1, 1, 100000, "g++")),
+            3,
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,212 @@
+"""Test the vectorized SPSA worker data against the scalar reference."""
+
+import contextlib
+import unittest
+import zlib
+
+import numpy as np
+
+from fishtest.spsa_handler import SPSAHandler, _generate_flips
+from fishtest.spsa_history import SpsaHistory
+from fishtest.spsa_workflow import CLASSIC_SPSA_ALGORITHM
+
+
+class _CollectionStub:
+    def __init__(self):
+        self.records = []
+
+    def insert_one(self, record):
+        self.records.append(record)
+
+    def find_one(self, filter, projection, sort):
+        records = self.find(filter, projection, sort)
+        return records[-1] if records else None
+
+    def find(self, filter, projection, sort):
+        records = [r for r in self.records if r["run_id"] == filter["run_id"]]
+        return sorted(records, key=lambda record: record["index"])
+
+
+class _RunDbStub:
+    def __init__(self, run):
+        self.run = run
+        self.buffered = []
+        self.spsa_history = SpsaHistory({"spsa_history": _CollectionStub()})
+
+    def get_run(self, run_id):
+        return self.run
+
+    def is_primary_instance(self):
+        return True
+
+    def buffer(self, run, paths=()):
+        self.buffered.append(tuple(paths))
+
+    def active_run_lock(self, run_id):
+        return contextlib.nullcontext()
+
+
+RUN_ID = "0123456789abcdef01234567"
+
+
+def unpack_flips(packed_flips, n_params):
+    bits = np.unpackbits(np.frombuffer(packed_flips, dtype=np.uint8), count=n_params)
+    return 2 * bits.astype(np.int8) - 1
+
+
+def reference_step(spsa, param, iter_value):
+    # The classic SPSA step of a single param, written out independently
+    # of the vectorized code: c = c0 / (iter + 1)^gamma and
+    # R = a / (A + iter + 1)^alpha / c^2.
+    c = param["c"] / (iter_value + 1) ** spsa["gamma"]
+    R = param["a"] / (spsa["A"] + iter_value + 1) ** spsa["alpha"] / c**2
+    return c, R
+
+
+def reference_clip(param, value):
+    return min(max(value, param["min"]), param["max"])
+
+
+def make_run(n_params=300):
+    params = []
+    for i in range(n_params):
+        c = 2.0 + i % 7
+        params.append(
+            {
+                "name": f"P{i}",
+                "min": 0.0,
+                "max": 100.0,
+                "theta": 1.0 + (i % 100),
+                "c": c,
+                "a": 0.002 * c**2,
+            }
+        )
+    return {
+        "args": {
+            "num_games": 100000,
+            "spsa": {
+                "algorithm": CLASSIC_SPSA_ALGORITHM,
+                "A": 5000,
+                "alpha": 0.602,
+                "gamma": 0.101,
+                "iter": 1460,
+                "num_iter": 50000,
+                "params": params,
+            },
+        },
+        "tasks": [{"active": True}],
+    }
+
+
+class CreateSpsaHandlerTest(unittest.TestCase):
+    def setUp(self):
+        self.run = make_run()
+        self.rundb = _RunDbStub(self.run)
+        self.handler = SPSAHandler(self.rundb)
+        self.spsa = self.run["args"]["spsa"]
+
+    def test_generate_flips(self):
+        for n_params in (1, 7, 8, 300):
+            flips, packed_flips = _generate_flips(n_params)
+            self.assertIsInstance(packed_flips, bytes)
+            self.assertEqual(len(packed_flips), (n_params + 7) // 8)
+            self.assertEqual(set(flips.tolist()) - {-1, 1}, set())
+            np.testing.assert_array_equal(unpack_flips(packed_flips, n_params), flips)
+
+    def test_request_spsa_data_matches_steps(self):
+        result = self.handler.request_spsa_data(RUN_ID, 0)
+        packed_flips = self.run["tasks"][0]["spsa_params"]["packed_flips"]
+        self.assertEqual(result["sig"], zlib.crc32(packed_flips))
+        flips = unpack_flips(packed_flips, len(self.spsa["params"]))
+        self.assertEqual(
+            [w_param["flip"] for w_param in result["w_params"]], flips.tolist()
+        )
+        for param, w_param, b_param, flip in zip(
+            self.spsa["params"], result["w_params"], result["b_params"], flips
+        ):
+            c, R = reference_step(self.spsa, param, 1460)
+            self.assertAlmostEqual(w_param["c"], c, delta=1e-12 * c)
+            self.assertAlmostEqual(w_param["R"], R, delta=1e-12 * R)
+            self.assertAlmostEqual(
+                w_param["value"], reference_clip(param, param["theta"] + c * flip)
+            )
+            self.assertAlmostEqual(
+                b_param["value"], reference_clip(param, param["theta"] - c * flip)
+            )
+
+    def test_request_spsa_data_first_iteration(self):
+        # A tiny tune: at iter 0 the perturbation c is the base c.
+        self.spsa["iter"] = 0
+        self.spsa["params"] = self.spsa["params"][:1]
+        self.spsa["params"][0].update(theta=99.0, c=2.0)
+        result = self.handler.request_spsa_data(RUN_ID, 0)
+        w_param, b_param = result["w_params"][0], result["b_params"][0]
+        self.assertEqual(w_param["c"], 2.0)
+        expected = (100.0, 97.0) if w_param["flip"] == 1 else (97.0, 100.0)
+        self.assertEqual((w_param["value"], b_param["value"]), expected)
+
+    def test_update_spsa_data_matches_update_rule(self):
+        reference = make_run()["args"]["spsa"]
+        history = []
+        for _ in range(3):
+            result = self.handler.request_spsa_data(RUN_ID, 0)
+            flips = unpack_flips(
+                self.run["tasks"][0]["spsa_params"]["packed_flips"],
+                len(self.spsa["params"]),
+            )
+            steps = [
+                reference_step(reference, param, reference["iter"])
+                for param in reference["params"]
+            ]
+            for param, (c, R), flip in zip(reference["params"], steps, flips):
+                # wins - losses = 7
+                param["theta"] = reference_clip(
+                    param, param["theta"] + R * c * 7 * flip
+                )
+            reference["iter"] += 50
+            self.handler.update_spsa_data(
+                RUN_ID,
+                0,
+                {"sig": result["sig"], "wins": 30, "losses": 23, "num_games": 100},
+            )
+            self.assertNotIn("spsa_params", self.run["tasks"][0])
+            self.assertEqual(self.spsa["iter"], reference["iter"])
+            np.testing.assert_allclose(
+                [param["theta"] for param in self.spsa["params"]],
+                [param["theta"] for param in reference["params"]],
+                rtol=1e-12,
+            )
+            if not history:
+                history = [
+                    [param["theta"] for param in reference["params"]],
+                    [R for _, R in steps],
+                    [c for c, _ in steps],
+                ]
+        # The history period is 1500 iterations.
+        packed_history = self.rundb.spsa_history.load(RUN_ID, len(history[0]))
+        self.assertEqual(packed_history.shape, (1, 3, len(history[0])))
+        np.testing.assert_allclose(packed_history[0], history, rtol=1e-6)
+        self.assertNotIn("param_history", self.spsa)
+        chart = self.handler.get_spsa_data(RUN_ID)
+        self.assertEqual(len(chart["chart_rows"]), 3)
+
+    def test_reloaded_run_gets_a_new_state(self):
+        self.handler.request_spsa_data(RUN_ID, 0)
+        self.run["args"]["spsa"]["params"] = make_run()["args"]["spsa"]["params"]
+        self.run["args"]["spsa"]["params"][0]["theta"] = 50.0
+        result = self.handler.request_spsa_data(RUN_ID, 0)
+        w_param = result["w_params"][0]
+        self.assertEqual(w_param["value"], 50.0 + w_param["c"] * w_param["flip"])
+
+    def test_history_next_index_skips_gaps(self):
+        spsa_history = self.rundb.spsa_history
+        self.assertEqual(spsa_history.next_index(RUN_ID), 0)
+        # A migrated history whose sample 1 was skipped.
+        for index in (0, 2):
+            spsa_history.append(RUN_ID, index, 10 * index, [1.0], [0.1], [2.0])
+        self.assertEqual(spsa_history.next_index(RUN_ID), 3)
+        self.assertEqual(spsa_history.load(RUN_ID, 1).shape, (2, 3, 1))
+
+
+if __name__ == "__main__":
+    unittest.main()
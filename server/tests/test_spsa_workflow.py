@@ -4,13 +4,17 @@ import json
 import unittest
 from math import isfinite
 
+import numpy as np
+
 from fishtest.spsa_workflow import (
     CLASSIC_SPSA_ALGORITHM,
-    apply_spsa_result_updates,
     build_spsa_chart_payload,
     build_spsa_form_values,
     build_spsa_state,
-    build_spsa_worker_step,
+    build_spsa_worker_steps,
+    clip_spsa_param_values,
+    pack_spsa_history_sample,
+    unpack_spsa_history,
 )
 
 
@@ -89,72 +93,35 @@ class SpsaWorkflowTests(unittest.TestCase):
                 with self.assertRaisesRegex(ValueError, pattern):
                     build_spsa_state(post, num_games=500)
 
-    def test_build_spsa_worker_step_uses_classic_decay(self):
+    def test_build_spsa_worker_steps_uses_classic_decay(self):
         spsa = {
             "algorithm": CLASSIC_SPSA_ALGORITHM,
             "A": 25,
             "alpha": 0.602,
             "gamma": 0.101,
         }
-        param = {"a": 0.2, "c": 1.6}
 
-        worker_step = build_spsa_worker_step(spsa, param, iter_value=2, flip=1)
+        c, R = build_spsa_worker_steps(
+            spsa, np.array([1.6, 3.2]), np.array([0.2, 0.4]), iter_value=2
+        )
 
         expected_c = 1.6 / (3**0.101)
         expected_R = 0.2 / (28**0.602) / expected_c**2
-        self.assertAlmostEqual(worker_step["c"], expected_c)
-        self.assertAlmostEqual(worker_step["R"], expected_R)
-        self.assertEqual(worker_step["flip"], 1)
-
-    def test_apply_spsa_result_updates_preserves_classic_update_rule(self):
-        spsa = {
-            "algorithm": CLASSIC_SPSA_ALGORITHM,
-            "iter": 4,
-            "params": [
-                {
-                    "theta": 10.0,
-                    "min": 0.0,
-                    "max": 20.0,
-                },
-            ],
-        }
-        w_params = [{"R": 0.5, "c": 2.0, "flip": 1}]
-
-        result = apply_spsa_result_updates(
-            spsa,
-            w_params,
-            result=3,
-            game_pairs=10,
+        self.assertAlmostEqual(c[0], expected_c)
+        self.assertAlmostEqual(R[0], expected_R)
+        self.assertAlmostEqual(c[1], 2 * expected_c)
+        self.assertAlmostEqual(R[1], expected_R / 2)
+
+    def test_clip_spsa_param_values_preserves_classic_update_rule(self):
+        # theta += R * c * result * flip, clipped to [min, max].
+        theta = clip_spsa_param_values(
+            np.array([10.0, 10.0, 10.0]),
+            np.array([0.0, 0.0, 9.0]),
+            np.array([20.0, 12.0, 20.0]),
+            0.5 * 2.0 * 3 * np.array([1, 1, -1]),
         )
 
-        self.assertIsNone(result)
-        self.assertEqual(spsa["params"][0]["theta"], 13.0)
-
-    def test_apply_spsa_result_updates_rejects_length_mismatch(self):
-        spsa = {
-            "algorithm": CLASSIC_SPSA_ALGORITHM,
-            "iter": 4,
-            "params": [
-                {
-                    "theta": 10.0,
-                    "min": 0.0,
-                    "max": 20.0,
-                },
-                {
-                    "theta": 11.0,
-                    "min": 0.0,
-                    "max": 20.0,
-                },
-            ],
-        }
-
-        with self.assertRaisesRegex(ValueError, "length mismatch"):
-            apply_spsa_result_updates(
-                spsa,
-                [{"R": 0.5, "c": 2.0, "flip": 1}],
-                result=3,
-                game_pairs=10,
-            )
+        self.assertEqual(theta.tolist(), [13.0, 12.0, 9.0])
 
     def test_build_spsa_chart_payload_returns_server_shaped_chart_rows(self):
         spsa = {
@@ -295,6 +262,52 @@ class SpsaWorkflowTests(unittest.TestCase):
         )
         self.assertEqual(payload["chart_rows"][3]["values"], [12.5])
 
+    def test_build_spsa_chart_payload_decodes_packed_history(self):
+        gamma = 0.101
+        base_c = 1.6
+        spsa = {
+            "iter": 201,
+            "num_iter": 250,
+            "A": 4,
+            "alpha": 0.602,
+            "gamma": gamma,
+            "params": [
+                {
+                    "name": "ParamA",
+                    "theta": 12.5,
+                    "start": 10,
+                    "min": 0,
+                    "max": 20,
+                    "c": base_c,
+                    "c_end": 0.1,
+                    "a": 0.2,
+                    "r_end": 1.0e-03,
+                },
+            ],
+            "param_history": [[{"theta": 11.5, "R": 0.08, "c": base_c / 21**gamma}]],
+        }
+        samples = [
+            pack_spsa_history_sample([12.0], [0.08], [base_c / 201**gamma]),
+            pack_spsa_history_sample([12.5], [0.08], [base_c / 202**gamma]),
+            b"truncated",
+        ]
+        packed_history = unpack_spsa_history(samples, 1)
+
+        payload = build_spsa_chart_payload(spsa, packed_history)
+
+        self.assertEqual(packed_history.shape, (2, 3, 1))
+        self.assertEqual(
+            [row["values"] for row in payload["chart_rows"]],
+            [[10.0], [11.5], [12.0], [12.5]],
+        )
+        self.assertAlmostEqual(payload["chart_rows"][1]["iter_ratio"], 20 / 250)
+        # The packed samples are float32.
+        self.assertAlmostEqual(
+            payload["chart_rows"][2]["iter_ratio"], 200 / 250, places=6
+        )
+        # The last sample matches the live point, so no live row is added.
+        self.assertEqual(payload["chart_rows"][3]["iter_ratio"], 201 / 250)
+
     def test_build_spsa_chart_payload_falls_back_to_master_spacing_without_c(self):
         spsa = {
             "iter": 20,
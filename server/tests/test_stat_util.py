@@ -0,0 +1,95 @@
+"""Test the SPRT statistics and the memoization of SPRT_elo."""
+
+import math
+import unittest
+
+import numpy as np
+
+from fishtest.stats.brownian import Brownian
+from fishtest.stats.sprt import sprt
+from fishtest.stats.stat_util import (
+    SPRT_elo,
+    SPRT_elo_batch,
+    SPRT_elo_cache_clear,
+    SPRT_elo_cache_stats,
+    _SPRT_elo,
+)
+
+
+class CreateSPRTEloCacheTest(unittest.TestCase):
+    def setUp(self):
+        SPRT_elo_cache_clear()
+        self.results = {
+            "wins": 1200,
+            "losses": 1100,
+            "draws": 3700,
+            "pentanomial": [40, 700, 1400, 800, 60],
+        }
+        self.sprt = {"alpha": 0.05, "beta": 0.05, "elo0": 0.0, "elo1": 2.0}
+
+    def tearDown(self):
+        SPRT_elo_cache_clear()
+
+    def test_cached_result_matches(self):
+        for elo_model in ("BayesElo", "logistic", "normalized"):
+            expected = _SPRT_elo(self.results, p=0.05, elo_model=elo_model, **self.sprt)
+            for _ in range(2):
+                a = SPRT_elo(self.results, elo_model=elo_model, **self.sprt)
+                self.assertEqual(a, expected)
+        self.assertEqual(SPRT_elo_cache_stats(), {"hits": 3, "misses": 3, "size": 3})
+
+    def test_key(self):
+        a = SPRT_elo(self.results, elo_model="normalized", **self.sprt)
+        # the caller may modify the returned value
+        a["ci"][0] = None
+        a["elo"] = None
+        b = SPRT_elo(dict(self.results), elo_model="normalized", **self.sprt)
+        self.assertIsNotNone(b["ci"][0])
+        self.assertIsNotNone(b["elo"])
+        self.results["pentanomial"][2] += 1
+        SPRT_elo(self.results, elo_model="normalized", **self.sprt)
+        del self.results["pentanomial"]
+        SPRT_elo(self.results, elo_model="normalized", **self.sprt)
+        SPRT_elo(self.results, elo_model="normalized", **{**self.sprt, "elo1": 3.0})
+        self.assertEqual(SPRT_elo_cache_stats(), {"hits": 1, "misses": 4, "size": 4})
+
+    def test_batch(self):
+        tests = [
+            {"results": self.results, "elo_model": elo_model, **self.sprt}
+            for elo_model in ("BayesElo", "normalized", "normalized")
+        ]
+        elos = SPRT_elo_batch(tests)
+        self.assertEqual(
+            elos[0], SPRT_elo(self.results, elo_model="BayesElo", **self.sprt)
+        )
+        self.assertEqual(elos[1], elos[2])
+        self.assertEqual(SPRT_elo_cache_stats()["misses"], 2)
+
+
+class CreateVectorizedStatsTest(unittest.TestCase):
+    def test_brownian_outcome_cdf_vec(self):
+        mus = np.linspace(-0.05, 0.05, 41)
+        for T, sigma in ((5000, 0.05), (50, 0.05), (2000, 0.2)):
+            brownian = Brownian(a=-2.94, b=2.94, mu=mus, sigma=sigma)
+            cdfs = brownian.outcome_cdf(T=T, y=1.0)
+            for mu, cdf in zip(mus, cdfs):
+                expected = Brownian(a=-2.94, b=2.94, mu=mu, sigma=sigma).outcome_cdf(
+                    T=T, y=1.0
+                )
+                self.assertTrue(math.isclose(cdf, expected, abs_tol=1e-12))
+
+    def test_outcome_prob_batch(self):
+        for elo_model in ("logistic", "normalized"):
+            sp = sprt(elo0=0.0, elo1=2.0, elo_model=elo_model)
+            sp.set_state([40, 700, 1400, 800, 60])
+            elos = np.linspace(-20, 20, 17)
+            for elo, prob in zip(elos, sp.outcome_prob_batch(elos)):
+                self.assertTrue(math.isclose(prob, sp.outcome_prob(elo), abs_tol=1e-12))
+            lower, elo, upper = (sp.lower_cb(p) for p in (0.025, 0.5, 0.975))
+            self.assertLess(lower, elo)
+            self.assertLess(elo, upper)
+            self.assertTrue(math.isclose(sp.outcome_prob(elo), 0.5, abs_tol=1e-9))
+
+
+if __name__ == "__main__":
+    unittest.main()
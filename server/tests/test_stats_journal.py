@@ -0,0 +1,75 @@
+"""Test the selection of the records replayed from the stats journal."""
+
+import unittest
+from datetime import UTC, datetime, timedelta
+
+from bson.objectid import ObjectId
+
+from fishtest.stats_journal import StatsJournal
+
+
+class _JournalStub:
+    def __init__(self):
+        self.records = []
+
+    def insert_one(self, record):
+        self.records.append(record)
+
+    def with_options(self, write_concern):
+        return self
+
+    def find(self, filter, sort):
+        return reversed(self.records)
+
+
+class _DbStub(dict):
+    def list_collection_names(self):
+        return list(self.keys())
+
+    def create_collection(self, name, capped, size):
+        self[name] = _JournalStub()
+
+
+def stats(games):
+    return {
+        "wins": games,
+        "losses": 0,
+        "draws": 0,
+        "crashes": 0,
+        "time_losses": 0,
+        "pentanomial": [0, 0, 0, 0, games // 2],
+    }
+
+
+class CreateStatsJournalTest(unittest.TestCase):
+    def setUp(self):
+        self.journal = StatsJournal(_DbStub())
+        self.run_id = str(ObjectId())
+
+    def test_latest_record_per_task(self):
+        self.journal.record(self.run_id, 0, stats(2))
+        self.journal.record(self.run_id, 1, stats(2))
+        self.journal.record(self.run_id, 0, stats(4))
+        latest = self.journal.latest()
+        self.assertEqual(len(latest), 2)
+        self.assertEqual(latest[(self.run_id, 0)]["stats"], stats(4))
+        self.assertEqual(latest[(self.run_id, 1)]["stats"], stats(2))
+
+    def test_old_and_invalid_records_are_skipped(self):
+        self.journal.record(self.run_id, 0, stats(2))
+        self.journal.journal.records[0]["time"] -= timedelta(days=2)
+        self.journal.record(self.run_id, 1, {"wins": 2})
+        self.assertEqual(self.journal.latest(), {})
+        self.journal.record(self.run_id, 1, stats(2))
+        self.assertEqual(
+            self.journal.latest(max_age=timedelta(hours=1)).keys(),
+            {(self.run_id, 1)},
+        )
+        self.assertLess(
+            datetime.now(UTC) - self.journal.latest()[(self.run_id, 1)]["time"],
+            timedelta(minutes=1),
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,48 @@
+"""Test the deadline heap used by the dead task scavenger."""
+
+import unittest
+from datetime import UTC, datetime, timedelta
+
+from bson.objectid import ObjectId
+
+from fishtest.task_deadlines import TaskDeadlines
+
+
+class CreateTaskDeadlinesTest(unittest.TestCase):
+    def setUp(self):
+        self.deadlines = TaskDeadlines()
+        self.run_id = str(ObjectId())
+        self.now = datetime.now(UTC)
+
+    def test_pop_expired(self):
+        for task_id in range(3):
+            self.deadlines.touch(
+                self.run_id, task_id, self.now - timedelta(seconds=100 * task_id)
+            )
+        cutoff = (self.now - timedelta(seconds=150)).timestamp()
+        self.assertEqual(self.deadlines.pop_expired(cutoff), [(self.run_id, 2)])
+        self.assertEqual(self.deadlines.pop_expired(cutoff), [])
+        self.assertEqual(len(self.deadlines), 2)
+
+    def test_refresh_and_discard(self):
+        self.deadlines.touch(self.run_id, 0, self.now - timedelta(seconds=500))
+        self.deadlines.touch(self.run_id, 1, self.now - timedelta(seconds=500))
+        self.deadlines.touch(self.run_id, 0, self.now)
+        self.deadlines.discard(self.run_id, 1)
+        self.assertIn((self.run_id, 0), self.deadlines)
+        self.assertNotIn((self.run_id, 1), self.deadlines)
+        cutoff = (self.now - timedelta(seconds=360)).timestamp()
+        self.assertEqual(self.deadlines.pop_expired(cutoff), [])
+        self.assertEqual(len(self.deadlines), 1)
+
+    def test_compaction(self):
+        for _ in range(2000):
+            self.deadlines.touch(self.run_id, 0, self.now)
+        self.assertEqual(len(self.deadlines), 1)
+        self.assertEqual(
+            self.deadlines.pop_expired(self.now.timestamp() + 1), [(self.run_id, 0)]
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
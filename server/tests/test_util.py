@@ -0,0 +1,20 @@
+"""Test the chunking of streamed responses."""
+
+import unittest
+
+from fishtest.util import iter_chunks
+
+
+class CreateIterChunksTest(unittest.TestCase):
+    def test_iter_chunks(self):
+        blobs = [b"a" * 3, b"b" * 3, b"c" * 10, b"d"]
+        chunks = list(iter_chunks(blobs, chunk_size=4))
+        self.assertEqual(b"".join(chunks), b"".join(blobs))
+        self.assertEqual([len(chunk) for chunk in chunks], [6, 4, 4, 2, 1])
+        # large blobs are sliced without copying
+        self.assertIsInstance(chunks[1], memoryview)
+        self.assertEqual(list(iter_chunks([], chunk_size=4)), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,228 @@
+"""Test the compiled validators and the incremental run validation."""
+
+import copy
+import os
+import time
+import unittest
+from datetime import UTC, datetime
+
+from bson.objectid import ObjectId
+from vtjson import ValidationError, validate
+
+from fishtest.schemas import RUN_VERSION, api_schema, runs_schema
+from fishtest.validators import (
+    validate_api_access,
+    validate_api_beat,
+    validate_api_request,
+    validate_api_update_task,
+    validate_run,
+)
+
+WORKER_INFO = {
+    "uname": "Linux 6.1.0",
+    "architecture": ["64bit", "ELF"],
+    "concurrency": 8,
+    "max_memory": 4096,
+    "min_threads": 1,
+    "username": "WorkerUser",
+    "version": 329,
+    "python_version": [3, 11, 7],
+    "gcc_version": [12, 2, 0],
+    "compiler": "g++",
+    "unique_key": "abcd1234-1234-1234-1234-123456789abc",
+    "modified": False,
+    "worker_arch": "x86-64-avx2",
+    "ARCH": "x86-64-avx2",
+    "nps": 1000000.0,
+    "near_github_api_limit": False,
+}
+
+STATS = {
+    "wins": 10,
+    "losses": 10,
+    "draws": 20,
+    "crashes": 0,
+    "time_losses": 0,
+    "pentanomial": [2, 3, 10, 3, 2],
+}
+
+
+def api_request():
+    return {
+        "password": "secret",
+        "run_id": str(ObjectId()),
+        "task_id": 5,
+        "worker_info": copy.deepcopy(WORKER_INFO),
+        "stats": copy.deepcopy(STATS),
+    }
+
+
+def make_run(num_tasks):
+    now = datetime.now(UTC)
+    worker_info = {
+        **WORKER_INFO,
+        "remote_addr": "127.0.0.1",
+        "country_code": "?",
+    }
+    tasks = [
+        {
+            "num_games": 40,
+            "active": False,
+            "last_updated": now,
+            "start": 40 * i,
+            "stats": copy.deepcopy(STATS),
+            "worker_info": copy.deepcopy(worker_info),
+        }
+        for i in range(num_tasks)
+    ]
+    results = {
+        key: (
+            [num_tasks * x for x in value]
+            if key == "pentanomial"
+            else num_tasks * value
+        )
+        for key, value in STATS.items()
+    }
+    return {
+        "_id": ObjectId(),
+        "version": RUN_VERSION,
+        "start_time": now,
+        "last_updated": now,
+        "tc_base": 10.0,
+        "approved": True,
+        "approver": "Approver",
+        "finished": False,
+        "deleted": False,
+        "failed": False,
+        "failures": 0,
+        "is_green": False,
+        "is_yellow": False,
+        "workers": 0,
+        "cores": 0,
+        "committed_games": 40 * num_tasks,
+        "total_games": 40 * num_tasks,
+        "results": results,
+        "nps": 0.0,
+        "games_per_minute": 0.0,
+        "args": {
+            "base_tag": "master",
+            "new_tag": "patch",
+            "base_nets": ["nn-0123456789ab.nnue"],
+            "new_nets": ["nn-0123456789ab.nnue"],
+            "num_games": 80 * num_tasks,
+            "tc": "10+0.1",
+            "new_tc": "10+0.1",
+            "book": "UHO_Lichess_4852_v1.epd",
+            "book_depth": "8",
+            "threads": 1,
+            "resolved_base": 40 * "a",
+            "resolved_new": 40 * "b",
+            "msg_base": "base",
+            "msg_new": "new",
+            "base_options": "Hash=16",
+            "new_options": "Hash=16",
+            "info": "",
+            "base_signature": "123456",
+            "new_signature": "123457",
+            "username": "RunUser",
+            "tests_repo": "https://github.com/official-stockfish/Stockfish",
+            "auto_purge": False,
+            "throughput": 100.0,
+            "itp": 100.0,
+            "priority": 0.0,
+            "adjudication": True,
+        },
+        "tasks": tasks,
+        "bad_tasks": [],
+    }
+
+
+class ValidatorTest(unittest.TestCase):
+    def test_api_request(self):
+        request = api_request()
+        validate_api_access(request)
+        validate_api_request(request)
+        del request["run_id"]
+        with self.assertRaises(ValidationError) as e:
+            validate_api_request(request)
+        self.assertIn("request", str(e.exception))
+
+    def test_api_update_task_and_beat(self):
+        request = api_request()
+        validate_api_update_task(request)
+        request["spsa"] = {"wins": 1, "losses": 1, "draws": 0, "num_games": 2, "sig": 1}
+        validate_api_update_task(request)
+        request["pgn"] = "1. e4"
+        with self.assertRaises(ValidationError):
+            validate_api_update_task(request)
+        request = api_request()
+        del request["stats"]
+        validate_api_beat(request)
+        for key in ("run_id", "task_id"):
+            beat = dict(request)
+            del beat[key]
+            with self.assertRaises(ValidationError) as e:
+                validate_api_beat(beat)
+            self.assertIn(key, str(e.exception))
+        request["stats"] = copy.deepcopy(STATS)
+        with self.assertRaises(ValidationError):
+            validate_api_beat(request)
+
+    def test_run(self):
+        run = make_run(3)
+        validate(runs_schema, run, "run")
+        validate_run(run)
+        validate_run(run, task_ids=(1,))
+
+    def test_run_incremental(self):
+        run = make_run(3)
+        run["tasks"][2]["start"] = -1
+        with self.assertRaises(ValidationError):
+            validate_run(run)
+        with self.assertRaises(ValidationError) as e:
+            validate_run(run, task_ids=(2,))
+        self.assertIn("run['tasks'][2]", str(e.exception))
+        # Only the given tasks are validated.
+        validate_run(run, task_ids=(0, 1))
+        # But the run itself is.
+        run["cores"] = 8
+        with self.assertRaises(ValidationError):
+            validate_run(run, task_ids=(0,))
+
+
+@unittest.skipUnless(
+    os.environ.get("FISHTEST_BENCHMARK"), "set FISHTEST_BENCHMARK=1 to run"
+)
+class ValidatorBenchmark(unittest.TestCase):
+    def measure(self, name, f, count):
+        f()
+        start = time.perf_counter()
+        for _ in range(count):
+            f()
+        elapsed = (time.perf_counter() - start) / count
+        print(f"\n{name}: {1e6 * elapsed:,.1f} us", end="")
+
+    def test_api_request(self):
+        request = api_request()
+        self.measure(
+            "api request, vtjson.validate",
+            lambda: validate(api_schema, request, "request"),
+            1000,
+        )
+        self.measure(
+            "api request, compiled", lambda: validate_api_request(request), 1000
+        )
+
+    def test_run(self):
+        run = make_run(20000)
+        self.measure(
+            "run (20000 tasks), vtjson.validate",
+            lambda: validate(runs_schema, run, "run"),
+            1,
+        )
+        self.measure("run (20000 tasks), compiled", lambda: validate_run(run), 1)
+        self.measure(
+            "run (20000 tasks), one task",
+            lambda: validate_run(run, task_ids=(0,)),
+            10,
+        )
@@ -95,6 +95,14 @@ def create_runs_indexes():
 def create_pgns_indexes():
     print("Creating indexes on pgns collection")
     db["pgns"].create_index([("run_id", DESCENDING)])
+    db["pgns"].create_index([("run", ASCENDING), ("task_id", ASCENDING)])
+
+
+def create_spsa_history_indexes():
+    print("Creating indexes on spsa_history collection")
+    db["spsa_history"].create_index(
+        [("run_id", ASCENDING), ("index", ASCENDING)], unique=True
+    )
 
 
 def create_nns_indexes():
@@ -194,6 +202,9 @@ if __name__ == "__main__":
             elif collection_name == "pgns":
                 drop_indexes("pgns")
                 create_pgns_indexes()
+            elif collection_name == "spsa_history":
+                drop_indexes("spsa_history")
+                create_spsa_history_indexes()
             elif collection_name == "nns":
                 drop_indexes("nns")
                 create_nns_indexes()
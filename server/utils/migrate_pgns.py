@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+
+# migrate_pgns.py - add the "run" and "task_id" fields to the pgns
+#
+# The pgns of a run are looked up through the (run, task_id) index
+# instead of a regex on run_id. Run this script once, after the server
+# upgrade, to add the fields to the existing pgns and to create the index.
+# It can be interrupted and restarted.
+
+from pymongo import ASCENDING, UpdateOne
+
+from fishtest.rundb import RunDb
+from fishtest.util import split_pgn_id
+
+BATCH_SIZE = 1000
+
+
+def migrate_pgns(pgndb):
+    migrated = 0
+    requests = []
+    for pgn in pgndb.find({"run": {"$exists": False}}, {"run_id": 1}):
+        try:
+            run, task_id = split_pgn_id(pgn["run_id"])
+        except ValueError:
+            print(f"Skipping the pgn {pgn['run_id']}", flush=True)
+            continue
+        requests.append(
+            UpdateOne({"_id": pgn["_id"]}, {"$set": {"run": run, "task_id": task_id}})
+        )
+        if len(requests) >= BATCH_SIZE:
+            pgndb.bulk_write(requests, ordered=False)
+            migrated += len(requests)
+            requests = []
+            print(f"{migrated} pgns migrated", flush=True)
+    if requests:
+        pgndb.bulk_write(requests, ordered=False)
+        migrated += len(requests)
+    return migrated
+
+
+def main():
+    rundb = RunDb()
+    migrated = migrate_pgns(rundb.pgndb)
+    print(f"Migrated {migrated} pgns")
+    rundb.pgndb.create_index([("run", ASCENDING), ("task_id", ASCENDING)])
+    print("Created the (run, task_id) index on pgns")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+# migrate_spsa_history.py - move the SPSA parameter history out of the runs
+#
+# The parameter history of an SPSA tune is stored as packed float32 samples
+# in the spsa_history collection instead of the list of dicts
+# args.spsa.param_history of the run. Run this script once, with the server
+# stopped (the run cache must not hold the old runs), to move the existing
+# histories and to create the index. It can be interrupted and restarted.
+#
+# Sample i of param_history gets the index i. A skipped sample leaves a gap
+# so that the indices match the ones the server counts from the length of
+# param_history, and the samples the server stored after them (with indices
+# from len(param_history) on) are kept.
+
+import math
+
+from pymongo import ASCENDING
+
+from fishtest.rundb import RunDb
+from fishtest.spsa_workflow import get_spsa_history_period, pack_spsa_history_sample
+
+
+def as_float(value):
+    try:
+        return float(value)
+    except TypeError, ValueError:
+        return math.nan
+
+
+def migrate_run(spsa_history, run):
+    run_id = str(run["_id"])
+    spsa = run["args"]["spsa"]
+    param_count = len(spsa["params"])
+    period = get_spsa_history_period(
+        num_iter=run["args"]["num_games"] / 2, param_count=param_count
+    )
+    param_history = spsa["param_history"]
+    records = []
+    for index, sample in enumerate(param_history):
+        if len(sample) != param_count:
+            print(f"Skipping sample {index} of {run_id}", flush=True)
+            continue
+        theta, R, c = (
+            [as_float(param.get(key)) for param in sample]
+            for key in ("theta", "R", "c")
+        )
+        records.append(
+            {
+                "run_id": run_id,
+                "index": index,
+                # The iteration of the legacy samples is not known.
+                "iter": int((index + 1) * period),
+                "sample": pack_spsa_history_sample(theta, R, c),
+            }
+        )
+    # Samples left by an interrupted migration.
+    spsa_history.collection.delete_many(
+        {"run_id": run_id, "index": {"$lt": len(param_history)}}
+    )
+    if records:
+        spsa_history.collection.insert_many(records)
+    return len(records)
+
+
+def main():
+    rundb = RunDb()
+    migrated = 0
+    for run in rundb.runs.find(
+        {"args.spsa.param_history": {"$exists": True}},
+        {"args.spsa": 1, "args.num_games": 1},
+    ):
+        samples = migrate_run(rundb.spsa_history, run)
+        rundb.runs.update_one(
+            {"_id": run["_id"]}, {"$unset": {"args.spsa.param_history": ""}}
+        )
+        migrated += 1
+        print(f"{run['_id']}: {samples} samples", flush=True)
+    print(f"Migrated {migrated} runs")
+    rundb.spsa_history.collection.create_index(
+        [("run_id", ASCENDING), ("index", ASCENDING)], unique=True
+    )
+    print("Created the (run_id, index) index on spsa_history")
+
+
+if __name__ == "__main__":
+    main()
@@ -5,6 +5,7 @@ from datetime import UTC, datetime, timedelta
 from pymongo import DESCENDING
 
 from fishtest.rundb import RunDb
+from fishtest.util import run_pgns_query
 
 
 def purge_pgns(rundb, finished, deleted, days, days_ltc=60):
@@ -33,7 +34,7 @@ def purge_pgns(rundb, finished, deleted, days, days_ltc=60):
             purged_runs += 1
 
         tasks_count = len(run["tasks"])
-        pgns_query = {"run_id": {"$regex": f"^{run['_id']}-\\d+"}}
+        pgns_query = run_pgns_query(str(run["_id"]))
         pgns_count = rundb.pgndb.count_documents(pgns_query)
         if keep:
             kept_tasks += tasks_count
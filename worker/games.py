@@ -1,8 +1,11 @@
 import base64
 import copy
 import ctypes
+import functools
+import gzip
 import hashlib
 import io
+import itertools
 import json
 import math
 import multiprocessing
@@ -23,6 +26,7 @@ from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
 from pathlib import Path
 from queue import Empty, Queue
+from urllib.parse import urlparse
 from zipfile import ZipFile
 
 if "packages.requests" in sys.modules:
@@ -33,6 +37,11 @@ else:
     except ImportError:
         from packages import requests
 
+try:
+    import openlock
+except (ImportError, SyntaxError):
+    from packages import openlock
+
 IS_WINDOWS = "windows" in platform.system().lower()
 IS_MACOS = "darwin" in platform.system().lower()
 LOGFILE = "api.log"
@@ -88,6 +97,10 @@ UPDATE_RETRY_TIME = 15.0
 RAWCONTENT_HOST = "https://raw.githubusercontent.com"
 API_HOST = "https://api.github.com"
 EXE_SUFFIX = ".exe" if IS_WINDOWS else ""
+# Json api requests of at least this size are sent gzip compressed.
+API_GZIP_MIN_SIZE = 1024
+# Maximal time to wait for another worker building the same engine.
+ENGINE_BUILD_LOCK_TIMEOUT = 1800
 
 
 def log(s):
@@ -172,6 +185,7 @@ def trim_files(testing_dir, source_dir=None):
         ("fastchess" + EXE_SUFFIX, 1, math.inf, False),
         ("stockfish-*-old" + EXE_SUFFIX, 0, -1, True),
         ("stockfish-*" + EXE_SUFFIX, 50, 30, False),
+        ("bench-stockfish-*", 50, 30, False),
         ("nn-*.nnue", 10, 30, False),
         ("results-*.pgn", 10, 30, False),
         ("*.epd", 4, 365, False),
@@ -274,26 +288,121 @@ def requests_get(remote, *args, **kw):
     return result
 
 
-def requests_post(remote, *args, **kw):
-    # A lightweight wrapper around requests.post()
-    try:
-        if "timeout" not in kw:
-            kw["timeout"] = HTTP_TIMEOUT
-        result = requests.post(remote, *args, **kw)
-    except Exception as e:
-        print(f"Exception in requests.post():\n{e}", file=sys.stderr)
-        raise WorkerException(f"Post request to {remote} failed.", e=e)
+class ApiClient:
+    """Client for the api of the server.
+
+    Every thread (the main thread and the heartbeat thread) uses its own
+    requests.Session, so that the connection to the server is kept alive
+    and reused. A request which fails because the server closed an idle
+    connection is sent once more on a new connection. Json bodies of at
+    least gzip_min_size bytes are gzip compressed (None disables this).
+    The latencies of the requests are aggregated per endpoint.
+    """
+
+    def __init__(self, gzip_min_size=API_GZIP_MIN_SIZE):
+        self.gzip_min_size = gzip_min_size
+        self.__local = threading.local()
+        self.__lock = threading.Lock()
+        self.__stats = {}
+
+    def __session(self):
+        session = getattr(self.__local, "session", None)
+        if session is None:
+            session = self.__local.session = requests.Session()
+        return session
+
+    def reset(self):
+        """Close the connections of the current thread."""
+        session = getattr(self.__local, "session", None)
+        if session is not None:
+            self.__local.session = None
+            session.close()
+
+    def encode(self, payload):
+        """Return (body, headers) for a json payload."""
+        body = json.dumps(payload).encode()
+        headers = {"Content-Type": "application/json"}
+        if self.gzip_min_size is not None and len(body) >= self.gzip_min_size:
+            body = gzip.compress(body)
+            headers["Content-Encoding"] = "gzip"
+        return body, headers
+
+    def post(self, url, data, headers):
+        try:
+            try:
+                return self.__session().post(
+                    url, data=data, headers=headers, timeout=HTTP_TIMEOUT
+                )
+            except requests.exceptions.ConnectionError as e:
+                # An iterator body cannot be sent again.
+                if not isinstance(data, bytes) or not is_connection_aborted(e):
+                    raise
+                print(f"Connection to {url} aborted, reconnecting...")
+                self.reset()
+                return self.__session().post(
+                    url, data=data, headers=headers, timeout=HTTP_TIMEOUT
+                )
+        except Exception as e:
+            print(f"Exception in requests.post():\n{e}", file=sys.stderr)
+            self.reset()
+            raise WorkerException(f"Post request to {url} failed.", e=e)
+
+    def record(self, url, worker_ms, server_ms):
+        endpoint = urlparse(url).path
+        with self.__lock:
+            stats = self.__stats.setdefault(
+                endpoint,
+                {"count": 0, "worker_ms": 0.0, "server_ms": 0.0, "max_ms": 0.0},
+            )
+            stats["count"] += 1
+            stats["worker_ms"] += worker_ms
+            stats["server_ms"] += server_ms
+            stats["max_ms"] = max(stats["max_ms"], worker_ms)
+
+    def stats(self):
+        with self.__lock:
+            return copy.deepcopy(self.__stats)
+
+    def format_stats(self):
+        lines = []
+        for endpoint, stats in sorted(self.stats().items()):
+            count = stats["count"]
+            lines.append(
+                f"{endpoint:<24} {count:6d} requests  "
+                f"{stats['worker_ms'] / count:7.2f} ms (w)  "
+                f"{stats['server_ms'] / count:6.2f} ms (s)  "
+                f"{stats['max_ms']:7.2f} ms (w max)"
+            )
+        return "\n".join(lines)
 
-    return result
+
+def is_connection_aborted(e):
+    # Raised when the server closed an idle keep-alive connection, as
+    # opposed to a connection that could not be established.
+    return bool(e.args) and isinstance(
+        e.args[0], (requests.adapters.ProtocolError, ConnectionResetError)
+    )
 
 
-def send_api_post_request(api_url, payload, quiet=False):
+API_CLIENT = ApiClient()
+
+
+def send_api_post_request(api_url, payload, quiet=False, gzip_body=None):
+    # If gzip_body (bytes or an iterator of bytes) is given, then it is
+    # sent as the (possibly chunked) body of the request, after the payload
+    # terminated by a newline. Headers are logged by proxies, so they must
+    # not carry the password.
     t0 = datetime.now(timezone.utc)
-    response = requests_post(
-        api_url,
-        data=json.dumps(payload),
-        headers={"Content-Type": "application/json"},
-    )
+    if gzip_body is None:
+        data, headers = API_CLIENT.encode(payload)
+    else:
+        request = json.dumps(payload).encode() + b"\n"
+        if isinstance(gzip_body, bytes):
+            data = request + gzip_body
+        else:
+            data = itertools.chain((request,), gzip_body)
+        headers = {"Content-Type": "application/octet-stream"}
+    response = API_CLIENT.post(api_url, data=data, headers=headers)
     valid_response = True
     try:
         response = response.json()
@@ -313,6 +422,7 @@ def send_api_post_request(api_url, payload, quiet=False):
     t1 = datetime.now(timezone.utc)
     w = 1000 * (t1 - t0).total_seconds()
     s = 1000 * response["duration"]
+    API_CLIENT.record(api_url, w, s)
     log(f"{s:6.2f} ms (s)  {w:7.2f} ms (w)  {api_url}")
     if not quiet:
         if "info" in response:
@@ -555,15 +665,38 @@ def get_bench_nps(engine, games_concurrency, threads, hash_size):
     return mean_nps
 
 
-def verify_signature(engine, signature):
+def bench_nodes_path(engine):
+    return engine.parent / ("bench-" + engine.name)
+
+
+def write_bench_nodes(engine, bench_nodes):
+    try:
+        bench_nodes_path(engine).write_text(str(bench_nodes))
+    except OSError as e:
+        print(f"Failed to save the bench of {engine.name}:\n{e}", file=sys.stderr)
+
+
+def engine_bench_nodes(engine):
+    """The bench nodes (signature) of the engine. They are computed once
+    and then saved in a file next to the engine."""
+    try:
+        return int(bench_nodes_path(engine).read_text())
+    except (OSError, ValueError):
+        pass
     hash_size, threads, depth = 16, 1, 13
     print("Computing engine signature...")
     bench_time, bench_nodes = run_single_bench(engine, hash_size, threads, depth)
     print(f"...done in {bench_time:.2f}ms.")
-    if int(bench_nodes) != int(signature):
+    write_bench_nodes(engine, int(bench_nodes))
+    return int(bench_nodes)
+
+
+def verify_signature(engine, signature):
+    bench_nodes = engine_bench_nodes(engine)
+    if bench_nodes != int(signature):
         message = (
             f"Wrong bench in {engine.name}, "
-            f"user expected: {signature} but worker got: {int(bench_nodes)}"
+            f"user expected: {signature} but worker got: {bench_nodes}"
         )
         raise RunException(message)
 
@@ -838,6 +971,63 @@ def engine_is_healthy(path: Path, timeout_s: float = 5.0):
         return False
 
 
+@functools.lru_cache(maxsize=None)
+def host_cpu_id(compiler):
+    """Identify the cpu as seen by the compiler. An engine built with
+    ARCH=native only runs on a cpu with the same features."""
+    props = gcc_props() if compiler == "g++" else clang_props()
+    flags = " ".join(sorted(props["flags"]))
+    return props["arch"] + "-" + hashlib.sha256(flags.encode()).hexdigest()[0:8]
+
+
+def engine_cache_read(global_cache, cache_name, engine_path, engine_path_native):
+    """Copy the engine from the global cache to the testing directory,
+    None if not available"""
+    info = cache_read(global_cache, cache_name + ".json")
+    blob = cache_read(global_cache, cache_name + EXE_SUFFIX)
+    if info is None or blob is None:
+        return None
+    try:
+        info = json.loads(info)
+        path = engine_path_native if info["native"] else engine_path
+        bench_nodes = int(info["bench"])
+    except (ValueError, TypeError, KeyError):
+        cache_remove(global_cache, cache_name + ".json")
+        return None
+
+    temp_file = tempfile.NamedTemporaryFile(
+        dir=path.parent, suffix=EXE_SUFFIX, delete=False
+    )
+    temp_path = Path(temp_file.name)
+    try:
+        with temp_file:
+            temp_file.write(blob)
+        temp_path.chmod(0o755)
+        if not engine_is_healthy(temp_path):
+            print(f"Removing invalid engine {cache_name} from global cache.")
+            cache_remove(global_cache, cache_name + ".json")
+            cache_remove(global_cache, cache_name + EXE_SUFFIX)
+            return None
+        write_bench_nodes(path, bench_nodes)
+        temp_path.replace(path)
+    finally:
+        temp_path.unlink(missing_ok=True)
+    print(f"Using {cache_name} from global cache.")
+    return path
+
+
+def engine_cache_write(global_cache, cache_name, path, native):
+    """Publish the engine in the global cache, together with its bench.
+    The json file is written last, so readers never see a partial entry."""
+    try:
+        info = {"native": native, "bench": engine_bench_nodes(path)}
+    except (RunException, WorkerException) as e:
+        print(f"Not publishing {cache_name} in the global cache: {e}")
+        return
+    cache_write(global_cache, cache_name + EXE_SUFFIX, path.read_bytes())
+    cache_write(global_cache, cache_name + ".json", json.dumps(info).encode())
+
+
 def setup_engine(
     testing_dir,
     remote,
@@ -863,10 +1053,63 @@ def setup_engine(
 
         print(f"Removing invalid engine {path}")
         try:
+            bench_nodes_path(path).unlink(missing_ok=True)
             path.unlink()
         except Exception as e:
             raise WorkerException(f"Failed to remove cached engine {path}:\n{e}")
 
+    build_args = (
+        testing_dir,
+        remote,
+        sha,
+        repo_url,
+        concurrency,
+        compiler,
+        env,
+        engine_path,
+        engine_path_native,
+        global_cache,
+    )
+    if global_cache == "":
+        return build_engine(*build_args)
+
+    # The global cache is shared by the workers on the host (or on several
+    # hosts), so the engines are also keyed by the cpu. The lock makes the
+    # other workers wait for the build instead of repeating it.
+    cache_name = "-".join([engine_name, host_cpu_id(compiler)])
+    lock = openlock.FileLock(Path(global_cache) / (cache_name + ".lock"))
+    try:
+        lock.acquire(timeout=ENGINE_BUILD_LOCK_TIMEOUT)
+    except (openlock.OpenLockException, OSError) as e:
+        print(f"Unable to lock the global cache for {cache_name}: {e}")
+        lock = None
+    try:
+        path = engine_cache_read(
+            global_cache, cache_name, engine_path, engine_path_native
+        )
+        if path is None:
+            path = build_engine(*build_args)
+            engine_cache_write(
+                global_cache, cache_name, path, native=path == engine_path_native
+            )
+    finally:
+        if lock is not None:
+            lock.release()
+    return path
+
+
+def build_engine(
+    testing_dir,
+    remote,
+    sha,
+    repo_url,
+    concurrency,
+    compiler,
+    env,
+    engine_path,
+    engine_path_native,
+    global_cache,
+):
     """Download and build sources in a temporary directory then move exe as engine_path"""
     worker_dir = testing_dir.parent
     tmp_dir = Path(tempfile.mkdtemp(dir=worker_dir))
@@ -1028,6 +1271,8 @@ def adjust_tc(tc, factor):
 def enqueue_output(stream, queue):
     for line in iter(stream.readline, ""):
         queue.put(line)
+    # Signal the end of the stream.
+    queue.put(None)
 
 
 def parse_fastchess_output(
@@ -1092,6 +1337,9 @@ def parse_fastchess_output(
     )
     fastchess_WLD_results = None
     fastchess_ptnml_results = None
+    # All the patterns below start with "Warning;", which is checked first,
+    # so that the bulk of the output (e.g. the "Finished game" lines) is
+    # not matched against them.
     patterns_fastchess_error = (
         # E.g. "Warning; New-SHA doesn't have option ThreatBySafePawn"
         re.compile(r"Warning;.*doesn't have option"),
@@ -1122,6 +1370,9 @@ def parse_fastchess_output(
         re.compile(r"Warning; No output from"),
         re.compile(r"Warning; No bestmove found from"),
     )
+    pattern_fastchess_error = re.compile(
+        "|".join(f"(?:{pattern.pattern})" for pattern in patterns_fastchess_error)
+    )
 
     q = Queue()
     t_output = threading.Thread(target=enqueue_output, args=(p.stdout, q), daemon=True)
@@ -1134,14 +1385,28 @@ def parse_fastchess_output(
 
     num_games_updated = 0
     count_fastchess_warnings = {}
+    open_streams = 2
+    # Throughput of the processing of the fastchess output.
+    output_stats = {"lines": 0, "processing_time": 0.0}
+    current_state["fastchess_output"] = output_stats
     while datetime.now(timezone.utc) < end_time:
         if current_state["task_id"] is None:
             # This task is no longer necessary.
             # Error message has already been printed.
             return False
+        # We block until fastchess produces output, but wake up regularly
+        # to check the state of the task and of the fastchess process.
         try:
-            line = q.get_nowait().strip()
+            line = q.get(timeout=1.0)
         except Empty:
+            line = ""
+        if line is None:
+            # End of stdout or stderr.
+            open_streams -= 1
+            if open_streams > 0:
+                continue
+        if not line:
+            # Both streams are closed or fastchess has been silent for a while.
             returncode = p.poll()
             if returncode is not None:
                 if returncode != 0:
@@ -1150,10 +1415,13 @@ def parse_fastchess_output(
                         f"{format_returncode(returncode)}"
                     )
                 break
-            time.sleep(0.1)
             continue
 
-        line = hash_pattern.sub(shorten_hash, line)
+        start_time = time.perf_counter()
+        line = line.strip()
+        # Most lines name no engine, so skip the substitution for them.
+        if "Base-" in line or "New-" in line:
+            line = hash_pattern.sub(shorten_hash, line)
         print(line, flush=True)
 
         # Do we have a pgn crc?
@@ -1171,9 +1439,12 @@ def parse_fastchess_output(
 
         engine_names = frozenset(name for name in (base_name, new_name) if name in line)
 
+        is_warning = "Warning;" in line
+
         # Check line for fastchess errors, exempting official releases.
         if (
-            any(pattern.search(line) for pattern in patterns_fastchess_error)
+            is_warning
+            and pattern_fastchess_error.search(line)
             and not engine_names & release_names
         ):
             message = f"fastchess says: '{line}'"
@@ -1182,7 +1453,7 @@ def parse_fastchess_output(
         # Check line for fastchess warnings, and post warnings that do not come
         # from official releases to the event log.
         # Post only the first warning per pattern and engine, followed by an exponential count.
-        for pattern in patterns_fastchess_warning:
+        for pattern in patterns_fastchess_warning if is_warning else ():
             if not pattern.search(line) or engine_names & release_names:
                 continue
 
@@ -1218,7 +1489,7 @@ def parse_fastchess_output(
             result["stats"]["time_losses"] += 1
 
         # fastchess WLD and pentanomial output parsing.
-        m = pattern_WLD.search(line)
+        m = pattern_WLD.search(line) if "Games:" in line else None
         if m:
             try:
                 fastchess_WLD_results = {
@@ -1233,7 +1504,7 @@ def parse_fastchess_output(
                     f"Failed to parse WLD line: {line} leading to:\n{e}"
                 )
 
-        m = pattern_ptnml.search(line)
+        m = pattern_ptnml.search(line) if "Ptnml(" in line else None
         if m:
             try:
                 fastchess_ptnml_results = [int(m.group(i)) for i in range(1, 6)]
@@ -1242,6 +1513,9 @@ def parse_fastchess_output(
                     f"Failed to parse ptnml line: {line} leading to:\n{e}"
                 )
 
+        output_stats["lines"] += 1
+        output_stats["processing_time"] += time.perf_counter() - start_time
+
         # If we have parsed the block properly let's update results.
         if (fastchess_ptnml_results is not None) and (
             fastchess_WLD_results is not None
@@ -1321,6 +1595,11 @@ def parse_fastchess_output(
             f"{datetime.now(timezone.utc)} is past end time {end_time}."
         )
 
+    lines, processing_time = output_stats["lines"], output_stats["processing_time"]
+    print(
+        f"Processed {lines} lines of fastchess output in {processing_time:.3f}s"
+        + (f" ({lines / processing_time:.0f} lines/s)" if processing_time > 0 else "")
+    )
     return True
 
 
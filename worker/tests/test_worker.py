@@ -1,5 +1,7 @@
 """Test worker setup, downloads, and command-line behavior."""
 
+import gzip
+import json
 import os
 import shutil
 import subprocess
@@ -66,6 +68,49 @@ class WorkerTest(unittest.TestCase):
         with self.assertRaises(Exception):
             games.setup_engine("foo", cwd, cwd, "https://foo", "foo", "https://foo", 1)
 
+    @unittest.skipIf(os.name == "nt", "the fake engine is a shell script")
+    def test_engine_global_cache(self):
+        cache = self.tempdir / "cache"
+        cache.mkdir()
+        testing_dir = self.tempdir / "testing"
+        engine = testing_dir / "stockfish-built"
+        engine.write_text("#!/bin/sh\nexit 0\n")
+        engine.chmod(0o755)
+        games.write_bench_nodes(engine, 1234)
+        games.engine_cache_write(str(cache), "stockfish-key", engine, native=True)
+
+        engine_path = testing_dir / "stockfish-copy-old"
+        engine_path_native = testing_dir / "stockfish-copy"
+        path = games.engine_cache_read(
+            str(cache), "stockfish-key", engine_path, engine_path_native
+        )
+        self.assertEqual(path, engine_path_native)
+        self.assertEqual(path.read_bytes(), engine.read_bytes())
+        self.assertEqual(games.engine_bench_nodes(path), 1234)
+        self.assertIsNone(
+            games.engine_cache_read(
+                str(cache), "stockfish-other", engine_path, engine_path_native
+            )
+        )
+
+    def test_api_client(self):
+        client = games.ApiClient(gzip_min_size=100)
+        body, headers = client.encode({"a": 1})
+        self.assertEqual(body, b'{"a": 1}')
+        self.assertNotIn("Content-Encoding", headers)
+        payload = {"message": 100 * "a"}
+        body, headers = client.encode(payload)
+        self.assertEqual(headers["Content-Encoding"], "gzip")
+        self.assertEqual(json.loads(gzip.decompress(body)), payload)
+
+        client.record("https://tests.stockfishchess.org/api/beat", 20.0, 1.0)
+        client.record("https://tests.stockfishchess.org/api/beat", 40.0, 3.0)
+        stats = client.stats()["/api/beat"]
+        self.assertEqual(stats["count"], 2)
+        self.assertEqual(stats["worker_ms"], 60.0)
+        self.assertEqual(stats["max_ms"], 40.0)
+        self.assertIn("/api/beat", client.format_stats())
+
     def test_updater(self):
         file_list = updater.update(restart=False, test=True)
         self.assertIn("worker.py", file_list)
@@ -1,10 +1,8 @@
 #!/usr/bin/env python3
-import base64
+import codecs
 import getpass
-import gzip
 import hashlib
 import importlib
-import io
 import json
 import multiprocessing
 import os
@@ -41,6 +39,7 @@ except ImportError:
     from packages import requests
 
 from games import (
+    API_CLIENT,
     EXE_SUFFIX,
     IS_MACOS,
     IS_WINDOWS,
@@ -74,12 +73,13 @@ MIN_CLANG_MINOR = 0
 
 FASTCHESS_SHA = "58072f231dc1ae33204254f867afd0a195f21a2e"
 
-WORKER_VERSION = 325
+WORKER_VERSION = 331
 FILE_LIST = ["updater.py", "worker.py", "games.py"]
 HTTP_TIMEOUT = 30.0
 INITIAL_RETRY_TIME = 15.0
 THREAD_JOIN_TIMEOUT = 15.0
 MAX_RETRY_TIME = 900.0  # 15 minutes
+PGN_CHUNK_SIZE = 1024 * 1024  # bytes, for the streaming pgn upload
 
 # We do not import "google.colab" directly since it is not used
 # and there are subtleties involved in deleting it after import
@@ -138,7 +138,7 @@ Main loop           <fishtest>/api/update_task
 
 Finish task         <fishtest>/api/failed_task                                  POST
                     <fishtest>/api/stop_run                                     POST
-                    <fishtest>/api/upload_pgn                                   POST
+                    <fishtest>/api/upload_pgn_stream                            POST
 
 
 The POST requests are json encoded. For the shape of a valid request, consult
@@ -1412,18 +1412,36 @@ def fetch_and_handle_task(
         except Exception as e:
             print(f"Exception posting failed_task:\n{e}", file=sys.stderr)
 
-    def upload_pgn_data(pgn_data, run_id, task_id, remote, payload):
-        with io.BytesIO() as gz_buffer:
-            with gzip.GzipFile(
-                filename=f"{str(run_id)}-{task_id}.pgn.gz",
-                mode="wb",
-                fileobj=gz_buffer,
-            ) as gz:
-                gz.write(pgn_data.encode())
-            payload["pgn"] = base64.b64encode(gz_buffer.getvalue()).decode()
-
-        print(f"Uploading compressed PGN of {len(payload['pgn'])} bytes.")
-        send_api_post_request(remote + "/api/upload_pgn", payload)
+    def pgn_crc32(pgn_file):
+        crc = 0
+        with open(pgn_file, "rb") as f:
+            while chunk := f.read(PGN_CHUNK_SIZE):
+                crc = zlib.crc32(chunk, crc)
+        return hex(crc)
+
+    def gzip_pgn_chunks(pgn_file, stats):
+        # Compress the file on the fly, dropping non UTF-8 characters.
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+        compressor = zlib.compressobj(wbits=31)  # gzip format
+        with open(pgn_file, "rb") as f:
+            while chunk := f.read(PGN_CHUNK_SIZE):
+                data = compressor.compress(decoder.decode(chunk).encode())
+                stats["size"] += len(data)
+                if data:
+                    yield data
+        data = compressor.compress(decoder.decode(b"", final=True).encode())
+        data += compressor.flush()
+        stats["size"] += len(data)
+        yield data
+
+    def upload_pgn_file(pgn_file, remote, payload):
+        stats = {"size": 0}
+        send_api_post_request(
+            remote + "/api/upload_pgn_stream",
+            payload,
+            gzip_body=gzip_pgn_chunks(pgn_file, stats),
+        )
+        print(f"Uploaded compressed PGN of {stats['size']} bytes.")
 
     if (
         not pgn_file["name"]
@@ -1439,9 +1457,7 @@ def fetch_and_handle_task(
     # Upload PGN file.
     if "spsa" not in run["args"]:
         try:
-            file_content = pgn_file.read_bytes()
-
-            crc_actual = hex(zlib.crc32(file_content))
+            crc_actual = pgn_crc32(pgn_file)
 
             # Check that the file is not corrupted
             if crc_actual != crc_expected:
@@ -1449,9 +1465,7 @@ def fetch_and_handle_task(
                     f"Checksum of file ({crc_actual}) does not match expected value ({crc_expected}).\nSkipping upload."
                 )
             else:
-                # Decode bytes to text, ignoring non UTF-8 characters
-                data = file_content.decode("utf-8", errors="ignore")
-                upload_pgn_data(data, run["_id"], task_id, remote, payload)
+                upload_pgn_file(pgn_file, remote, payload)
         except Exception as e:
             print(f"\nException uploading PGN file:\n{e}", file=sys.stderr)
 
@@ -1618,6 +1632,9 @@ def worker():
             options.global_cache,
             worker_lock,
         )
+        api_stats = API_CLIENT.format_stats()
+        if api_stats:
+            print(f"Latency of the api requests:\n{api_stats}")
         if (worker_dir / "fish.exit").is_file():
             current_state["alive"] = False
             print("Stopped by 'fish.exit' file.")